@@ -13,7 +13,9 @@ import numba
 # of this code have already been tested and shown to perform no better
 # than numba on Intel haswell and KNL architectures.
 
-@numba.jit
+# cache=True keeps the compiled kernel on disk, so that new processes (and
+# the multiprocessing workers) do not compile it again.
+@numba.jit(nopython=True, nogil=True, cache=True)
 def _trapz_rebin(x, y, edges, results):
     nbin = len(edges) - 1
     nx = len(x)
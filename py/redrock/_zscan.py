@@ -5,7 +5,6 @@ Low-level optimized functions for chi^2 fitting.
 from __future__ import absolute_import, division, print_function
 
 import numpy as np
-import numba
 
 # This code is purposely written in a very "C-like" way.  The logic
 # being that it may help numba optimization and also makes it easier
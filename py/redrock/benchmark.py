@@ -0,0 +1,406 @@
+"""
+redrock.benchmark
+=================
+
+Benchmarks of the main steps of redrock on synthetic targets and templates.
+
+The targets and templates are built with the functions of redrock.test.util,
+by default with DESI-like sizes (3 cameras at 0.8 Angstrom sampling and
+10 basis vectors), so no input files or template directory are needed.  The
+results are written as JSON, which can be compared between commits with
+compare_results() (or "rrspeedtest --compare old.json new.json").
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import json
+import shutil
+import socket
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+
+from ._version import __version__
+
+
+# The steps which are run for each number of processes.
+mp_steps = ["rebin", "scan", "zfind"]
+
+# All steps, in the order they are run.
+all_steps = ["coadd", "load", "distribute", "rebin", "scan", "fitz", "zfind",
+    "write", "read", "write_spectra", "read_spectra"]
+
+
+class _quiet(object):
+    """Silence the progress messages printed by the code being timed."""
+    def __enter__(self):
+        sys.stdout.flush()
+        self._stdout = sys.stdout
+        self._null = open(os.devnull, "w")
+        sys.stdout = self._null
+        return self
+
+    def __exit__(self, *exc):
+        sys.stdout = self._stdout
+        self._null.close()
+        return False
+
+
+def _timeit(func, repeat):
+    """Run func() repeat times and return the list of run times.
+    """
+    times = list()
+    for r in range(repeat):
+        with _quiet():
+            start = time.time()
+            func()
+            times.append(time.time() - start)
+    return times
+
+
+def synthetic_inputs(ntarget=16, nz=500, nexp=1, nbasis=10, small=False,
+    seed=0):
+    """Build synthetic spectra and a template for the benchmarks.
+
+    Args:
+        ntarget (int): the number of targets.
+        nz (int): the number of redshifts of the template.
+        nexp (int): the number of exposures of each target.
+        nbasis (int): the number of basis vectors of the template.
+        small (bool): use the small wavelength grids of the unit tests
+            rather than DESI-like grids.
+        seed (int): the random seed.
+
+    Returns:
+        tuple: (spectra, template) where spectra is a list of (targetid,
+            list of Spectrum) for each target, from which new Target objects
+            can be built, and template is a Template.
+
+    """
+    from .test import util
+
+    np.random.seed(seed)
+    waves = None
+    if not small:
+        waves = util.desi_waves
+    zmax = 1.5
+    redshifts = np.linspace(0.01, zmax, nz)
+    wavemax = 9000 if small else util.desi_waves[-1][-1] + 100
+    template = util.get_template(wavemin=100, wavemax=wavemax, wavestep=1,
+        redshifts=redshifts, nbasis=nbasis)
+    spectra = list()
+    for i in range(ntarget):
+        z = np.random.uniform(0.05, zmax - 0.05)
+        tg = util.get_target(z, waves=waves, nexp=nexp)
+        spectra.append((1000 + i, tg.spectra))
+    return spectra, template
+
+
+def run_benchmarks(ntarget=16, nz=500, nexp=1, nbasis=10, procs=(1,),
+    repeat=3, steps=None, small=False, backend="processes", tmpdir=None):
+    """Time the main steps of redrock.
+
+    The steps are:
+
+    - coadd: building the targets and computing their coadds.
+    - load: reading a template file.
+    - distribute: distributing the targets (DistTargetsCopy) and packing
+      them into shared memory.
+    - rebin: rebinning the template to the wavelength grids of the targets.
+    - scan: the coarse redshift scan (calc_zchi2_targets).
+    - fitz: the refinement of all targets on one process.
+    - zfind: the full fit, including the scan and the refinement.
+    - write: writing the redrock scan file.
+    - read: reading the scan file.
+    - write_spectra: writing a DESI spectra file of the targets.
+    - read_spectra: reading the spectra file with DistTargetsDESI (skipped
+      if desispec is not installed).
+
+    The rebin, scan and zfind steps are timed for each number of processes.
+
+    Args:
+        ntarget (int): the number of targets.
+        nz (int): the number of redshifts of the template.
+        nexp (int): the number of exposures of each target.
+        nbasis (int): the number of basis vectors of the template.
+        procs (list): the numbers of multiprocessing processes.
+        repeat (int): the number of times each step is timed.
+        steps (list): the steps to run (default all).
+        small (bool): use the small spectra of the unit tests.
+        backend (str): "processes" or "threads" for the workers.
+        tmpdir (str): directory for the temporary files (default a new
+            temporary directory, which is removed at the end).
+
+    Returns:
+        list: one dictionary per step and number of processes, with the
+            "step", "nproc", the run "times" and their "best" and "median".
+
+    """
+    from .test import util
+    from .targets import Target, DistTargetsCopy
+    from .templates import Template, DistTemplate
+    from .zscan import calc_zchi2_targets
+    from .fitz import fitz
+    from .zfind import zfind
+    from .results import write_zscan, read_zscan
+    from .test.mockfiles import write_desi_spectra, write_template
+
+    if steps is None:
+        steps = all_steps
+    for st in steps:
+        if st not in all_steps:
+            raise ValueError("unknown benchmark step \"{}\"".format(st))
+
+    spectra, template = synthetic_inputs(ntarget=ntarget, nz=nz, nexp=nexp,
+        nbasis=nbasis, small=small)
+
+    def make_targets():
+        return [ Target(tid, list(sp), coadd=True) for tid, sp in spectra ]
+
+    cleanup = False
+    if tmpdir is None:
+        tmpdir = tempfile.mkdtemp()
+        cleanup = True
+
+    out = list()
+    def record(step, nproc, times):
+        out.append(dict(step=step, nproc=nproc, times=times,
+            best=min(times), median=float(np.median(times))))
+        print("  {:<13s} {:>3d} procs  best {:8.3f} s  median {:8.3f} s"\
+            .format(step, nproc, min(times), np.median(times)))
+        sys.stdout.flush()
+
+    try:
+        targets = make_targets()
+        dtargets = DistTargetsCopy(targets)
+        dwave = dtargets.wavegrids()
+        ft = template.full_type
+
+        if "coadd" in steps:
+            record("coadd", 1, _timeit(make_targets, repeat))
+
+        if "load" in steps:
+            tfile = os.path.join(tmpdir, "rrtemplate-bench.fits")
+            write_template(tfile, template)
+            record("load", 1, _timeit(lambda: Template(tfile), repeat))
+
+        if "distribute" in steps:
+            def distribute():
+                dt = DistTargetsCopy(make_targets())
+                for tg in dt.local():
+                    tg.sharedmem_pack()
+            record("distribute", 1, _timeit(distribute, repeat))
+
+        dtemp = DistTemplate(template, dwave, mp_procs=max(procs),
+            backend=backend)
+
+        for nproc in procs:
+            if "rebin" in steps:
+                record("rebin", nproc, _timeit(lambda: DistTemplate(template,
+                    dwave, mp_procs=nproc, backend=backend), repeat))
+            if "scan" in steps:
+                record("scan", nproc, _timeit(lambda: calc_zchi2_targets(
+                    dtargets, [ dtemp ], mp_procs=nproc, backend=backend),
+                    repeat))
+            if "zfind" in steps:
+                record("zfind", nproc, _timeit(lambda: zfind(dtargets,
+                    [ dtemp ], mp_procs=nproc, backend=backend), repeat))
+
+        if ("fitz" in steps) or ("write" in steps) or ("read" in steps):
+            with _quiet():
+                zscan, zfit = zfind(dtargets, [ dtemp ], mp_procs=max(procs),
+                    backend=backend)
+
+        if "fitz" in steps:
+            def refine():
+                for tg in dtargets.local():
+                    res = zscan[tg.id][ft]
+                    fitz(res["zchi2"] + res["penalty"], template.redshifts,
+                        tg.spectra, template)
+            record("fitz", 1, _timeit(refine, repeat))
+
+        scanfile = os.path.join(tmpdir, "rrbench.h5")
+        if "write" in steps:
+            record("write", 1, _timeit(lambda: write_zscan(scanfile, zscan,
+                zfit, clobber=True), repeat))
+
+        if "read" in steps:
+            if not os.path.exists(scanfile):
+                with _quiet():
+                    write_zscan(scanfile, zscan, zfit, clobber=True)
+            record("read", 1, _timeit(lambda: read_zscan(scanfile), repeat))
+
+        specfile = os.path.join(tmpdir, "spectra-bench.fits")
+        waves = None if small else util.desi_waves
+        def write_spectra():
+            write_desi_spectra(specfile, ntarget=ntarget, nexp=nexp,
+                waves=waves)
+        if "write_spectra" in steps:
+            record("write_spectra", 1, _timeit(write_spectra, repeat))
+
+        if "read_spectra" in steps:
+            from .external.desi import DistTargetsDESI
+            try:
+                import desispec.resolution
+                import desiutil.io
+                have_desi = True
+            except ImportError:
+                have_desi = False
+                print("  {:<13s} skipped, desispec is not available".format(
+                    "read_spectra"))
+            if have_desi:
+                if not os.path.exists(specfile):
+                    write_spectra()
+                record("read_spectra", 1, _timeit(lambda: DistTargetsDESI(
+                    [ specfile ], coadd=True), repeat))
+
+    finally:
+        if cleanup:
+            shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return out
+
+
+def _git_commit():
+    """Return the git commit of the source tree, or None."""
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+    try:
+        with open(os.devnull, "w") as null:
+            commit = subprocess.check_output(["git", "rev-parse", "HEAD"],
+                cwd=srcdir, stderr=null)
+        return commit.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def environment():
+    """Describe the code and machine that the benchmarks ran on."""
+    import platform
+    import multiprocessing as mp
+    env = dict(version=__version__, commit=_git_commit(),
+        host=socket.gethostname(), date=time.strftime("%Y-%m-%dT%H:%M:%S"),
+        python=platform.python_version(), numpy=np.__version__,
+        cpus=mp.cpu_count())
+    try:
+        import numba
+        env["numba"] = numba.__version__
+    except ImportError:
+        pass
+    return env
+
+
+def compare_results(old, new, threshold=0.1):
+    """Compare the run times of two benchmark result files.
+
+    Steps are matched by step name, number of processes and problem size.
+    The best run times are compared.
+
+    Args:
+        old (dict): the earlier results, as written by main().
+        new (dict): the new results.
+        threshold (float): the relative slowdown above which a step is
+            flagged as a regression.
+
+    Returns:
+        list: for each matching step, a tuple (step, nproc, old best, new
+            best, ratio, regressed).
+
+    """
+    okeys = ["ntarget", "nz", "nexp", "nbasis", "small"]
+    if any([ old["config"].get(k) != new["config"].get(k) for k in okeys ]):
+        print("WARNING: the problem sizes of the two results differ")
+    oldres = { (x["step"], x["nproc"]) : x for x in old["results"] }
+    rows = list()
+    for x in new["results"]:
+        key = (x["step"], x["nproc"])
+        if key not in oldres:
+            continue
+        ob = oldres[key]["best"]
+        ratio = x["best"] / ob if ob > 0 else float("inf")
+        rows.append((x["step"], x["nproc"], ob, x["best"], ratio,
+            ratio > 1.0 + threshold))
+    return rows
+
+
+def main(options=None):
+    """Run the benchmarks, or compare two result files.
+    """
+    parser = argparse.ArgumentParser(description="Time the main steps of "
+        "redrock on synthetic targets and templates.")
+
+    parser.add_argument("--ntarget", type=int, default=16,
+        help="number of targets")
+    parser.add_argument("--nz", type=int, default=500,
+        help="number of template redshifts")
+    parser.add_argument("--nexp", type=int, default=1,
+        help="number of exposures of each target")
+    parser.add_argument("--nbasis", type=int, default=10,
+        help="number of template basis vectors")
+    parser.add_argument("--procs", type=str, default="1",
+        help="comma separated numbers of processes to sweep")
+    parser.add_argument("--repeat", type=int, default=3,
+        help="number of timings of each step")
+    parser.add_argument("--steps", type=str, default=None,
+        help="comma separated steps to run, from {}".format(
+        ",".join(all_steps)))
+    parser.add_argument("--small", default=False, action="store_true",
+        help="use the small spectra of the unit tests")
+    parser.add_argument("--backend", type=str, default="processes",
+        choices=["processes", "threads"], help="worker backend")
+    parser.add_argument("-o", "--output", type=str, default=None,
+        help="write the results to this JSON file")
+    parser.add_argument("--compare", type=str, nargs=2, default=None,
+        metavar=("OLD", "NEW"), help="compare two result files and exit")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help="relative slowdown reported as a regression by --compare")
+
+    args = None
+    if options is None:
+        args = parser.parse_args()
+    else:
+        args = parser.parse_args(options)
+
+    if args.compare is not None:
+        with open(args.compare[0]) as f:
+            old = json.load(f)
+        with open(args.compare[1]) as f:
+            new = json.load(f)
+        print("Comparing {} ({}) to {} ({})".format(args.compare[1],
+            new["environment"].get("commit"), args.compare[0],
+            old["environment"].get("commit")))
+        rows = compare_results(old, new, threshold=args.threshold)
+        nbad = 0
+        for step, nproc, ob, nb, ratio, bad in rows:
+            print("  {:<13s} {:>3d} procs  {:8.3f} s -> {:8.3f} s  x{:5.2f}{}"\
+                .format(step, nproc, ob, nb, ratio,
+                "  REGRESSION" if bad else ""))
+            nbad += bad
+        return 1 if nbad > 0 else 0
+
+    procs = [ int(x) for x in args.procs.split(",") ]
+    steps = None
+    if args.steps is not None:
+        steps = args.steps.split(",")
+
+    config = dict(ntarget=args.ntarget, nz=args.nz, nexp=args.nexp,
+        nbasis=args.nbasis, procs=procs, repeat=args.repeat,
+        small=args.small, backend=args.backend)
+    print("Benchmarking {} targets, {} redshifts, {} basis vectors".format(
+        args.ntarget, args.nz, args.nbasis))
+    sys.stdout.flush()
+
+    results = run_benchmarks(ntarget=args.ntarget, nz=args.nz,
+        nexp=args.nexp, nbasis=args.nbasis, procs=procs, repeat=args.repeat,
+        steps=steps, small=args.small, backend=args.backend)
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(dict(environment=environment(), config=config,
+                results=results), f, indent=1)
+        print("Wrote {}".format(args.output))
+    return 0
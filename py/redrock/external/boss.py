@@ -16,25 +16,17 @@ import traceback
 import argparse
 
 import numpy as np
-from scipy import sparse
 
-from astropy.io import fits
-from astropy.table import Table
+# astropy, fitsio, the DESI packages and the fitting modules are imported by
+# the functions using them, so that the command line starts quickly.
 
-import fitsio
+from ..utils import (elapsed, get_mp, distribute_work, configure_workers,
+    worker_threads, set_threads, mpi_threads, thread_summary, process_age)
 
-import desispec.resolution
-from desispec.resolution import Resolution
+from ..targets import (Spectrum, Target, DistTargetsCopy,
+    downsample_targets)
 
-from ..utils import elapsed, get_mp, distribute_work
-
-from ..targets import Spectrum, Target, DistTargetsCopy
-
-from ..templates import load_dist_templates
-
-from ..results import write_zscan
-
-from ..zfind import zfind
+from ..instrument import span, write_trace, enable_memory, print_memory
 
 
 def platemjdfiber2targetid(plate, mjd, fiber):
@@ -56,6 +48,8 @@ def write_zbest(outfile, zbest):
         zbest (Table): the output best fit results.
 
     """
+    from astropy.io import fits
+
     zbest.meta['EXTNAME'] = 'ZBEST'
 
     hx = fits.HDUList()
@@ -81,6 +75,11 @@ def read_spectra(spplate_name, targetids=None, use_frames=False,
         meta is a Table of metadata (currently only BRICKNAME).
 
     """
+    from scipy import sparse
+    from astropy.table import Table
+    import fitsio
+    from desispec.resolution import Resolution
+
     ## read spplate
     spplate = fitsio.FITS(spplate_name)
     plate = spplate[0].read_header()["PLATEID"]
@@ -256,10 +255,68 @@ def rrboss(options=None, comm=None):
     parser.add_argument("--allspec", default=False, action="store_true",
         required=False, help="use individual spectra instead of coadd")
 
+    parser.add_argument("--downsample", type=int, default=1,
+        required=False, help="bin the spectra and templates by this factor "
+        "for the coarse redshift scan; the minima are refined at full "
+        "resolution")
+
+    parser.add_argument("--zcoeff", type=str, default="full",
+        required=False, choices=["full", "window", "none"],
+        help="template coefficients to keep in the scan output: at every "
+        "redshift (full), only around the chi2 minima (window) or none")
+
+    parser.add_argument("--zcoeff-halfwidth", type=int, default=5,
+        required=False, help="for --zcoeff window, the number of redshifts "
+        "kept on each side of each minimum")
+
+    parser.add_argument("--scan-float32", default=False, action="store_true",
+        required=False, help="store the scan chi2, penalty and coefficients "
+        "as float32")
+
+    parser.add_argument("--priors", type=str, default=None,
+        required=False, help="a table of TARGETID and the optional columns "
+        "ZMIN, ZMAX and SPECTYPE (comma separated template types) which "
+        "restrict the redshift scan of each target")
+
+    parser.add_argument("--zmin", type=str, default=None, action="append",
+        required=False, help="the smallest redshift scanned, either for all "
+        "templates or as TYPE:ZMIN for one template type (repeatable)")
+
+    parser.add_argument("--zmax", type=str, default=None, action="append",
+        required=False, help="the largest redshift scanned, either for all "
+        "templates or as TYPE:ZMAX for one template type (repeatable)")
+
     parser.add_argument("--mp", type=int, default=0,
         required=False, help="if not using MPI, the number of multiprocessing"
             " processes to use (defaults to half of the hardware threads)")
 
+    parser.add_argument("--trace", type=str, default=None,
+        required=False, help="write the timing of the phases and the "
+        "counters of every process to this JSON file")
+
+    parser.add_argument("--trace-format", type=str, default="json",
+        required=False, choices=["json", "chrome"],
+        help="write a summary per phase and process (json) or every timed "
+        "span as a Chrome trace event (chrome)")
+
+    parser.add_argument("--memory", default=False, action="store_true",
+        required=False, help="record the memory of every process in each "
+        "phase and print the peak memory of each process at the end")
+
+    parser.add_argument("--threads", type=int, default=None,
+        required=False, help="the number of BLAS / OpenMP threads of each "
+        "process (default: OMP_NUM_THREADS if set, otherwise the available "
+        "CPUs divided between the processes)")
+
+    parser.add_argument("--pin", type=str, default=None, required=False,
+        choices=["none", "cores", "numa"],
+        help="pin the processes to their own cores or to NUMA domains")
+
+    parser.add_argument("--backend", type=str, default="processes",
+        required=False, choices=["processes", "threads"],
+        help="if not using MPI, run the multiprocessing workers as processes "
+        "or as threads sharing the target and template data")
+
     parser.add_argument("--use-frames", default=False, action="store_true",
         required=False, help="use individual spcframes instead of spplate "
         "(the spCFrame files are expected to be in the same directory as "
@@ -281,6 +338,18 @@ def rrboss(options=None, comm=None):
         comm_size = comm.size
         comm_rank = comm.rank
 
+    startup = process_age()
+    if comm_rank == 0 and startup is not None:
+        print("Startup (interpreter, imports and options): {:0.1f} seconds"\
+            .format(startup))
+        sys.stdout.flush()
+
+    from ..templates import load_dist_templates
+    from ..results import write_zscan
+    from ..zscan import ScanRetention
+    from ..zfind import zfind
+    from ..priors import RedshiftPriors, parse_zlimits
+
     # Check arguments- all processes have this, so just check on the first
     # process
 
@@ -319,28 +388,36 @@ def rrboss(options=None, comm=None):
     elif n_targets is not None:
         first_target = 0
 
+    # Limit the BLAS / OpenMP threads so that the processes do not
+    # oversubscribe the CPUs.  An explicit OMP_NUM_THREADS is kept.
+    nthread = args.threads
+    if nthread is None and "OMP_NUM_THREADS" in os.environ:
+        nthread = int(os.environ["OMP_NUM_THREADS"])
+    configure_workers(threads=nthread, pin=args.pin)
+
     # Multiprocessing processes to use if MPI is disabled.
     mpprocs = 0
     if comm is None:
         mpprocs = get_mp(args.mp)
         print("Running with {} processes".format(mpprocs))
-        if "OMP_NUM_THREADS" in os.environ:
-            nthread = int(os.environ["OMP_NUM_THREADS"])
-            if nthread != 1:
-                print("WARNING:  {} multiprocesses running, each with "
-                    "{} threads ({} total)".format(mpprocs, nthread,
-                    mpprocs*nthread))
-                print("WARNING:  Please ensure this is <= the number of "
-                    "physical cores on the system")
-        else:
-            print("WARNING:  using multiprocessing, but the OMP_NUM_THREADS")
-            print("WARNING:  environment variable is not set- your system may")
-            print("WARNING:  be oversubscribed.")
+        threads = set_threads(worker_threads(mpprocs))
+        print("Each process uses {} threads ({}), pinning: {}".format(
+            threads["threads"], threads["method"], args.pin or "none"))
         sys.stdout.flush()
-    elif comm_rank == 0:
-        print("Running with {} processes".format(comm_size))
+    else:
+        threads = mpi_threads(comm)
+        if comm_rank == 0:
+            print("Running with {} processes".format(comm_size))
+            print("Rank 0 uses {}".format(thread_summary(threads)))
+            sys.stdout.flush()
+    if threads["method"] == "environment" and comm_rank == 0:
+        print("WARNING:  threadpoolctl is not installed, the thread limits")
+        print("WARNING:  only apply to libraries loaded after this point.")
         sys.stdout.flush()
 
+    if args.memory:
+        enable_memory()
+
     try:
         # Load and distribute the targets
         if comm_rank == 0:
@@ -354,24 +431,36 @@ def rrboss(options=None, comm=None):
         # that could be changed to work like the DESI write_zbest() function.
         # Each target contains metadata which is propagated to the output zbest
         # table though.
-        targets, meta = read_spectra(args.spplate, targetids=targetids,
-            use_frames=args.use_frames, coadd=(not args.allspec))
+        targets = None
+        if comm_rank == 0:
+            with span("load_targets"):
+                targets, meta = read_spectra(args.spplate,
+                    targetids=targetids, use_frames=args.use_frames,
+                    coadd=(not args.allspec))
 
-        if args.ntargets is not None:
-            targets = targets[first_target:first_target+n_targets]
-            meta = meta[first_target:first_target+n_targets]
+            if args.ntargets is not None:
+                targets = targets[first_target:first_target+n_targets]
+                meta = meta[first_target:first_target+n_targets]
 
         stop = elapsed(start, "Read of {} targets"\
-            .format(len(targets)), comm=comm)
+            .format(0 if targets is None else len(targets)), comm=comm)
 
         # Distribute the targets.
 
         start = elapsed(None, "", comm=comm)
 
-        dtargets = DistTargetsCopy(targets, comm=comm, root=0)
+        with span("distribute_targets"):
+            dtargets = DistTargetsCopy(targets, comm=comm, root=0)
 
-        # Get the dictionary of wavelength grids
-        dwave = dtargets.wavegrids()
+        # Get the dictionary of wavelength grids, binned for the coarse scan
+        # if requested.
+        coarse = None
+        if args.downsample > 1:
+            with span("downsample"):
+                coarse = downsample_targets(dtargets, args.downsample)
+            dwave = coarse.wavegrids()
+        else:
+            dwave = dtargets.wavegrids()
 
         stop = elapsed(start, "Distribution of {} targets"\
             .format(len(dtargets.all_target_ids)), comm=comm)
@@ -379,15 +468,37 @@ def rrboss(options=None, comm=None):
         # Read the template data
 
         dtemplates = load_dist_templates(dwave, templates=args.templates,
-            comm=comm, mp_procs=mpprocs)
+            comm=comm, mp_procs=mpprocs, backend=args.backend)
+
+        # The scan data to keep in memory and write to the output.
+
+        retention = ScanRetention(zcoeff=args.zcoeff, nminima=args.nminima,
+            halfwidth=args.zcoeff_halfwidth,
+            dtype=(np.float32 if args.scan_float32 else np.float64))
+
+        # The redshift priors of the targets.
+
+        zmin = parse_zlimits(args.zmin)
+        zmax = parse_zlimits(args.zmax)
+        priors = None
+        if comm_rank == 0:
+            if args.priors is not None:
+                priors = RedshiftPriors.read(args.priors, zmin=zmin,
+                    zmax=zmax)
+            elif len(zmin) + len(zmax) > 0:
+                priors = RedshiftPriors(zmin=zmin, zmax=zmax)
+        if comm is not None:
+            priors = comm.bcast(priors, root=0)
 
         # Compute the redshifts, including both the coarse scan and the
-        # refinement.  This function only returns data on the rank 0 process.
+        # refinement.  The best fit table is only returned on the rank 0
+        # process, and each process keeps the scan data of its own targets.
 
         start = elapsed(None, "", comm=comm)
 
         scandata, zfit = zfind(dtargets, dtemplates, mpprocs,
-            nminima=args.nminima)
+            nminima=args.nminima, gather_scan=False, retention=retention,
+            backend=args.backend, coarse=coarse, priors=priors)
 
         stop = elapsed(start, "Computing redshifts took", comm=comm)
 
@@ -395,8 +506,9 @@ def rrboss(options=None, comm=None):
 
         if args.output is not None:
             start = elapsed(None, "", comm=comm)
-            if comm_rank == 0:
-                write_zscan(args.output, scandata, zfit, clobber=True)
+            with span("write_zscan"):
+                write_zscan(args.output, scandata, zfit, clobber=True,
+                    comm=comm)
             stop = elapsed(start, "Writing zscan data took", comm=comm)
 
         if args.zbest:
@@ -412,7 +524,8 @@ def rrboss(options=None, comm=None):
                     if colname.islower():
                         zbest.rename_column(colname, colname.upper())
 
-                write_zbest(args.zbest, zbest)
+                with span("write_zbest"):
+                    write_zbest(args.zbest, zbest)
 
             stop = elapsed(start, "Writing zbest data took", comm=comm)
 
@@ -427,6 +540,12 @@ def rrboss(options=None, comm=None):
 
     global_stop = elapsed(global_start, "Total run time", comm=comm)
 
+    if args.memory:
+        print_memory(comm=comm)
+
+    if args.trace is not None:
+        write_trace(args.trace, comm=comm, format=args.trace_format)
+
     if args.debug:
         import IPython
         IPython.embed()
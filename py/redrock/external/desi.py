@@ -9,6 +9,8 @@ from __future__ import absolute_import, division, print_function
 import os
 import sys
 import re
+import gc
+import shutil
 import warnings
 import traceback
 
@@ -19,22 +21,20 @@ if sys.version_info[0] > 2:
 
 import numpy as np
 
-from astropy.io import fits
-from astropy.table import Table
+# astropy, the DESI packages and the fitting modules are imported by the
+# functions using them, so that the command line starts quickly.
 
-from desiutil.io import encode_table
+from ..utils import (elapsed, get_mp, distribute_work, configure_workers,
+    worker_threads, set_threads, mpi_threads, thread_summary, process_age)
 
-from desispec.resolution import Resolution
+from ..targets import (Spectrum, Target, DistTargets, TargetCost,
+    downsample_targets)
 
-from ..utils import elapsed, get_mp, distribute_work
+from ..instrument import span, write_trace, enable_memory, print_memory
 
-from ..targets import (Spectrum, Target, DistTargets)
+from ..memory import format_bytes
 
-from ..templates import load_dist_templates
-
-from ..results import write_zscan
-
-from ..zfind import zfind
+from ..zwarning import ZWarningMask as ZW
 
 
 def write_zbest(outfile, zbest, fibermap):
@@ -46,6 +46,8 @@ def write_zbest(outfile, zbest, fibermap):
         fibermap (Table): the fibermap from the original inputs.
 
     """
+    from astropy.io import fits
+
     zbest.meta['EXTNAME'] = 'ZBEST'
     fibermap.meta['EXTNAME'] = 'FIBERMAP'
 
@@ -57,6 +59,41 @@ def write_zbest(outfile, zbest, fibermap):
     return
 
 
+def desi_triage(fibermap):
+    """Find the targets of a fibermap which are not fit.
+
+    Sky fibers (OBJTYPE "SKY") are flagged with ZWarningMask.SKY, and fibers
+    without a target or broken (OBJTYPE "NON" or "BAD") with UNPLUGGED.  A
+    target is only flagged if all of its rows are.
+
+    Args:
+        fibermap (Table or array): the fibermap.
+
+    Returns:
+        dict: the ZWARN bits of the target IDs which should not be fit.
+
+    """
+    if "OBJTYPE" not in fibermap.dtype.names:
+        return dict()
+    objtype = np.asarray(fibermap["OBJTYPE"])
+    if objtype.dtype.kind == "S":
+        objtype = np.char.decode(objtype, "ascii")
+    objtype = np.char.strip(np.char.upper(objtype))
+    bits = np.zeros(len(objtype), dtype=np.int64)
+    bits[objtype == "SKY"] = ZW.SKY
+    bits[(objtype == "NON") | (objtype == "BAD")] = ZW.UNPLUGGED
+
+    flags = dict()
+    good = set()
+    for tid, b in zip(np.asarray(fibermap["TARGETID"]), bits):
+        tid = tid.item()
+        if b == 0:
+            good.add(tid)
+        else:
+            flags[tid] = flags.get(tid, 0) | int(b)
+    return { x : y for x, y in flags.items() if x not in good }
+
+
 class DistTargetsDESI(DistTargets):
     """Distributed targets for DESI.
 
@@ -80,10 +117,19 @@ class DistTargetsDESI(DistTargets):
         n_target (int): (optional) number of targets to consider in each file.
             Useful for debugging / testing.
         comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
+        triage (bool): if True, the targets flagged by desi_triage() are
+            kept in the "triage" dictionary and given no weight in the
+            distribution among processes, since they are not fit.
+        cost (TargetCost): (optional) the model of the cost of each target
+            used to distribute them.
     """
 
     def __init__(self, spectrafiles, coadd=True, targetids=None,
-        first_target=None, n_target=None, comm=None):
+        first_target=None, n_target=None, comm=None, triage=True, cost=None):
+        from astropy.io import fits
+        from astropy.table import Table
+        from desiutil.io import encode_table
+        from desispec.resolution import Resolution
 
         comm_size = 1
         comm_rank = 0
@@ -225,19 +271,42 @@ class DistTargetsDESI(DistTargets):
 
         self._keep_targets = list(sorted(self._alltargetids))
 
+        # The targets which are not fit, from the fibermap.
+
+        self.triage = dict()
+        if triage:
+            self.triage = desi_triage(np.hstack([ self._fmaps[x] \
+                for x in spectrafiles ]))
+
         # Now we have the metadata for all targets in all files.  Distribute
-        # the targets among process weighted by the amount of work to do for
-        # each target.  This weight is either "1" if we are going to use coadds
-        # or the number of spectra if we are using all the data.
-
-        tweights = None
-        if not coadd:
-            tweights = dict()
-            for t in self._keep_targets:
+        # the targets among process weighted by the estimated cost of each
+        # target (see TargetCost), from its number of spectra and pixels.
+        # The coadds have one spectrum per wavelength grid.  The targets
+        # which are not fit have no weight.
+
+        if cost is None:
+            cost = TargetCost()
+        tweights = dict()
+        for t in self._keep_targets:
+            if t in self.triage:
                 tweights[t] = 0
-                for sfile in spectrafiles:
-                    if t in self._target_specs[sfile]:
-                        tweights[t] += len(self._target_specs[sfile][t])
+                continue
+            grids = dict()
+            nspec = 0
+            npix = 0
+            for sfile in spectrafiles:
+                if t not in self._target_specs[sfile]:
+                    continue
+                nrow = len(self._target_specs[sfile][t])
+                for b in self._bands[sfile]:
+                    nwave = len(self._wave[sfile][b])
+                    grids[(nwave, self._wave[sfile][b][0])] = nwave
+                    nspec += nrow
+                    npix += nrow * nwave
+            if coadd:
+                nspec = len(grids)
+                npix = sum(grids.values())
+            tweights[t] = cost.cost(nspec, npix)
 
         self._proc_targets = distribute_work(comm_size,
             self._keep_targets, weights=tweights)
@@ -405,6 +474,177 @@ class DistTargetsDESI(DistTargets):
         return self._my_data
 
 
+def desi_targetids(spectrafiles, targetids=None, first_target=None,
+    n_target=None, comm=None):
+    """Return the target IDs selected from DESI spectra files.
+
+    Only the TARGETID column of the fibermaps is read, so this can be used to
+    split the targets into chunks before loading them with DistTargetsDESI.
+    The selection options have the same meaning as for DistTargetsDESI,
+    except that requested target IDs which are in none of the files are
+    ignored.
+
+    Args:
+        spectrafiles (str or list): a list of input files or pattern match
+            of files.
+        targetids (list): (optional) restrict the targets to this list.
+        first_target (int): (optional) integer offset of the first target to
+            consider in each file.
+        n_target (int): (optional) number of targets to consider in each file.
+        comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
+
+    Returns:
+        list: the sorted, unique target IDs on every process.
+
+    """
+    from astropy.io import fits
+
+    comm_rank = 0
+    if comm is not None:
+        comm_rank = comm.rank
+
+    if isinstance(spectrafiles, basestring):
+        import glob
+        spectrafiles = glob.glob(spectrafiles)
+
+    allids = None
+    if comm_rank == 0:
+        allids = set()
+        for sfile in spectrafiles:
+            with fits.open(sfile, memmap=True) as hdus:
+                fileids = np.array(hdus["FIBERMAP"].data["TARGETID"])
+            keep = fileids
+            if targetids is not None:
+                present = set(fileids)
+                keep = [ x for x in targetids if x in present ]
+            first = 0 if first_target is None else first_target
+            num = len(keep) if n_target is None else n_target
+            if first + num > len(keep):
+                raise RuntimeError("Requested first_target / n_target "
+                    " range is larger than the number of selected targets "
+                    " in the file")
+            allids.update(keep[first:first+num])
+        allids = sorted(allids)
+
+    if comm is not None:
+        allids = comm.bcast(allids, root=0)
+
+    return allids
+
+
+def desi_memory(spectrafiles, templates, ntarget, nproc=1, node_procs=None,
+    mp_procs=1, retention=None, coadd=True, comm=None):
+    """Predict the memory of a node for DESI spectra files.
+
+    The number of pixels of each target, the number of diagonals of the
+    resolution matrices and (without coadds) the number of spectra of each
+    target are read from the files.  See
+    redrock.memory.predict_memory() for the model.
+
+    Args:
+        spectrafiles (list): the input files.
+        templates (list): the Template objects.
+        ntarget (int): the number of targets processed at once.
+        nproc (int): the number of MPI processes, or 1.
+        node_procs (int): the number of MPI processes on one node.
+        mp_procs (int): the number of multiprocessing workers without MPI.
+        retention (ScanRetention): the scan data kept.
+        coadd (bool): whether the targets are fit using coadds.
+        comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
+
+    Returns:
+        dict: the prediction returned by predict_memory().
+
+    """
+    from astropy.io import fits
+    from ..memory import predict_memory
+
+    shape = None
+    if comm is None or comm.rank == 0:
+        npix = 0
+        ndiag = 1
+        nspec = 1
+        for sfile in spectrafiles:
+            filepix = 0
+            with fits.open(sfile, memmap=True) as hdus:
+                fmap = hdus["FIBERMAP"]
+                nrow = fmap.header["NAXIS2"]
+                nid = len(np.unique(fmap.data["TARGETID"]))
+                for hdu in hdus:
+                    name = hdu.header.get("EXTNAME", "")
+                    if name.endswith("_WAVELENGTH"):
+                        filepix += hdu.header["NAXIS1"]
+                    elif name.endswith("_RESOLUTION"):
+                        ndiag = max(ndiag, hdu.header["NAXIS2"])
+            if not coadd:
+                nspec = max(nspec, int(np.ceil(nrow / max(nid, 1))))
+            npix = max(npix, filepix)
+        shape = (npix, ndiag, nspec)
+    if comm is not None:
+        shape = comm.bcast(shape, root=0)
+
+    return predict_memory(ntarget, shape[0], templates, nspec=shape[2],
+        nproc=nproc, node_procs=node_procs, mp_procs=mp_procs,
+        retention=retention, ndiag=shape[1])
+
+
+def read_batch(batch, comm=None):
+    """Iterate over the jobs of a batch list.
+
+    Each non-empty line of the batch list describes one job with three
+    whitespace-separated fields:  a comma-separated list of input spectra
+    files, the output scan file and the output zbest file.  Either output
+    may be given as "-" to skip it.  Lines starting with "#" are ignored.
+
+    If batch is "-", jobs are read from standard input as they arrive, so
+    that a long-lived process can be fed like a queue.  The list is read on
+    the first process and each job is broadcast to the others.
+
+    Args:
+        batch (str): path to the batch list, or "-" for standard input.
+        comm (mpi4py.Comm): MPI communicator to use.
+
+    Yields:
+        tuple: (infiles, output, zbest) for each job.
+
+    """
+    rank = 0
+    if comm is not None:
+        rank = comm.rank
+
+    fh = None
+    if rank == 0:
+        if batch == "-":
+            fh = sys.stdin
+        else:
+            fh = open(batch, "r")
+
+    try:
+        while True:
+            job = None
+            if rank == 0:
+                for line in iter(fh.readline, ""):
+                    fields = line.split()
+                    if len(fields) == 0 or fields[0].startswith("#"):
+                        continue
+                    if len(fields) != 3:
+                        print("WARNING: skipping malformed batch line "
+                            "'{}'".format(line.strip()))
+                        sys.stdout.flush()
+                        continue
+                    outs = [ None if x == "-" else x for x in fields[1:] ]
+                    job = (fields[0].split(","), outs[0], outs[1])
+                    break
+            if comm is not None:
+                job = comm.bcast(job, root=0)
+            if job is None:
+                break
+            yield job
+    finally:
+        if (fh is not None) and (fh is not sys.stdin):
+            fh.close()
+
+
 def rrdesi(options=None, comm=None):
     """Estimate redshifts for DESI targets.
 
@@ -412,6 +652,11 @@ def rrdesi(options=None, comm=None):
     files and computes the redshifts.  The outputs are written to a redrock
     scan file and a DESI redshift catalog.
 
+    With --batch, many jobs are processed one after another by the same
+    processes (see read_batch()).  The templates are read once and the
+    rebinned templates are reused for every job whose wavelength grids have
+    already been seen, so the fixed cost of a job is only its own I/O.
+
     Args:
         options (list): optional list of commandline options to parse.
         comm (mpi4py.Comm): MPI communicator to use.
@@ -446,6 +691,68 @@ def rrdesi(options=None, comm=None):
     parser.add_argument("--allspec", default=False, action="store_true",
         required=False, help="use individual spectra instead of coadd")
 
+    parser.add_argument("--downsample", type=int, default=1,
+        required=False, help="bin the spectra and templates by this factor "
+        "for the coarse redshift scan; the minima are refined at full "
+        "resolution")
+
+    parser.add_argument("--zcoeff", type=str, default="full",
+        required=False, choices=["full", "window", "none"],
+        help="template coefficients to keep in the scan output: at every "
+        "redshift (full), only around the chi2 minima (window) or none")
+
+    parser.add_argument("--zcoeff-halfwidth", type=int, default=5,
+        required=False, help="for --zcoeff window, the number of redshifts "
+        "kept on each side of each minimum")
+
+    parser.add_argument("--scan-float32", default=False, action="store_true",
+        required=False, help="store the scan chi2, penalty and coefficients "
+        "as float32")
+
+    parser.add_argument("--normeq", default=False, action="store_true",
+        required=False, help="also store the sums of the chi2 normal "
+        "equations of every target in the scan output, so that it can be "
+        "updated with new spectra (requires --allspec)")
+
+    parser.add_argument("--update", type=str, default=None,
+        required=False, help="a scan output written with --normeq.  Only "
+        "the input spectra which are not included in it are scanned; the "
+        "input files must still contain all spectra of the targets, which "
+        "are used to refine the redshifts (implies --normeq)")
+
+    parser.add_argument("--priors", type=str, default=None,
+        required=False, help="a table of TARGETID and the optional columns "
+        "ZMIN, ZMAX and SPECTYPE (comma separated template types) which "
+        "restrict the redshift scan of each target.  By default, the "
+        "columns RR_ZMIN, RR_ZMAX and RR_SPECTYPE of the input fibermap "
+        "are used if present")
+
+    parser.add_argument("--zmin", type=str, default=None, action="append",
+        required=False, help="the smallest redshift scanned, either for all "
+        "templates or as TYPE:ZMIN for one template type (repeatable)")
+
+    parser.add_argument("--zmax", type=str, default=None, action="append",
+        required=False, help="the largest redshift scanned, either for all "
+        "templates or as TYPE:ZMAX for one template type (repeatable)")
+
+    parser.add_argument("--no-triage", default=False, action="store_true",
+        required=False, help="also fit the sky fibers and the fibers "
+        "without a target (OBJTYPE SKY, NON or BAD), which are otherwise "
+        "given a placeholder row with the SKY or UNPLUGGED zwarn bit")
+
+    parser.add_argument("--stream", type=int, default=None,
+        required=False, help="load, fit and write the targets in chunks of "
+        "at most this many targets per process, to bound the memory use")
+
+    parser.add_argument("--checkpoint", default=False, action="store_true",
+        required=False, help="save the results in chunks of targets to a "
+        "<output>.checkpoint directory as they are computed, and resume "
+        "from it if it exists.  It is removed once the outputs are written")
+
+    parser.add_argument("--checkpoint-size", type=int, default=64,
+        required=False, help="the number of targets per process in each "
+        "checkpoint chunk")
+
     parser.add_argument("--ncpu", type=int, default=None,
         required=False, help="DEPRECATED: the number of multiprocessing"
             " processes; use --mp instead")
@@ -454,10 +761,46 @@ def rrdesi(options=None, comm=None):
         required=False, help="if not using MPI, the number of multiprocessing"
             " processes to use (defaults to half of the hardware threads)")
 
+    parser.add_argument("--trace", type=str, default=None,
+        required=False, help="write the timing of the phases and the "
+        "counters of every process to this JSON file")
+
+    parser.add_argument("--trace-format", type=str, default="json",
+        required=False, choices=["json", "chrome"],
+        help="write a summary per phase and process (json) or every timed "
+        "span as a Chrome trace event (chrome)")
+
+    parser.add_argument("--memory", default=False, action="store_true",
+        required=False, help="record the memory of every process in each "
+        "phase and print the peak memory of each process at the end")
+
+    parser.add_argument("--predict-memory", default=False,
+        action="store_true", required=False, help="print the predicted "
+        "memory of a node for the inputs and options, and exit")
+
+    parser.add_argument("--threads", type=int, default=None,
+        required=False, help="the number of BLAS / OpenMP threads of each "
+        "process (default: OMP_NUM_THREADS if set, otherwise the available "
+        "CPUs divided between the processes)")
+
+    parser.add_argument("--pin", type=str, default=None, required=False,
+        choices=["none", "cores", "numa"],
+        help="pin the processes to their own cores or to NUMA domains")
+
+    parser.add_argument("--backend", type=str, default="processes",
+        required=False, choices=["processes", "threads"],
+        help="if not using MPI, run the multiprocessing workers as processes "
+        "or as threads sharing the target and template data")
+
     parser.add_argument("--debug", default=False, action="store_true",
         required=False, help="debug with ipython (only if communicator has a "
         "single process)")
 
+    parser.add_argument("--batch", type=str, default=None,
+        required=False, help="file listing the jobs to run, one per line as "
+        "'infile[,infile...] output zbest' (use '-' to skip an output), or "
+        "'-' to read jobs from stdin")
+
     parser.add_argument("infiles", nargs='*')
 
     args = None
@@ -476,6 +819,19 @@ def rrdesi(options=None, comm=None):
         comm_size = comm.size
         comm_rank = comm.rank
 
+    startup = process_age()
+    if comm_rank == 0 and startup is not None:
+        print("Startup (interpreter, imports and options): {:0.1f} seconds"\
+            .format(startup))
+        sys.stdout.flush()
+
+    from astropy.table import vstack
+    from ..templates import load_templates, load_dist_templates
+    from ..results import write_zscan, merge_zscan
+    from ..zscan import ScanRetention, NormalEquations
+    from ..zfind import zfind
+    from ..priors import RedshiftPriors, parse_zlimits
+
     # Check arguments- all processes have this, so just check on the first
     # process
 
@@ -487,7 +843,19 @@ def rrdesi(options=None, comm=None):
             if comm is not None:
                 comm.Abort()
 
-        if (args.output is None) and (args.zbest is None):
+        if args.batch is not None:
+            if (len(args.infiles) > 0) or (args.output is not None) \
+                or (args.zbest is not None) or args.predict_memory:
+                print("ERROR: --batch cannot be used with input files, "
+                    "--output, --zbest or --predict-memory")
+                sys.stdout.flush()
+                if comm is not None:
+                    comm.Abort()
+                else:
+                    sys.exit(1)
+
+        elif (args.output is None) and (args.zbest is None) \
+            and (not args.predict_memory):
             parser.print_help()
             print("ERROR: --output or --zbest required")
             sys.stdout.flush()
@@ -496,7 +864,7 @@ def rrdesi(options=None, comm=None):
             else:
                 sys.exit(1)
 
-        if len(args.infiles) == 0:
+        elif len(args.infiles) == 0:
             print("ERROR: must provide input files")
             sys.stdout.flush()
             if comm is not None:
@@ -504,6 +872,28 @@ def rrdesi(options=None, comm=None):
             else:
                 sys.exit(1)
 
+        if (args.normeq or (args.update is not None)) and \
+            ((not args.allspec) or (args.batch is not None) \
+            or (args.downsample > 1) or (args.stream is not None)):
+            print("ERROR: --normeq and --update require --allspec and "
+                "cannot be used with --batch, --downsample or --stream")
+            sys.stdout.flush()
+            if comm is not None:
+                comm.Abort()
+            else:
+                sys.exit(1)
+
+        if (args.normeq or (args.update is not None)) and \
+            ((args.priors is not None) or (args.zmin is not None) \
+            or (args.zmax is not None)):
+            print("ERROR: --normeq and --update cannot be used with "
+                "--priors, --zmin or --zmax")
+            sys.stdout.flush()
+            if comm is not None:
+                comm.Abort()
+            else:
+                sys.exit(1)
+
         if (args.targetids is not None) and ((args.mintarget is not None) \
             or (args.ntargets is not None)):
             print("ERROR: cannot select targets by both ID and range")
@@ -527,99 +917,312 @@ def rrdesi(options=None, comm=None):
     elif n_target is not None:
         first_target = 0
 
+    # Limit the BLAS / OpenMP threads so that the processes do not
+    # oversubscribe the CPUs.  An explicit OMP_NUM_THREADS is kept.
+    nthread = args.threads
+    if nthread is None and "OMP_NUM_THREADS" in os.environ:
+        nthread = int(os.environ["OMP_NUM_THREADS"])
+    configure_workers(threads=nthread, pin=args.pin)
+
     # Multiprocessing processes to use if MPI is disabled.
     mpprocs = 0
     if comm is None:
         mpprocs = get_mp(args.mp)
         print("Running with {} processes".format(mpprocs))
-        if "OMP_NUM_THREADS" in os.environ:
-            nthread = int(os.environ["OMP_NUM_THREADS"])
-            if nthread != 1:
-                print("WARNING:  {} multiprocesses running, each with "
-                    "{} threads ({} total)".format(mpprocs, nthread,
-                    mpprocs*nthread))
-                print("WARNING:  Please ensure this is <= the number of "
-                    "physical cores on the system")
-        else:
-            print("WARNING:  using multiprocessing, but the OMP_NUM_THREADS")
-            print("WARNING:  environment variable is not set- your system may")
-            print("WARNING:  be oversubscribed.")
-        sys.stdout.flush()
-    elif comm_rank == 0:
-        print("Running with {} processes".format(comm_size))
+        threads = set_threads(worker_threads(mpprocs))
+        print("Each process uses {} threads ({}), pinning: {}".format(
+            threads["threads"], threads["method"], args.pin or "none"))
         sys.stdout.flush()
-
-    try:
-        # Load and distribute the targets
+    else:
+        threads = mpi_threads(comm)
         if comm_rank == 0:
-            print("Loading targets...")
+            print("Running with {} processes".format(comm_size))
+            print("Rank 0 uses {}".format(thread_summary(threads)))
             sys.stdout.flush()
+    if threads["method"] == "environment" and comm_rank == 0:
+        print("WARNING:  threadpoolctl is not installed, the thread limits")
+        print("WARNING:  only apply to libraries loaded after this point.")
+        sys.stdout.flush()
 
-        start = elapsed(None, "", comm=comm)
+    # The scan data to keep in memory and write to the output.
 
-        # Load the targets.  If comm is None, then the target data will be
-        # stored in shared memory.
-        targets = DistTargetsDESI(args.infiles, coadd=(not args.allspec),
-            targetids=targetids, first_target=first_target, n_target=n_target,
-            comm=comm)
+    retention = ScanRetention(zcoeff=args.zcoeff, nminima=args.nminima,
+        halfwidth=args.zcoeff_halfwidth,
+        dtype=(np.float32 if args.scan_float32 else np.float64),
+        normeq=(args.normeq or (args.update is not None)))
 
-        # Get the dictionary of wavelength grids
-        dwave = targets.wavegrids()
+    # The redshift priors of the targets.  Without a priors table, the
+    # fibermap of each input is searched for prior columns.
 
-        stop = elapsed(start, "Read and distribution of {} targets"\
-            .format(len(targets.all_target_ids)), comm=comm)
+    zmin = parse_zlimits(args.zmin)
+    zmax = parse_zlimits(args.zmax)
+    priors = None
+    if comm_rank == 0:
+        if args.priors is not None:
+            priors = RedshiftPriors.read(args.priors, zmin=zmin, zmax=zmax)
+        elif len(zmin) + len(zmax) > 0:
+            priors = RedshiftPriors(zmin=zmin, zmax=zmax)
+    if comm is not None:
+        priors = comm.bcast(priors, root=0)
 
-        # Read the template data
+    if args.memory:
+        enable_memory()
 
-        dtemplates = load_dist_templates(dwave, templates=args.templates,
-            comm=comm, mp_procs=mpprocs)
+    if args.predict_memory:
+        node_procs = comm_size
+        if comm is not None:
+            from mpi4py import MPI
+            local = comm.Split_type(MPI.COMM_TYPE_SHARED)
+            node_procs = local.size
+            local.Free()
+        templates = load_templates(templates=args.templates, comm=comm)
+        ntarget = len(desi_targetids(args.infiles, targetids=targetids,
+            first_target=first_target, n_target=n_target, comm=comm))
+        if args.stream is not None:
+            ntarget = min(ntarget, args.stream * comm_size)
+        pred = desi_memory(args.infiles, templates, ntarget, nproc=comm_size,
+            node_procs=node_procs, mp_procs=mpprocs, retention=retention,
+            coadd=(not args.allspec), comm=comm)
+        if comm_rank == 0:
+            print("Predicted memory for {} targets at once:".format(ntarget))
+            for key in ["baseline", "targets", "templates", "results",
+                "process", "root", "node"]:
+                print("  {:<10s} {}".format(key, format_bytes(pred[key])))
+            sys.stdout.flush()
+        return
 
-        # Compute the redshifts, including both the coarse scan and the
-        # refinement.  This function only returns data on the rank 0 process.
+    if args.batch is None:
+        jobs = [ (args.infiles, args.output, args.zbest) ]
+    else:
+        jobs = read_batch(args.batch, comm=comm)
+
+    # The templates are read once, and rebinned again only when a job
+    # brings wavelength grids that were not seen before.
+
+    templates = None
+    dtemplates = None
+    dwave_all = dict()
+
+    for infiles, output, zbestfile in jobs:
+        targets = None
+        scandata = None
+        zfit = None
+        try:
+            if templates is None:
+                start = elapsed(None, "", comm=comm)
+                templates = load_templates(templates=args.templates,
+                    comm=comm)
+                stop = elapsed(start, "Read and broadcast of {} templates"\
+                    .format(len(templates)), comm=comm)
+
+            checkpoint = None
+            if args.checkpoint:
+                checkpoint = "{}.checkpoint".format(output if output \
+                    is not None else zbestfile)
+
+            # In streaming mode, the targets are loaded, fit and written in
+            # chunks of at most --stream targets per process.
+
+            if args.stream is None:
+                chunks = [ dict(targetids=targetids,
+                    first_target=first_target, n_target=n_target) ]
+            else:
+                allids = desi_targetids(infiles, targetids=targetids,
+                    first_target=first_target, n_target=n_target, comm=comm)
+                nchunk = args.stream * comm_size
+                chunks = [ dict(targetids=allids[x:x+nchunk]) \
+                    for x in range(0, len(allids), nchunk) ]
+                if len(chunks) == 0:
+                    raise RuntimeError("no targets selected in {}".format(
+                        ",".join(infiles)))
+                if comm_rank == 0:
+                    print("Streaming {} targets in {} chunks".format(
+                        len(allids), len(chunks)))
+                    sys.stdout.flush()
 
-        start = elapsed(None, "", comm=comm)
+            zfits = list()
+            fibermaps = list()
+            parts = list()
 
-        scandata, zfit = zfind(targets, dtemplates, mpprocs,
-            nminima=args.nminima)
+            for ichunk, selection in enumerate(chunks):
+                # Load and distribute the targets
+                if comm_rank == 0:
+                    print("Loading targets from {}...".format(
+                        ",".join(infiles)))
+                    sys.stdout.flush()
+
+                start = elapsed(None, "", comm=comm)
+
+                # Load the targets.  If comm is None, then the target data
+                # will be stored in shared memory.
+                with span("load_targets"):
+                    targets = DistTargetsDESI(infiles,
+                        coadd=(not args.allspec), comm=comm,
+                        triage=(not args.no_triage), **selection)
+
+                # Get the dictionary of wavelength grids, binned for the
+                # coarse scan if requested.
+                coarse = None
+                if args.downsample > 1:
+                    with span("downsample"):
+                        coarse = downsample_targets(targets, args.downsample)
+                    dwave = coarse.wavegrids()
+                else:
+                    dwave = targets.wavegrids()
+
+                stop = elapsed(start, "Read and distribution of {} targets"\
+                    .format(len(targets.all_target_ids)), comm=comm)
+
+                # Rebin the templates.  The wavelength grids are global, so
+                # all processes take the same branch.
+
+                if (dtemplates is None) \
+                    or (not set(dwave.keys()).issubset(dwave_all.keys())):
+                    dtemplates = None
+                    dwave_all.update(dwave)
+                    dtemplates = load_dist_templates(dwave_all,
+                        templates=templates, comm=comm, mp_procs=mpprocs,
+                        backend=args.backend)
+
+                # The priors of the fibermap cannot be combined with the
+                # normal equations, which need the scan at every redshift.
+
+                tpriors = priors
+                if args.priors is None:
+                    fpriors = RedshiftPriors.from_table(targets.fibermap,
+                        prefix="RR_", zmin=zmin, zmax=zmax)
+                    if len(fpriors) > 0:
+                        if retention.normeq:
+                            if comm_rank == 0:
+                                print("WARNING: ignoring the RR_ZMIN, RR_ZMAX "
+                                    "and RR_SPECTYPE priors of the fibermap "
+                                    "with --normeq and --update")
+                                sys.stdout.flush()
+                        else:
+                            tpriors = fpriors
+
+                # Read the stored normal equations of our targets to update.
+
+                normeq = None
+                if args.update is not None:
+                    with span("read_normeq"):
+                        normeq = NormalEquations.read(args.update,
+                            targets.local_target_ids(), dtemplates)
+
+                # Compute the redshifts, including both the coarse scan and
+                # the refinement.  The best fit table is only returned on the
+                # rank 0 process, and each process keeps the scan data of its
+                # own targets.
+
+                start = elapsed(None, "", comm=comm)
+
+                scandata, zfit = zfind(targets, dtemplates, mpprocs,
+                    nminima=args.nminima, gather_scan=False,
+                    retention=retention, checkpoint=checkpoint,
+                    checkpoint_size=args.checkpoint_size,
+                    backend=args.backend, coarse=coarse, normeq=normeq,
+                    priors=tpriors, flags=targets.triage)
+
+                stop = elapsed(start, "Computing redshifts took", comm=comm)
+
+                # Write the scan data.  When streaming, each chunk goes to a
+                # part file which is merged at the end.
+
+                if output is not None:
+                    start = elapsed(None, "", comm=comm)
+                    scanfile = output
+                    if len(chunks) > 1:
+                        scanfile = "{}.stream{}".format(output, ichunk)
+                        parts.append(scanfile)
+                    with span("write_zscan"):
+                        write_zscan(scanfile, scandata, zfit, clobber=True,
+                            comm=comm)
+                    stop = elapsed(start, "Writing zscan data took",
+                        comm=comm)
+
+                if comm_rank == 0:
+                    zfits.append(zfit)
+                    fibermaps.append(targets.fibermap)
+
+                del targets
+                del coarse
+                del normeq
+                del scandata
+                del zfit
+                targets = None
+                scandata = None
+                zfit = None
+                gc.collect()
+
+            fibermap = None
+            if comm_rank == 0:
+                if len(chunks) == 1:
+                    zfit = zfits[0]
+                    fibermap = fibermaps[0]
+                else:
+                    zfit = vstack(zfits)
+                    fibermap = vstack(fibermaps)
+            del zfits
+            del fibermaps
+
+            if (output is not None) and (len(parts) > 0):
+                start = elapsed(None, "", comm=comm)
+                if comm_rank == 0:
+                    with span("merge_zscan"):
+                        merge_zscan(output, parts, zfit, clobber=True)
+                stop = elapsed(start, "Merging zscan data took", comm=comm)
 
-        stop = elapsed(start, "Computing redshifts took", comm=comm)
+            if zbestfile is not None:
+                start = elapsed(None, "", comm=comm)
+                if comm_rank == 0:
+                    zbest = zfit[zfit['znum'] == 0]
 
-        # Write the outputs
+                    # Remove extra columns not needed for zbest
+                    zbest.remove_columns(['zz', 'zzchi2', 'znum'])
 
-        if args.output is not None:
-            start = elapsed(None, "", comm=comm)
-            if comm_rank == 0:
-                write_zscan(args.output, scandata, zfit, clobber=True)
-            stop = elapsed(start, "Writing zscan data took", comm=comm)
+                    # Change to upper case like DESI
+                    for colname in zbest.colnames:
+                        if colname.islower():
+                            zbest.rename_column(colname, colname.upper())
 
-        if args.zbest:
-            start = elapsed(None, "", comm=comm)
-            if comm_rank == 0:
-                zbest = zfit[zfit['znum'] == 0]
+                    with span("write_zbest"):
+                        write_zbest(zbestfile, zbest, fibermap)
 
-                # Remove extra columns not needed for zbest
-                zbest.remove_columns(['zz', 'zzchi2', 'znum'])
+                stop = elapsed(start, "Writing zbest data took", comm=comm)
 
-                # Change to upper case like DESI
-                for colname in zbest.colnames:
-                    if colname.islower():
-                        zbest.rename_column(colname, colname.upper())
+            # The outputs are complete, so the checkpoint is not needed.
 
-                write_zbest(args.zbest, zbest, targets.fibermap)
+            if comm is not None:
+                comm.barrier()
+            if (checkpoint is not None) and (comm_rank == 0):
+                shutil.rmtree(checkpoint, ignore_errors=True)
+
+        except:
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            lines = traceback.format_exception(exc_type, exc_value,
+                exc_traceback)
+            lines = [ "Proc {}: {}".format(comm_rank, x) for x in lines ]
+            print("".join(lines))
+            sys.stdout.flush()
+            if comm is not None:
+                comm.Abort()
 
-            stop = elapsed(start, "Writing zbest data took", comm=comm)
+        # Release the per-job state before starting the next one, so that
+        # the memory footprint of a batch stays that of its largest job.
 
-    except:
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-        lines = [ "Proc {}: {}".format(comm_rank, x) for x in lines ]
-        print("".join(lines))
-        sys.stdout.flush()
-        if comm is not None:
-            comm.Abort()
+        del targets
+        del scandata
+        del zfit
+        gc.collect()
 
     global_stop = elapsed(global_start, "Total run time", comm=comm)
 
+    if args.memory:
+        print_memory(comm=comm)
+
+    if args.trace is not None:
+        write_trace(args.trace, comm=comm, format=args.trace_format)
+
     if args.debug:
         import IPython
         IPython.embed()
@@ -114,6 +114,12 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3):
     TODO:
         if there are fewer than nminima minima, consider padding.
 
+    Redshifts with a non-finite chi^2 (for example those excluded by
+    redrock.priors.RedshiftPriors) are not refined, and the refinement of a
+    minimum next to them is limited to the evaluated side and flagged with
+    Z_FITLIMIT.  If no redshift was evaluated, the Table has no rows (and
+    already has the "npixels" column added by the callers).
+
     Args:
         zchi2 (array): chi^2 values for each redshift.
         redshifts (array): the redshift values.
@@ -130,6 +136,15 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3):
 
     nbasis = template.nbasis
 
+    from astropy.table import Table
+    finite = np.isfinite(zchi2)
+    if not np.any(finite):
+        return Table([ np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64),
+            np.zeros(0), np.zeros((0, 15)), np.zeros((0, 15)),
+            np.zeros((0, nbasis)), np.zeros(0, dtype=np.int64) ],
+            names=('z', 'zerr', 'zwarn', 'chi2', 'zz', 'zzchi2', 'coeff',
+            'npixels'))
+
     # Build dictionary of wavelength grids
     dwave = dict()
     for s in spectra:
@@ -138,11 +153,26 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3):
 
     (weights, flux, wflux) = spectral_data(spectra)
 
+    # Only rebin the template where it feeds pixels with nonzero weight.
+    pixels = dict()
+    for s in spectra:
+        lo, hi = s.feed_range
+        if hi <= lo:
+            continue
+        if s.wavehash in pixels:
+            lo = min(lo, pixels[s.wavehash][0])
+            hi = max(hi, pixels[s.wavehash][1])
+        pixels[s.wavehash] = (lo, hi)
+    for hs in dwave:
+        pixels.setdefault(hs, (0, 0))
+
     results = list()
 
     for imin in find_minima(zchi2):
         if len(results) == nminima:
             break
+        if not finite[imin]:
+            continue
 
         #- Skip this minimum if it is within constants.max_velo_diff km/s of a
         # previous one dv is in km/s
@@ -154,6 +184,13 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3):
         #- Sample more finely around the minimum
         ilo = max(0, imin-1)
         ihi = min(imin+1, len(zchi2)-1)
+        edge = False
+        if not finite[ilo]:
+            ilo = imin
+            edge = True
+        if not finite[ihi]:
+            ihi = imin
+            edge = True
         zz = np.linspace(redshifts[ilo], redshifts[ihi], 15)
         nz = len(zz)
 
@@ -161,7 +198,7 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3):
         zzcoeff = np.zeros((nz, nbasis), dtype=np.float64)
 
         for i, z in enumerate(zz):
-            binned = rebin_template(template, z, dwave)
+            binned = rebin_template(template, z, dwave, pixels=pixels)
             zzchi2[i], zzcoeff[i] = calc_zchi2_one(spectra, weights, flux,
                 wflux, binned)
 
@@ -170,7 +207,7 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3):
         zmin, sigma, chi2min, zwarn = minfit(zz[i-1:i+2], zzchi2[i-1:i+2])
 
         try:
-            binned = rebin_template(template, zmin, dwave)
+            binned = rebin_template(template, zmin, dwave, pixels=pixels)
             coeff = calc_zchi2_one(spectra, weights, flux, wflux,
                 binned)[1]
         except ValueError as err:
@@ -187,6 +224,8 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3):
         zerr = sigma
 
         #- Initial minimum or best fit too close to edge of redshift range
+        if edge:
+            zwarn |= ZW.Z_FITLIMIT
         if zbest < redshifts[1] or zbest > redshifts[-2]:
             zwarn |= ZW.Z_FITLIMIT
         if zmin < redshifts[1] or zmin > redshifts[-2]:
@@ -215,7 +254,6 @@ def fitz(zchi2, redshifts, spectra, template, nminima=3):
     results = [results[i] for i in ii]
 
     #- Convert list of dicts -> Table
-    from astropy.table import Table
     results = Table(results)
 
     assert len(results) > 0
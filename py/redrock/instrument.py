@@ -0,0 +1,324 @@
+"""
+redrock.instrument
+==================
+
+Lightweight timing and counter instrumentation.
+
+Each process records named spans (wall clock intervals of the phases of a
+run) and counters (for example the number of chi2 evaluations or the bytes
+passed between processes) in memory.  Recording does not communicate, so the
+processes are not synchronized at the timing points.  The records of all
+processes are gathered once at the end of a run and written as a JSON
+summary or as a Chrome trace (viewable in chrome://tracing or Perfetto).
+
+Optionally, the spans also record the memory of the process (see
+enable_memory()).  The growth of the peak memory during a span attributes
+the high-water mark to a phase.  Gauges keep the largest value reported for
+a quantity, such as the estimated bytes held by the targets.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+import time
+import json
+import socket
+import threading
+
+from .memory import rss, peak_rss, format_bytes
+
+
+class Recorder(object):
+    """The spans and counters recorded by one process.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.memory = False
+        self.reset()
+
+    def reset(self):
+        """Discard all records."""
+        with self._lock:
+            self.spans = list()
+            self.counters = dict()
+            self.gauges = dict()
+        return
+
+    def add_span(self, name, start, stop, args=None, mem=None):
+        """Record a span of name from start to stop (seconds since epoch).
+
+        mem is None or a tuple of the memory at the end of the span and the
+        peak memory at its start and end, in bytes.
+
+        """
+        rec = (name, start, stop, threading.current_thread().ident, args, mem)
+        with self._lock:
+            self.spans.append(rec)
+        return
+
+    def count(self, name, n=1):
+        """Increment the counter name by n."""
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+        return
+
+    def gauge(self, name, value):
+        """Keep the largest value reported for name."""
+        with self._lock:
+            self.gauges[name] = max(self.gauges.get(name, value), value)
+        return
+
+    def records(self):
+        """Return a copy of the records which can be pickled."""
+        with self._lock:
+            rec = dict(host=socket.gethostname(), pid=os.getpid(),
+                spans=list(self.spans), counters=dict(self.counters),
+                gauges=dict(self.gauges))
+        if self.memory:
+            rec["peak_rss"] = peak_rss()
+            rec["worker_peak_rss"] = peak_rss(children=True)
+        return rec
+
+
+_recorder = Recorder()
+
+
+def recorder():
+    """Return the Recorder of this process."""
+    return _recorder
+
+
+class span(object):
+    """Record the time spent in a phase.
+
+    The span starts when it is created and is recorded when stop() is called,
+    or at the end of the with block if used as a context manager.
+
+    Args:
+        name (str): the name of the phase, for example "scan".
+        args: optional extra information, for example the template type.
+
+    """
+    def __init__(self, name, **args):
+        self.name = name
+        self.args = args
+        self.seconds = None
+        self._peak = None
+        if _recorder.memory:
+            self._peak = peak_rss()
+        self.start = time.time()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+    def stop(self):
+        """Record the span and return its duration in seconds."""
+        if self.seconds is None:
+            stop = time.time()
+            self.seconds = stop - self.start
+            mem = None
+            if self._peak is not None:
+                mem = (rss(), self._peak, peak_rss())
+            _recorder.add_span(self.name, self.start, stop,
+                (self.args if len(self.args) > 0 else None), mem)
+        return self.seconds
+
+
+def count(name, n=1):
+    """Increment the counter name of this process by n."""
+    _recorder.count(name, n)
+    return
+
+
+def gauge(name, value):
+    """Keep the largest value reported for name in this process."""
+    _recorder.gauge(name, value)
+    return
+
+
+def enable_memory(enable=True):
+    """Record the memory of the process at every span.
+
+    Returns:
+        bool: whether memory is recorded, which requires the peak memory to
+            be available on this system.
+
+    """
+    _recorder.memory = bool(enable) and (peak_rss() is not None)
+    return _recorder.memory
+
+
+def memory_enabled():
+    """Return True if the spans record the memory."""
+    return _recorder.memory
+
+
+def summarize(records):
+    """Summarize the spans of one process by name.
+
+    Args:
+        records (dict): the output of Recorder.records().
+
+    Returns:
+        dict: for each span name, a dictionary with the number of "calls",
+            the "total" and the "max" seconds.  If the memory was recorded,
+            "rss" is the largest memory at the end of a span and
+            "peak_growth" the increase of the peak memory during the spans,
+            in bytes.
+
+    """
+    out = dict()
+    for name, start, stop, tid, args, mem in records["spans"]:
+        sec = stop - start
+        if name not in out:
+            out[name] = dict(calls=0, total=0.0, max=0.0)
+        out[name]["calls"] += 1
+        out[name]["total"] += sec
+        out[name]["max"] = max(out[name]["max"], sec)
+        if mem is not None:
+            out[name]["rss"] = max(out[name].get("rss", 0), mem[0] or 0)
+            out[name]["peak_growth"] = out[name].get("peak_growth", 0) \
+                + (mem[2] - mem[1])
+    return out
+
+
+def _json_summary(allrecords):
+    ranks = list()
+    phases = dict()
+    counters = dict()
+    for rank, rec in enumerate(allrecords):
+        summ = summarize(rec)
+        ranks.append(dict(rank=rank, host=rec["host"], pid=rec["pid"],
+            spans=summ, counters=rec["counters"], gauges=rec["gauges"]))
+        if "peak_rss" in rec:
+            ranks[-1]["peak_rss"] = rec["peak_rss"]
+            ranks[-1]["worker_peak_rss"] = rec["worker_peak_rss"]
+        for name, val in summ.items():
+            phases.setdefault(name, list()).append(val["total"])
+        for name, val in rec["counters"].items():
+            counters[name] = counters.get(name, 0) + val
+    # The spread of a phase over the processes shows load imbalance.
+    balance = dict()
+    for name, tot in phases.items():
+        balance[name] = dict(nproc=len(tot), min=min(tot), max=max(tot),
+            mean=sum(tot) / len(tot))
+    return dict(nproc=len(allrecords), phases=balance, counters=counters,
+        ranks=ranks)
+
+
+def _chrome_trace(allrecords):
+    origin = None
+    for rec in allrecords:
+        for sp in rec["spans"]:
+            if origin is None or sp[1] < origin:
+                origin = sp[1]
+    if origin is None:
+        origin = time.time()
+    events = list()
+    for rank, rec in enumerate(allrecords):
+        events.append(dict(name="process_name", ph="M", pid=rank, tid=0,
+            args=dict(name="rank {} ({})".format(rank, rec["host"]))))
+        tids = dict()
+        end = origin
+        for name, start, stop, tid, args, mem in rec["spans"]:
+            if tid not in tids:
+                tids[tid] = len(tids)
+            ev = dict(name=name, ph="X", pid=rank, tid=tids[tid],
+                ts=1.0e6 * (start - origin), dur=1.0e6 * (stop - start))
+            if args is not None:
+                ev["args"] = args
+            events.append(ev)
+            if mem is not None and mem[0] is not None:
+                events.append(dict(name="rss", ph="C", pid=rank, tid=0,
+                    ts=1.0e6 * (stop - origin), args=dict(rss=mem[0])))
+            end = max(end, stop)
+        for name, val in sorted(rec["counters"].items()):
+            events.append(dict(name=name, ph="C", pid=rank, tid=0,
+                ts=1.0e6 * (end - origin), args={name: val}))
+    return dict(traceEvents=events, displayTimeUnit="ms")
+
+
+def write_trace(filename, comm=None, format="json"):
+    """Gather the records of all processes and write them to a file.
+
+    This must be called by all processes of the communicator.
+
+    Args:
+        filename (str): the output file.
+        comm (mpi4py.Comm): (optional) the communicator.
+        format (str): "json" writes the totals of each phase per process,
+            their spread over the processes and the summed counters.
+            "chrome" writes every span as an event of a Chrome trace.
+
+    """
+    if format not in ("json", "chrome"):
+        raise ValueError("unknown trace format \"{}\"".format(format))
+    records = _recorder.records()
+    if comm is None:
+        allrecords = [ records ]
+    else:
+        allrecords = comm.gather(records, root=0)
+    if comm is not None and comm.rank != 0:
+        return
+
+    if format == "chrome":
+        out = _chrome_trace(allrecords)
+    else:
+        out = _json_summary(allrecords)
+
+    tmp = "{}.tmp".format(filename)
+    with open(tmp, "w") as f:
+        json.dump(out, f, indent=1)
+    os.rename(tmp, filename)
+    print("Wrote {} trace of {} processes to {}".format(format,
+        len(allrecords), filename))
+    sys.stdout.flush()
+    return
+
+
+def print_memory(comm=None):
+    """Print the peak memory of every process and where it was reached.
+
+    For each process this prints the peak memory of the process and of its
+    largest worker, the phase during which the peak memory grew most, and
+    the gauges (for example the estimated bytes of the targets).  This must
+    be called by all processes of the communicator.
+
+    Args:
+        comm (mpi4py.Comm): (optional) the communicator.
+
+    """
+    records = _recorder.records()
+    summ = summarize(records)
+    phase = None
+    growth = [ (val.get("peak_growth", 0), name) for name, val \
+        in summ.items() ]
+    if len(growth) > 0 and max(growth)[0] > 0:
+        phase = max(growth)[1]
+    mine = (records["host"], records.get("peak_rss"),
+        records.get("worker_peak_rss"), phase, records["gauges"])
+    if comm is None:
+        allmem = [ mine ]
+    else:
+        allmem = comm.gather(mine, root=0)
+        if comm.rank != 0:
+            return
+
+    print("Memory high-water marks:")
+    for rank, (host, peak, wpeak, phase, gauges) in enumerate(allmem):
+        line = "  Proc {} ({}): peak {}".format(rank, host, format_bytes(peak))
+        if wpeak:
+            line += ", workers {}".format(format_bytes(wpeak))
+        if phase is not None:
+            line += ", grew most in {}".format(phase)
+        if len(gauges) > 0:
+            line += "; " + ", ".join([ "{} {}".format(k, format_bytes(v)) \
+                for k, v in sorted(gauges.items()) ])
+        print(line)
+    sys.stdout.flush()
+    return
@@ -0,0 +1,183 @@
+"""
+redrock.memory
+==============
+
+Memory used by the processes and by the main data structures, and a simple
+model to predict the memory needed by a run.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import os
+import sys
+
+import numpy as np
+
+
+def rss():
+    """Return the current resident memory of this process in bytes.
+
+    Returns None if this is not available on the system.
+
+    """
+    try:
+        with open("/proc/self/statm", "r") as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf("SC_PAGE_SIZE")
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+def peak_rss(children=False):
+    """Return the peak resident memory in bytes.
+
+    Args:
+        children (bool): if True, return the largest peak of the child
+            processes which have finished (for example the multiprocessing
+            workers), rather than that of this process.
+
+    Returns:
+        int: the peak memory, or None if this is not available.
+
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    peak = resource.getrusage(who).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    if sys.platform != "darwin":
+        peak *= 1024
+    return peak
+
+
+def nbytes(obj):
+    """Estimate the bytes held by the arrays in an object.
+
+    This follows lists, tuples, dictionaries and the attributes of objects
+    (for example Target, Spectrum, DistTemplate and the scan results) and
+    adds the size of every numpy array and sparse matrix found.  Arrays
+    which are referenced more than once are only counted once.
+
+    Args:
+        obj: the object.
+
+    Returns:
+        int: the number of bytes.
+
+    """
+    seen = set()
+    total = 0
+    stack = [ obj ]
+    while len(stack) > 0:
+        x = stack.pop()
+        if id(x) in seen:
+            continue
+        seen.add(id(x))
+        if isinstance(x, np.ndarray):
+            total += x.nbytes
+        elif isinstance(x, dict):
+            stack.extend(x.values())
+        elif isinstance(x, (list, tuple, set)):
+            stack.extend(x)
+        elif hasattr(x, "__dict__"):
+            stack.extend(vars(x).values())
+    return total
+
+
+def format_bytes(n):
+    """Format a number of bytes for printing."""
+    if n is None:
+        return "unknown"
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n) < 1024.0:
+            return "{:0.1f} {}".format(n, unit)
+        n /= 1024.0
+    return "{:0.1f} TB".format(n)
+
+
+def predict_memory(ntarget, npix, templates, nspec=1, nproc=1,
+    node_procs=None, mp_procs=1, retention=None, ndiag=11, nminima=3,
+    baseline=250*2**20):
+    """Predict the memory of one node.
+
+    The model counts the spectra of the targets (wavelength, flux, inverse
+    variance and the resolution matrix in band diagonal and CSR formats), the
+    rebinned templates, the retained scan data and the best fit tables.  With
+    MPI, every process holds its share of the targets and two slices of the
+    rebinned templates while they are passed around, and rank 0 also holds
+    the spectra of one band while they are read and broadcast.  Without MPI,
+    the parent holds all the data and the workers share it.
+
+    Args:
+        ntarget (int): the number of targets in the input.
+        npix (int): the number of spectral pixels of one spectrum, summed
+            over the bands (wavelength grids).
+        templates (list): for each template, either a Template object or a
+            tuple (nz, nbasis) of the number of redshifts and basis vectors.
+        nspec (int): the number of spectra of each target in each band (1 for
+            coadds).
+        nproc (int): the number of MPI processes, or 1 if not using MPI.
+        node_procs (int): the number of MPI processes on the node (default
+            nproc).
+        mp_procs (int): the number of multiprocessing workers if not using
+            MPI.
+        retention (ScanRetention): the scan data kept, see
+            ScanRetention.nbytes().
+        ndiag (int): the number of diagonals of the resolution matrices.
+        nminima (int): the number of minima kept in the best fit tables.
+        baseline (int): the memory of a process before reading any data
+            (interpreter, libraries and the template files).
+
+    Returns:
+        dict: the predicted bytes of "targets", "templates", "results" and
+            "baseline" for one process, the extra memory of the "root"
+            process, the "process" total and the "node" total.
+
+    """
+    if retention is None:
+        from .zscan import ScanRetention
+        retention = ScanRetention(nminima=nminima)
+    if node_procs is None:
+        node_procs = nproc
+
+    shape = list()
+    for t in templates:
+        if isinstance(t, tuple):
+            shape.append(t)
+        else:
+            shape.append((len(t.redshifts), t.nbasis))
+
+    # Per spectral pixel: wave, flux and ivar, the band diagonal matrix and
+    # the CSR matrix (values and column indices).
+    pixbytes = 8 * 3 + 8 * ndiag + 12 * ndiag
+
+    ntlocal = int(np.ceil(ntarget / nproc))
+    targets = ntlocal * nspec * npix * pixbytes
+
+    # The rebinned templates are stored for every wavelength grid.
+    tbytes = sum([ nz * nb * npix * 8 for nz, nb in shape ])
+    if nproc > 1:
+        templates = 2 * int(np.ceil(tbytes / nproc))
+    else:
+        templates = tbytes
+
+    results = ntlocal * sum([ retention.nbytes(nz, nb) for nz, nb in shape ])
+    fits = ntarget * len(shape) * nminima * (200 + 8 * max([ nb for nz, nb \
+        in shape ] + [0,]))
+
+    root = fits
+    if nproc > 1:
+        # One band of the input is read and broadcast at a time.
+        root += ntarget * nspec * npix * 8 * (2 + ndiag) // 3
+
+    process = baseline + targets + templates + results
+    node = node_procs * process + root
+    if nproc == 1:
+        # Each worker has its own copy of its targets' scan results while it
+        # runs, on top of the interpreter.
+        node += mp_procs * baseline // 2 + results
+
+    return dict(targets=targets, templates=templates, results=results,
+        baseline=baseline, root=root, process=process, node=node)
@@ -0,0 +1,218 @@
+"""
+redrock.priors
+==============
+
+Restrictions of the redshift scan of each target.
+
+Targets with a prior knowledge of their redshift (for example a photometric
+redshift) or of their class only need to be fit with some templates, over a
+part of the redshift grid of each template.  The grid points outside of the
+allowed region are not evaluated.
+"""
+
+from __future__ import absolute_import, division, print_function
+
+import numpy as np
+
+
+def parse_zlimits(values):
+    """Parse command line redshift limits.
+
+    Args:
+        values (list): strings "VALUE", which applies to all template types,
+            or "TYPE:VALUE", which applies to one template type.
+
+    Returns:
+        dict: the limit for each template type, with the key None for the
+            limit of all types.
+
+    """
+    limits = dict()
+    if values is None:
+        return limits
+    for val in values:
+        if val.count(":") > 0:
+            spectype, z = val.rsplit(":", 1)
+            limits[spectype.upper()] = float(z)
+        else:
+            limits[None] = float(val)
+    return limits
+
+
+class RedshiftPriors(object):
+    """The allowed redshifts and template types of targets.
+
+    A target is fit with a template if its type is allowed, and only at the
+    grid points of the template inside the redshift window of the target
+    and of the template type.  The nearest grid point outside the window is
+    also included on each side, so that minima at the edges of the window
+    can be refined.
+
+    Args:
+        zmin (dict): the smallest redshift for each template type, or for
+            all types with the key None (see parse_zlimits()).
+        zmax (dict): the largest redshift, as zmin.
+        targets (dict): for each target ID, a dictionary with the optional
+            keys "zmin" and "zmax" (the redshift window) and "spectypes"
+            (the list of allowed template types).
+
+    """
+    def __init__(self, zmin=None, zmax=None, targets=None):
+        self.zmin = dict() if zmin is None else dict(zmin)
+        self.zmax = dict() if zmax is None else dict(zmax)
+        self.targets = dict() if targets is None else targets
+
+    def __len__(self):
+        return len(self.targets)
+
+    def subset(self, targetids):
+        """Return the priors restricted to some targets."""
+        return RedshiftPriors(self.zmin, self.zmax, { x : self.targets[x] \
+            for x in targetids if x in self.targets })
+
+    def _type_limit(self, limits, template):
+        for key in (template.full_type.upper(),
+            template.template_type.upper(), None):
+            if key in limits:
+                return limits[key]
+        return None
+
+    def allowed(self, targetid, template):
+        """Return True if the target may be fit with this template."""
+        spectypes = self.targets.get(targetid, dict()).get("spectypes")
+        if spectypes is None or len(spectypes) == 0:
+            return True
+        spectypes = [ x.upper() for x in spectypes ]
+        return (template.template_type.upper() in spectypes) \
+            or (template.full_type.upper() in spectypes)
+
+    def window(self, targetid, template):
+        """Return the redshift window of a target and template.
+
+        Returns:
+            tuple: (zmin, zmax), either of which is None if unbounded.
+
+        """
+        prior = self.targets.get(targetid, dict())
+        lo = [ x for x in (self._type_limit(self.zmin, template),
+            prior.get("zmin")) if x is not None ]
+        hi = [ x for x in (self._type_limit(self.zmax, template),
+            prior.get("zmax")) if x is not None ]
+        return (max(lo) if len(lo) > 0 else None,
+            min(hi) if len(hi) > 0 else None)
+
+    def mask(self, targetid, template):
+        """Return the grid points of a template to evaluate for a target.
+
+        Returns:
+            array: boolean array for each redshift of the template, or None
+                if all redshifts are allowed.
+
+        """
+        redshifts = template.redshifts
+        if not self.allowed(targetid, template):
+            return np.zeros(len(redshifts), dtype=bool)
+        zmin, zmax = self.window(targetid, template)
+        if zmin is None and zmax is None:
+            return None
+        first = 0
+        last = len(redshifts)
+        if zmin is not None:
+            first = max(0, np.searchsorted(redshifts, zmin, side='left') - 1)
+        if zmax is not None:
+            last = min(len(redshifts),
+                np.searchsorted(redshifts, zmax, side='right') + 1)
+        mask = np.zeros(len(redshifts), dtype=bool)
+        mask[first:last] = True
+        if (zmin is not None and zmin > redshifts[-1]) \
+            or (zmax is not None and zmax < redshifts[0]):
+            mask[:] = False
+        return mask
+
+    def masks(self, targetid, templates):
+        """Return the masks of a target for all templates.
+
+        If the priors of a target exclude every template redshift, they are
+        ignored for that target, which is then fit without restriction.
+
+        Args:
+            targetid (int): the target ID.
+            templates (list): the Template objects.
+
+        Returns:
+            dict: the mask() of each template full type.
+
+        """
+        masks = { t.full_type : self.mask(targetid, t) for t in templates }
+        if all([ (m is not None) and (not np.any(m)) \
+            for m in masks.values() ]):
+            masks = { t.full_type : None for t in templates }
+        return masks
+
+    @staticmethod
+    def from_table(table, prefix="", zmin=None, zmax=None):
+        """Build the priors from the columns of a table.
+
+        The table has a TARGETID column and any of the columns ZMIN and ZMAX
+        (NaN for no limit) and SPECTYPE (a comma separated list of template
+        types, empty for all types), with an optional prefix.  If a target
+        appears in several rows, the first one is used.
+
+        Args:
+            table (Table): the input table.
+            prefix (str): the prefix of the column names, for example "RR_"
+                for the columns of a fibermap.
+            zmin (dict): global limits, see RedshiftPriors.
+            zmax (dict): global limits, see RedshiftPriors.
+
+        Returns:
+            RedshiftPriors: the priors, without target entries if the table
+                has none of the columns.
+
+        """
+        names = dict(zmin="{}ZMIN".format(prefix),
+            zmax="{}ZMAX".format(prefix),
+            spectypes="{}SPECTYPE".format(prefix))
+        names = { k : v for k, v in names.items() if v in table.colnames }
+        targets = dict()
+        if len(names) == 0:
+            return RedshiftPriors(zmin, zmax, targets)
+        tids = np.asarray(table["TARGETID"])
+        cols = { k : np.asarray(table[v]) for k, v in names.items() }
+        for row in range(len(tids)):
+            tid = tids[row].item()
+            if tid in targets:
+                continue
+            prior = dict()
+            for key in ("zmin", "zmax"):
+                if key in cols and np.isfinite(cols[key][row]):
+                    prior[key] = float(cols[key][row])
+            if "spectypes" in cols:
+                val = cols["spectypes"][row]
+                if isinstance(val, bytes):
+                    val = val.decode()
+                val = [ x.strip() for x in str(val).split(",") \
+                    if len(x.strip()) > 0 ]
+                if len(val) > 0:
+                    prior["spectypes"] = val
+            if len(prior) > 0:
+                targets[tid] = prior
+        return RedshiftPriors(zmin, zmax, targets)
+
+    @staticmethod
+    def read(filename, zmin=None, zmax=None):
+        """Read the priors of targets from a table file.
+
+        Args:
+            filename (str): a file readable by astropy.table.Table.read(),
+                with the columns described in from_table().
+            zmin (dict): global limits, see RedshiftPriors.
+            zmax (dict): global limits, see RedshiftPriors.
+
+        Returns:
+            RedshiftPriors: the priors.
+
+        """
+        from astropy.table import Table
+        return RedshiftPriors.from_table(Table.read(filename), zmin=zmin,
+            zmax=zmax)
@@ -9,8 +9,6 @@ from __future__ import absolute_import, division, print_function
 
 import numpy as np
 
-from ._rebin import _trapz_rebin
-
 from .utils import mp_array
 
 
@@ -68,12 +66,14 @@ def trapz_rebin(x, y, xnew=None, edges=None):
 
     result = np.zeros(len(edges)-1, dtype=np.float64)
 
+    # Imported here so that numba is only loaded when rebinning.
+    from ._rebin import _trapz_rebin
     _trapz_rebin(x, y, edges, result)
 
     return result
 
 
-def rebin_template(template, z, dwave):
+def rebin_template(template, z, dwave, pixels=None):
     """Rebin a template to a set of wavelengths.
 
     Given a template and a single redshift, rebin the template to a set of
@@ -84,6 +84,9 @@ def rebin_template(template, z, dwave):
         z (float): the redshift
         dwave (dict): the keys are the "wavehash" and the values
             are a 1D array containing the wavelength grid.
+        pixels (dict): (optional) for some of the wavehash keys, the (start,
+            stop) range of the pixels which are needed.  The other pixels of
+            these grids are set to zero.
 
     Returns:
         dict:  The rebinned template for every basis function and wavelength
@@ -94,9 +97,13 @@ def rebin_template(template, z, dwave):
     result = dict()
     for hs, wave in dwave.items():
         binned = np.zeros((wave.shape[0], nbasis), dtype=np.float64)
-        for b in range(nbasis):
-            t = trapz_rebin((1.0+z)*template.wave, template.flux[b],
-                wave)
-            binned[:,b] = t
+        lo, hi = (0, wave.shape[0])
+        if (pixels is not None) and (hs in pixels):
+            lo, hi = pixels[hs]
+        if hi > lo:
+            edges = centers2edges(wave)[lo:hi+1]
+            for b in range(nbasis):
+                binned[lo:hi,b] = trapz_rebin((1.0+z)*template.wave,
+                    template.flux[b], edges=edges)
         result[hs] = binned
     return result
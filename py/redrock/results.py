@@ -15,73 +15,531 @@ from astropy.table import Table
 from .utils import encode_column
 
 
-def write_zscan(filename, zscan, zfit, clobber=False):
+def _zscan_layout(zscan, targetids):
+    """Describe the scan datasets for a set of targets.
+
+    Args:
+        zscan (dict): the scan results for each target ID.
+        targetids (list): the target IDs to describe.
+
+    Returns:
+        dict: for each spectype, a dictionary with the "redshifts" array and
+            the (row shape, dtype string) of every other dataset.  None if
+            there are no targets.
+
+    """
+    if len(targetids) == 0:
+        return None
+    layout = dict()
+    first = zscan[targetids[0]]
+    for spectype in first.keys():
+        layout[spectype] = dict()
+        for key, value in first[spectype].items():
+            if key == 'redshifts':
+                layout[spectype][key] = np.asarray(value)
+            else:
+                value = np.asarray(value)
+                layout[spectype][key] = (value.shape, value.dtype.str)
+    return layout
+
+
+def _create_zscan(fx, ntarget, layout, compression=None, chunk_targets=16):
+    """Create the preallocated scan datasets in an open HDF5 file.
+
+    Args:
+        fx (h5py.File): the open file.
+        ntarget (int): the total number of targets.
+        layout (dict): the dataset description from _zscan_layout().
+        compression (str): optional h5py compression filter.
+        chunk_targets (int): the number of targets in each chunk.
+
+    """
+    fx.create_dataset('targetids', (ntarget,), dtype=np.int64)
+    for spectype in sorted(layout.keys()):
+        for key in sorted(layout[spectype].keys()):
+            name = 'zscan/{}/{}'.format(spectype, key)
+            if key == 'redshifts':
+                fx[name] = layout[spectype][key]
+                continue
+            rowshape, dtype = layout[spectype][key]
+            shape = (ntarget,) + tuple(rowshape)
+            chunks = None
+            comp = None
+            if ntarget > 0 and np.prod(shape) > 0:
+                chunks = (min(chunk_targets, ntarget),) + tuple(rowshape)
+                comp = compression
+            fx.create_dataset(name, shape, dtype=np.dtype(dtype),
+                chunks=chunks, compression=comp)
+    return
+
+
+def _write_zscan_rows(fx, offset, targetids, zscan, layout):
+    """Write the scan data for a contiguous block of targets.
+
+    Args:
+        fx (h5py.File): the open file with preallocated datasets.
+        offset (int): the row of the first target.
+        targetids (list): the target IDs to write.
+        zscan (dict): the scan results for each target ID.
+        layout (dict): the dataset description from _zscan_layout().
+
+    """
+    n = len(targetids)
+    if n == 0:
+        return
+    fx['targetids'][offset:offset+n] = np.asarray(targetids, dtype=np.int64)
+    for spectype in sorted(layout.keys()):
+        for key in sorted(layout[spectype].keys()):
+            if key == 'redshifts':
+                continue
+            data = np.stack([ zscan[t][spectype][key] for t in targetids ])
+            fx['zscan/{}/{}'.format(spectype, key)][offset:offset+n] = data
+            del data
+    return
+
+
+def _copy_zscan_rows(fx, offset, px, layout, chunk_targets=16):
+    """Copy all rows of a partial scan file into the final file.
+
+    The copy is done in blocks of targets so that memory use is bounded.
+
+    Args:
+        fx (h5py.File): the output file with preallocated datasets.
+        offset (int): the row of the first target in the output.
+        px (h5py.File): the partial file.
+        layout (dict): the dataset description from _zscan_layout().
+        chunk_targets (int): the number of targets in each chunk.
+
+    """
+    n = px['targetids'].shape[0]
+    names = [ 'targetids' ]
+    for spectype in sorted(layout.keys()):
+        for key in sorted(layout[spectype].keys()):
+            if key != 'redshifts':
+                names.append('zscan/{}/{}'.format(spectype, key))
+    block = 8 * chunk_targets
+    for first in range(0, n, block):
+        last = min(first + block, n)
+        for name in names:
+            fx[name][offset+first:offset+last] = px[name][first:last]
+    return
+
+
+def write_zscan(filename, zscan, zfit, clobber=False, comm=None,
+    compression=None, chunk_targets=16):
     """Writes redrock.zfind results to a file.
 
-    The nested dictionary structure of results is mapped into a nested
-    group structure of the HDF5 file:
+    The nested dictionary structure of results is mapped into a set of
+    preallocated, chunked datasets of the HDF5 file:
 
+    /zbest table...
     /targetids[nt]
     /zscan/{spectype}/redshifts[nz]
     /zscan/{spectype}/zchi2[nt, nz]
     /zscan/{spectype}/penalty[nt, nz]
-    /zscan/{spectype}/zcoeff[nt, nz, nc] or zcoeff[nt, nc, nz] ?
-    /zfit/{targetid}/zfit table...
+    /zscan/{spectype}/zcoeff[nt, nz, nc]
+    /zfit/zfit table...
+    /zfit/offsets[nt+1]
+
+    If the coefficients were only kept around the chi^2 minima (see
+    redrock.zscan.ScanRetention), zcoeff has shape [nt, nw, nc] and there is
+    an additional /zscan/{spectype}/zcoeff_index[nt, nw] with the redshift
+    index of each row (-1 for unused rows).  If they were not kept, there is
+    no zcoeff dataset.  The datasets keep the data type of the inputs.
+
+    The zfit table contains the fits of all targets, grouped by target in the
+    order of /targetids.  The fits of targetids[i] are the rows
+    offsets[i]:offsets[i+1].
+
+    If a communicator is given, each process writes the rows of its own
+    targets.  If h5py was built with parallel HDF5 the rows are written
+    directly with the MPI-IO driver, otherwise each process writes a partial
+    file which the root process then merges one block at a time.
 
     Args:
         filename (str): the output file path.
-        zscan (dict): the full set of fit results.
-        zfit (Table): the best fit redshift results.
+        zscan (dict): the full set of fit results, or if using MPI the
+            results of the local targets.
+        zfit (Table): the best fit redshift results.  If using MPI, this is
+            only used on the rank 0 process.
         clobber (bool): if True, delete the file if it exists.
+        comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
+        compression (str): (optional) h5py compression filter for the scan
+            datasets, e.g. "gzip".  Not used with the MPI-IO driver.
+        chunk_targets (int): the number of targets in each chunk of the scan
+            datasets.
 
     """
     import h5py
+
+    rank = 0
+    nproc = 1
+    if comm is not None:
+        rank = comm.rank
+        nproc = comm.size
+
+    if rank == 0:
+        zfit = _write_zbest_table(filename, zfit, clobber=clobber)
+        zbest = zfit[zfit['znum'] == 0]
+
+    # Find the targets written by each process.
+
+    if comm is None:
+        targetids = [ x for x in zbest['targetid'] ]
+    else:
+        targetids = list(zscan.keys())
+
+    layout = _zscan_layout(zscan, targetids)
+
+    ntarget = len(targetids)
+    offset = 0
+    if comm is not None:
+        layout = [ x for x in comm.allgather(layout) if x is not None ]
+        layout = layout[0] if len(layout) > 0 else None
+        counts = comm.allgather(len(targetids))
+        ntarget = sum(counts)
+        offset = sum(counts[:rank])
+        comm.barrier()
+
+    # Without any targets, the file only has the empty tables.
+
+    if layout is None:
+        layout = dict()
+
+    if comm is None:
+        with h5py.File(filename, 'a') as fx:
+            _create_zscan(fx, ntarget, layout, compression=compression,
+                chunk_targets=chunk_targets)
+            _write_zscan_rows(fx, offset, targetids, zscan, layout)
+    elif h5py.get_config().mpi:
+        with h5py.File(filename, 'a', driver='mpio', comm=comm) as fx:
+            _create_zscan(fx, ntarget, layout, compression=None,
+                chunk_targets=chunk_targets)
+            _write_zscan_rows(fx, offset, targetids, zscan, layout)
+    else:
+        partfile = '{}.part{}'.format(filename, rank)
+        with h5py.File(partfile, 'w') as px:
+            _create_zscan(px, len(targetids), layout,
+                chunk_targets=chunk_targets)
+            _write_zscan_rows(px, 0, targetids, zscan, layout)
+        comm.barrier()
+        if rank == 0:
+            with h5py.File(filename, 'a') as fx:
+                _create_zscan(fx, ntarget, layout, compression=compression,
+                    chunk_targets=chunk_targets)
+                poff = 0
+                for p in range(nproc):
+                    pfile = '{}.part{}'.format(filename, p)
+                    with h5py.File(pfile, 'r') as px:
+                        _copy_zscan_rows(fx, poff, px, layout,
+                            chunk_targets=chunk_targets)
+                        poff += px['targetids'].shape[0]
+                    os.remove(pfile)
+
+    if comm is not None:
+        comm.barrier()
+
+    # The root process writes the table of all fits, sorted into the order of
+    # the targets in the file.
+
+    if rank == 0:
+        _write_zfit_table(filename, zfit)
+
+    if comm is not None:
+        comm.barrier()
+
+    return
+
+
+def _write_zbest_table(filename, zfit, clobber=False):
+    """Start a scan file with the zbest table.
+
+    Args:
+        filename (str): the output file path.
+        zfit (Table): the best fit redshift results.
+        clobber (bool): if True, delete the file if it exists.
+
+    Returns:
+        Table: a copy of zfit with byte string spectype and subtype columns.
+
+    """
     if clobber and os.path.exists(filename):
         os.remove(filename)
 
     zfit = zfit.copy()
 
     #- convert unicode to byte strings
-    zfit.replace_column('spectype', np.char.encode(zfit['spectype'], 'ascii'))
-    zfit.replace_column('subtype', np.char.encode(zfit['subtype'], 'ascii'))
+    zfit.replace_column('spectype',
+        np.char.encode(zfit['spectype'], 'ascii'))
+    zfit.replace_column('subtype',
+        np.char.encode(zfit['subtype'], 'ascii'))
 
     zbest = zfit[zfit['znum'] == 0]
     zbest.remove_column('znum')
 
     zbest.write(filename, path='zbest', format='hdf5')
+    return zfit
+
+
+def _write_zfit_table(filename, zfit):
+    """Add the table of all fits to a scan file, in the order of /targetids.
+
+    Args:
+        filename (str): the scan file, which already has the targetids.
+        zfit (Table): the fits, as returned by _write_zbest_table().
+
+    """
+    import h5py
+
+    with h5py.File(filename, 'a') as fx:
+        alltargetids = fx['targetids'][()]
+        idsort = np.argsort(alltargetids, kind='stable')
+        pos = idsort[np.searchsorted(alltargetids, zfit['targetid'],
+            sorter=idsort)]
+        order = np.argsort(pos, kind='stable')
+        fx['zfit/zfit'] = zfit[order].as_array()
+        fx['zfit/offsets'] = np.searchsorted(pos[order],
+            np.arange(len(alltargetids)+1), side='left')
+        #- TODO: fx['zfit/model']
+    return
+
+
+def merge_zscan(filename, partfiles, zfit, clobber=False, remove=True,
+    compression=None, chunk_targets=16):
+    """Merge scan files of disjoint sets of targets into one scan file.
+
+    The parts are typically written by write_zscan() for successive chunks
+    of targets.  Their scan datasets are copied one block of targets at a
+    time, so memory use does not depend on the size of the parts.  The zbest
+    and zfit tables of the output are built from the given table rather than
+    from the parts.  This is only called by one process.
+
+    Args:
+        filename (str): the output file path.
+        partfiles (list): the scan files to merge, in output order.
+        zfit (Table): the best fit redshift results of all parts.
+        clobber (bool): if True, delete the file if it exists.
+        remove (bool): if True, remove each part after it is copied.
+        compression (str): (optional) h5py compression filter for the scan
+            datasets.
+        chunk_targets (int): the number of targets in each chunk of the scan
+            datasets.
+
+    """
+    import h5py
 
-    targetids = np.asarray(zbest['targetid'])
-    spectypes = list(zscan[targetids[0]].keys())
+    zfit = _write_zbest_table(filename, zfit, clobber=clobber)
 
-    fx = h5py.File(filename)
-    fx['targetids'] = targetids
+    layout = None
+    ntarget = 0
+    for pfile in partfiles:
+        with h5py.File(pfile, 'r') as px:
+            ntarget += px['targetids'].shape[0]
+            if layout is None:
+                layout = dict()
+                for spectype in px['zscan'].keys():
+                    layout[spectype] = dict()
+                    for key, ds in px['zscan'][spectype].items():
+                        if key == 'redshifts':
+                            layout[spectype][key] = ds[()]
+                        else:
+                            layout[spectype][key] = (ds.shape[1:],
+                                ds.dtype.str)
 
-    for spectype in spectypes:
-        zchi2 = np.vstack([zscan[t][spectype]['zchi2'] for t in targetids])
-        penalty = np.vstack([zscan[t][spectype]['penalty'] for t in targetids])
-        zcoeff = list()
-        for t in targetids:
-            tmp = zscan[t][spectype]['zcoeff']
-            tmp = tmp.reshape((1,)+tmp.shape)
-            zcoeff.append(tmp)
-        zcoeff = np.vstack(zcoeff)
-        fx['zscan/{}/zchi2'.format(spectype)] = zchi2
-        fx['zscan/{}/penalty'.format(spectype)] = penalty
-        fx['zscan/{}/zcoeff'.format(spectype)] = zcoeff
-        fx['zscan/{}/redshifts'.format(spectype)] = \
-            zscan[targetids[0]][spectype]['redshifts']
+    with h5py.File(filename, 'a') as fx:
+        _create_zscan(fx, ntarget, layout, compression=compression,
+            chunk_targets=chunk_targets)
+        offset = 0
+        for pfile in partfiles:
+            with h5py.File(pfile, 'r') as px:
+                _copy_zscan_rows(fx, offset, px, layout,
+                    chunk_targets=chunk_targets)
+                offset += px['targetids'].shape[0]
+            if remove:
+                os.remove(pfile)
 
-    for targetid in targetids:
-        ii = np.where(zfit['targetid'] == targetid)[0]
-        fx['zfit/{}/zfit'.format(targetid)] = zfit[ii].as_array()
-        #- TODO: fx['zfit/{}/model']
+    _write_zfit_table(filename, zfit)
+    return
 
-    fx.close()
+
+class ZScanFile(object):
+    """Random access to the contents of a redrock scan file.
+
+    The file is kept open and only the requested rows of the scan datasets
+    are read.  The table of fits for all targets is read once, in a single
+    pass, when the object is created.
+
+    Args:
+        filename (str): the path to a file written by write_zscan().
+
+    """
+    def __init__(self, filename):
+        import h5py
+        self._fx = h5py.File(filename, mode='r')
+        self._targetids = self._fx['targetids'][()]
+        self._rows = { x : i for i, x in enumerate(self._targetids) }
+        self._spectypes = list(self._fx['zscan'].keys())
+
+        self._keys = dict()
+        self._redshifts = dict()
+        for spectype in self._spectypes:
+            grp = self._fx['zscan/{}'.format(spectype)]
+            self._keys[spectype] = [ x for x in grp.keys() \
+                if x != 'redshifts' ]
+            self._redshifts[spectype] = grp['redshifts'][()]
+
+        # Files written by older versions store one zfit table per target.
+        if 'offsets' in self._fx['zfit']:
+            self._zfit = self._fx['zfit/zfit'][()]
+            self._offsets = self._fx['zfit/offsets'][()]
+        else:
+            zfit = [ self._fx['zfit/{}/zfit'.format(tid)][()] \
+                for tid in self._targetids ]
+            self._offsets = np.cumsum([0,] + [ len(x) for x in zfit ])
+            self._zfit = np.hstack(zfit)
+
+
+    @property
+    def targetids(self):
+        return self._targetids
+
+    @property
+    def spectypes(self):
+        return self._spectypes
+
+    def __len__(self):
+        return len(self._targetids)
+
+    def __iter__(self):
+        return iter(self._targetids)
+
+    def __contains__(self, targetid):
+        return targetid in self._rows
+
+    def __getitem__(self, targetid):
+        return self.zscan([ targetid ])[targetid]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """Close the underlying file.
+        """
+        if self._fx is not None:
+            self._fx.close()
+            self._fx = None
+        return
+
+
+    def _zfit_rows(self, rows):
+        """Return the zfit structured array for a list of target rows.
+        """
+        if len(rows) == 0:
+            return self._zfit[0:0]
+        return np.hstack([ self._zfit[self._offsets[x]:self._offsets[x+1]] \
+            for x in rows ])
+
+
+    def zfit(self, targetids=None):
+        """Return the table of fits.
+
+        Args:
+            targetids (list): (optional) only return the fits of these
+                targets, in this order.
+
+        Returns:
+            Table: the fits for the selected targets.
+
+        """
+        if targetids is None:
+            zfit = Table(self._zfit)
+        else:
+            zfit = Table(self._zfit_rows([ self._rows[x] for x in targetids ]))
+        zfit.replace_column('spectype', encode_column(zfit['spectype']))
+        zfit.replace_column('subtype', encode_column(zfit['subtype']))
+        return zfit
+
+
+    def _read_rows(self, rows):
+        """Read the scan results of a sorted list of unique target rows.
+        """
+        data = dict()
+        for spectype in self._spectypes:
+            data[spectype] = dict()
+            for key in self._keys[spectype]:
+                dset = self._fx['zscan/{}/{}'.format(spectype, key)]
+                if len(rows) > 0 and rows[-1] - rows[0] + 1 == len(rows):
+                    data[spectype][key] = dset[rows[0]:rows[-1]+1]
+                else:
+                    data[spectype][key] = dset[list(rows)]
+
+        zscan = dict()
+        for i, r in enumerate(rows):
+            targetid = self._targetids[r]
+            thiszfit = self._zfit[self._offsets[r]:self._offsets[r+1]]
+            zscan[targetid] = dict()
+            for spectype in self._spectypes:
+                tz = dict()
+                tz['redshifts'] = self._redshifts[spectype]
+                for key in self._keys[spectype]:
+                    tz[key] = data[spectype][key][i]
+                ii = (thiszfit['spectype'].astype('U') == spectype)
+                tf = Table(thiszfit[ii])
+                tf.remove_columns(['targetid', 'znum', 'deltachi2'])
+                tf.replace_column('spectype', encode_column(tf['spectype']))
+                tf.replace_column('subtype', encode_column(tf['subtype']))
+                tz['zfit'] = tf
+                zscan[targetid][spectype] = tz
+        return zscan
+
+
+    def zscan(self, targetids):
+        """Return the scan results for some targets.
+
+        Only the rows of the requested targets are read from the file.
+
+        Args:
+            targetids (list): the target IDs.
+
+        Returns:
+            dict: results[targetid][spectype] with the same keys as returned
+                by read_zscan().
+
+        """
+        rows = np.unique([ self._rows[x] for x in targetids ])
+        return self._read_rows(rows)
+
+
+    def iter_chunks(self, ntarget):
+        """Iterate over the file in chunks of consecutive targets.
+
+        This keeps the memory use bounded by the chunk size.
+
+        Args:
+            ntarget (int): the number of targets in each chunk.
+
+        Yields:
+            tuple: (zscan, zfit) for each chunk, as returned by zscan() and
+                zfit().
+
+        """
+        for first in range(0, len(self._targetids), ntarget):
+            rows = np.arange(first, min(first+ntarget, len(self._targetids)))
+            zfit = Table(self._zfit_rows(rows))
+            zfit.replace_column('spectype', encode_column(zfit['spectype']))
+            zfit.replace_column('subtype', encode_column(zfit['subtype']))
+            yield self._read_rows(rows), zfit
 
 
 def read_zscan(filename):
     """Read redrock.zfind results from a file.
 
+    To access only some of the targets in a large file, use ZScanFile
+    instead.
+
     Returns:
         tuple: (zbest, results) where zbest is a Table with keys TARGETID, Z,
             ZERR, ZWARN and results is a nested dictionary
@@ -96,42 +554,101 @@ def read_zscan(filename):
                 - zerr: uncertainty on zbest
                 - zwarn: 0=good, non-0 is a warning flag
 
+    """
+    with ZScanFile(filename) as zf:
+        zscan = zf._read_rows(np.arange(len(zf)))
+        zfit = zf.zfit()
+
+    return zscan, zfit
+
+
+def write_checkpoint(filename, results, targetids):
+    """Write the results of a chunk of targets to a checkpoint file.
+
+    The scan data and the refined fits of every template are stored for each
+    target, so that they can be restored by read_checkpoint() without any
+    computation.  The file is written under a temporary name and renamed
+    when complete, so an interrupted write never leaves a partial chunk.
+
+    Layout::
+
+        /targetids[nt]
+        /{spectype}/{zchi2,penalty,...}[nt, ...]
+        /{spectype}/zfit  fits of all targets, grouped by target
+        /{spectype}/zfit_offsets[nt+1]
+
+    Args:
+        filename (str): the checkpoint file to write.
+        results (dict): the results for each target ID, with the scan data
+            and the "zfit" Table for each template type.
+        targetids (list): the target IDs of the chunk.
+
     """
     import h5py
-    # zbest = Table.read(filename, format='hdf5', path='zbest')
-    with h5py.File(filename, mode='r') as fx:
-        targetids = fx['targetids'].value
-        spectypes = list(fx['zscan'].keys())
 
-        zscan = dict()
-        for targetid in targetids:
-            zscan[targetid] = dict()
-            for spectype in spectypes:
-                zscan[targetid][spectype] = dict()
-
-        for spectype in spectypes:
-            zchi2 = fx['/zscan/{}/zchi2'.format(spectype)].value
-            penalty = fx['/zscan/{}/penalty'.format(spectype)].value
-            zcoeff = fx['/zscan/{}/zcoeff'.format(spectype)].value
-            redshifts = fx['/zscan/{}/redshifts'.format(spectype)].value
-            for i, targetid in enumerate(targetids):
-                zscan[targetid][spectype]['redshifts'] = redshifts
-                zscan[targetid][spectype]['zchi2'] = zchi2[i]
-                zscan[targetid][spectype]['penalty'] = penalty[i]
-                zscan[targetid][spectype]['zcoeff'] = zcoeff[i]
-                thiszfit = fx['/zfit/{}/zfit'.format(targetid)].value
-                ii = (thiszfit['spectype'].astype('U') == spectype)
-                thiszfit = Table(thiszfit[ii])
-                thiszfit.remove_columns(['targetid', 'znum', 'deltachi2'])
-                thiszfit.replace_column('spectype',
-                    encode_column(thiszfit['spectype']))
-                thiszfit.replace_column('subtype',
-                    encode_column(thiszfit['subtype']))
-                zscan[targetid][spectype]['zfit'] = thiszfit
-
-        zfit = [fx['zfit/{}/zfit'.format(tid)].value for tid in targetids]
-        zfit = Table(np.hstack(zfit))
-        zfit.replace_column('spectype', encode_column(zfit['spectype']))
-        zfit.replace_column('subtype', encode_column(zfit['subtype']))
+    tmpfile = filename + '.tmp'
+    with h5py.File(tmpfile, 'w') as fx:
+        fx['targetids'] = np.asarray(targetids)
+        for ft in results[targetids[0]].keys():
+            grp = fx.create_group(ft)
+            for key in results[targetids[0]][ft].keys():
+                if key in ('redshifts', 'zfit'):
+                    continue
+                grp[key] = np.stack([ results[x][ft][key] for x in targetids ])
+            zfit = [ np.asarray(results[x][ft]['zfit'].as_array()) \
+                for x in targetids ]
+            grp['zfit'] = np.hstack(zfit)
+            grp['zfit_offsets'] = np.cumsum([0,] + [ len(x) for x in zfit ])
+    os.rename(tmpfile, filename)
 
-    return zscan, zfit
+
+def read_checkpoint(filenames, targetids, templates):
+    """Read the results of some targets from checkpoint files.
+
+    Files that cannot be read, for example because the job was killed while
+    writing them, are skipped.  The checkpoint must have been written with
+    the same templates and scan data options.
+
+    Args:
+        filenames (list): the checkpoint files written by write_checkpoint().
+        targetids (list): the target IDs to look for.
+        templates (list): list of DistTemplate objects, for the redshifts.
+
+    Returns:
+        dict: the results for each target ID found, in the format returned by
+            calc_zchi2_targets() with the "zfit" Table for each template type.
+
+    """
+    import h5py
+
+    wanted = set(targetids)
+    redshifts = { t.template.full_type : t.template.redshifts \
+        for t in templates }
+    results = dict()
+    for filename in filenames:
+        try:
+            with h5py.File(filename, 'r') as fx:
+                fileids = fx['targetids'][()].tolist()
+                rows = [ i for i, x in enumerate(fileids) if x in wanted ]
+                if len(rows) == 0:
+                    continue
+                chunk = { fileids[i] : dict() for i in rows }
+                for ft in redshifts.keys():
+                    grp = fx[ft]
+                    offsets = grp['zfit_offsets'][()]
+                    zfit = grp['zfit'][()]
+                    data = { key : grp[key][()] for key in grp.keys() \
+                        if key not in ('zfit', 'zfit_offsets') }
+                    for i in rows:
+                        tres = dict(redshifts=redshifts[ft])
+                        for key, value in data.items():
+                            tres[key] = value[i]
+                        tres['zfit'] = Table(zfit[offsets[i]:offsets[i+1]])
+                        chunk[fileids[i]][ft] = tres
+        except (IOError, OSError, KeyError) as e:
+            print("WARNING: skipping checkpoint file {}: {}".format(filename,
+                e))
+            sys.stdout.flush()
+            continue
+        results.update(chunk)
+    return results
@@ -10,12 +10,13 @@ import numpy as np
 import scipy.sparse
 from collections import OrderedDict
 
-from astropy.table import Table
-
 from .utils import mp_array, distribute_work
 
 from . import constants
 
+from .zwarning import ZWarningMask as ZW
+
+
 class Spectrum(object):
     """Simple container class for an individual spectrum.
 
@@ -40,11 +41,102 @@ class Spectrum(object):
         self.Rcsr = Rcsr
         self._mpshared = False
         self.wavehash = hash((len(wave), wave[0], wave[1], wave[-2], wave[-1]))
+        self._clear_compress()
+
+    def _clear_compress(self):
+        self.pixels = None
+        self.feed = None
+        self.feed_range = None
+        self.Rpix = None
+
+    def compress(self):
+        """Select the pixels which contribute to the chi^2 fit.
+
+        Pixels with zero inverse variance (masked, bad or poorly covered by
+        the resolution) do not contribute to the fit.  Only the pixels with
+        nonzero weight are kept, and only the template pixels which feed them
+        through the resolution matrix are needed.  This sets:
+
+        - pixels: the indices of the pixels with nonzero ivar.
+        - feed: the template pixels which feed them, as a slice if they are
+          contiguous and otherwise as an index array.
+        - feed_range: the (start, stop) range of the feed pixels.
+        - Rpix: the resolution matrix (CSR) restricted to the rows of pixels
+          and the columns of feed.
+
+        The selection is computed once and is dropped when packing the
+        spectrum into shared memory.  It must be recomputed (by calling
+        _clear_compress() first) if ivar or the resolution are modified
+        afterwards.
+        """
+        if self.pixels is not None:
+            return
+        pixels = np.where(self.ivar > 0)[0]
+        rows = self.Rcsr[pixels]
+        cols = np.unique(rows.indices)
+        if len(cols) == 0:
+            feed = slice(0, 0)
+            feed_range = (0, 0)
+            Rpix = scipy.sparse.csr_matrix((len(pixels), 0))
+        elif cols[-1] - cols[0] + 1 == len(cols):
+            feed = slice(cols[0], cols[-1] + 1)
+            feed_range = (cols[0], cols[-1] + 1)
+            Rpix = scipy.sparse.csr_matrix((rows.data, rows.indices - cols[0],
+                rows.indptr), shape=(len(pixels), len(cols)))
+        else:
+            feed = cols
+            feed_range = (cols[0], cols[-1] + 1)
+            Rpix = rows[:,cols]
+        self.feed = feed
+        self.feed_range = feed_range
+        self.Rpix = Rpix
+        self.pixels = pixels
+        return
+
+    def downsample(self, factor):
+        """Return a copy of the spectrum binned to a coarser grid.
+
+        Consecutive blocks of factor pixels (the last block may be shorter)
+        are combined.  The flux is the inverse variance weighted mean of each
+        block, and the inverse variance is the sum.  The binned resolution
+        matrix maps a template sampled on the coarse grid (and held constant
+        within each block) to the binned flux.
+
+        Args:
+            factor (int): the number of pixels in each block.
+
+        Returns:
+            Spectrum: the binned spectrum.
+
+        """
+        n = self.nwave
+        nc = (n + factor - 1) // factor
+        block = np.arange(n) // factor
+        A = scipy.sparse.csr_matrix((np.ones(n), (block, np.arange(n))),
+            shape=(nc, n))
+        npix = np.asarray(A.sum(axis=1))[:,0]
+        ivar = A.dot(self.ivar)
+        wave = A.dot(self.wave) / npix
+
+        # The weights of the pixels in each block, or equal weights if the
+        # block has no data.
+        isbad = (ivar == 0)
+        w = np.where(isbad[block], 1.0 / npix[block],
+            self.ivar / (ivar[block] + isbad[block]))
+        Aw = scipy.sparse.csr_matrix((w, (block, np.arange(n))),
+            shape=(nc, n))
+        flux = Aw.dot(self.flux)
+
+        R = (Aw * self.Rcsr * A.T).todia()
+        return Spectrum(wave, flux, ivar, R, R.tocsr())
 
     def sharedmem_pack(self):
         """Pack spectral data into multiprocessing shared memory.
         """
         if not self._mpshared:
+            # The pixel selection is cheap to recompute in the workers.
+            self._clear_compress()
+
             # Store data in multiprocessing shared memory
             import multiprocessing as mp
             self.wave = mp_array(self.wave)
@@ -163,6 +255,19 @@ class Target(object):
         self.spectra = coadd
         return
 
+    def downsample(self, factor):
+        """Return a copy of the target with all spectra binned.
+
+        Args:
+            factor (int): the number of pixels combined into one.
+
+        Returns:
+            Target: the target with the spectra binned by Spectrum.downsample.
+
+        """
+        return Target(self.id, [ s.downsample(factor) for s in self.spectra ],
+            meta=self.meta)
+
     def sharedmem_pack(self):
         """Pack all spectra into multiprocessing shared memory.
         """
@@ -257,7 +362,128 @@ class DistTargets(object):
         return self._dwave
 
 
-def distribute_targets(targets, nproc):
+def triage_targets(targets, flags=None, minpixels=1):
+    """Find the targets which are not fit.
+
+    A target is not fit if the caller flagged it (for example a sky fiber
+    found in the fibermap), if none of its pixels has a nonzero inverse
+    variance (NODATA), or if fewer than minpixels have (LITTLE_COVERAGE).
+
+    Args:
+        targets (list): list of Target objects.
+        flags (dict): (optional) the nonzero ZWARN bits of target IDs which
+            should not be fit.
+        minpixels (int): the smallest number of pixels with data to fit a
+            target, for example the number of template coefficients.
+
+    Returns:
+        dict: for each target ID which is not fit, a tuple of the ZWARN bits
+            and the number of pixels with data.
+
+    """
+    if flags is None:
+        flags = dict()
+    skip = dict()
+    for tg in targets:
+        npix = sum([ np.count_nonzero(s.ivar > 0) for s in tg.spectra ])
+        zwarn = flags.get(tg.id, 0)
+        if npix == 0:
+            zwarn |= ZW.NODATA
+        elif npix < minpixels:
+            zwarn |= ZW.LITTLE_COVERAGE
+        if zwarn != 0:
+            skip[tg.id] = (zwarn, npix)
+    return skip
+
+
+class TargetCost(object):
+    """Model of the time to fit a target.
+
+    The scan evaluates the chi2 of every target at every redshift of every
+    template, and the cost of one evaluation is modelled as
+
+        per_target + per_spectrum * nspec + per_pixel * npix
+
+    where nspec is the number of spectra and npix the number of pixels with
+    nonzero inverse variance, which are the only ones fit.  The refinement
+    repeats such evaluations around each minimum, so it scales the same way.
+    The default terms are the microseconds measured with 10 basis vectors
+    and 11 resolution diagonals; see calibrate() to measure them on another
+    system.  Only their ratios matter for the distribution of targets.
+
+    Any callable which takes a Target and returns a number can be used
+    instead of this class by distribute_targets().
+
+    Args:
+        per_target (float): the cost per redshift of each target.
+        per_spectrum (float): the cost per redshift of each spectrum.
+        per_pixel (float): the cost per redshift of each fit pixel.
+
+    """
+    def __init__(self, per_target=20.0, per_spectrum=3.5, per_pixel=0.13):
+        self.per_target = per_target
+        self.per_spectrum = per_spectrum
+        self.per_pixel = per_pixel
+
+    def cost(self, nspec, npix):
+        """Return the cost of a target with nspec spectra and npix pixels."""
+        return self.per_target + self.per_spectrum * nspec \
+            + self.per_pixel * npix
+
+    def __call__(self, target):
+        npix = sum([ np.count_nonzero(s.ivar > 0) for s in target.spectra ])
+        return self.cost(len(target.spectra), npix)
+
+    @staticmethod
+    def calibrate(nbasis=10, ndiag=11, sizes=(50, 500, 2000, 4000),
+        nspecs=(1, 4, 12), repeat=50):
+        """Measure the terms of the model on this system.
+
+        The chi2 of synthetic spectra is evaluated for every combination of
+        sizes and numbers of spectra, and the terms are fit to the measured
+        times (non-negative least squares of the relative errors).
+
+        Args:
+            nbasis (int): the number of template basis vectors.
+            ndiag (int): the number of diagonals of the resolution matrix.
+            sizes (tuple): the numbers of pixels of the spectra.
+            nspecs (tuple): the numbers of spectra of the targets.
+            repeat (int): the number of evaluations timed for each case.
+
+        Returns:
+            TargetCost: the model, with terms in microseconds.
+
+        """
+        import time
+        from scipy.optimize import nnls
+        from .zscan import spectral_data, calc_zchi2_one
+
+        rng = np.random.RandomState(0)
+        offsets = np.arange(ndiag//2, -(ndiag//2)-1, -1)
+        rows = list()
+        times = list()
+        for n in sizes:
+            wave = np.linspace(3600.0, 3600.0 + n, n)
+            data = np.ones((ndiag, n)) / ndiag
+            R = scipy.sparse.dia_matrix((data, offsets), shape=(n, n))
+            tmpl = rng.normal(size=(n, nbasis))
+            for nspec in nspecs:
+                spectra = [ Spectrum(wave, rng.normal(size=n), np.ones(n),
+                    R, R.tocsr()) for x in range(nspec) ]
+                tdata = { spectra[0].wavehash : tmpl }
+                weights, flux, wflux = spectral_data(spectra)
+                calc_zchi2_one(spectra, weights, flux, wflux, tdata)
+                start = time.time()
+                for x in range(repeat):
+                    calc_zchi2_one(spectra, weights, flux, wflux, tdata)
+                times.append(1.0e6 * (time.time() - start) / repeat)
+                rows.append([ 1.0, nspec, nspec * n ])
+        times = np.array(times)
+        terms = nnls(np.array(rows) / times[:,None], np.ones(len(times)))[0]
+        return TargetCost(*terms)
+
+
+def distribute_targets(targets, nproc, skip=None, cost=None):
     """Distribute a list of targets among processes.
 
     Given a list of Target objects, compute the load balanced
@@ -271,18 +497,26 @@ def distribute_targets(targets, nproc):
     Args:
         targets (list): list of Target objects.
         nproc (int): number of processes.
+        skip (dict): (optional) the target IDs which are not fit (see
+            triage_targets()), which get no weight.
+        cost (callable): (optional) the cost of a Target, by default
+            TargetCost().
 
     Returns:
         list:  A list (one element for each process) with each element
-            being a list of the target IDs assigned to that process.
+            being a sorted list of the target IDs assigned to that process.
 
     """
-    # We weight each target by the number of spectra.
+    # We weight each target by its estimated cost.
+    if cost is None:
+        cost = TargetCost()
     ids = list()
     tweights = dict()
     for tg in targets:
         ids.append(tg.id)
-        tweights[tg.id] = len(tg.spectra)
+        tweights[tg.id] = cost(tg)
+        if (skip is not None) and (tg.id in skip):
+            tweights[tg.id] = 0
     return distribute_work(nproc, ids, weights=tweights)
 
 
@@ -290,16 +524,22 @@ class DistTargetsCopy(DistTargets):
     """Distributed targets built from a copy.
 
     This class is a simple wrapper that distributes targets located on
-    one process to the processes in a communicator.
+    one process to the processes in a communicator.  Each target is only
+    sent to the process which owns it, with scatters of at most batchsize
+    targets per process, so that the pickled targets held at once on the
+    root process stay small.
 
     Args:
-        targets (list): list of Target objects on one process.
+        targets (list): list of Target objects on the root process.  It is
+            ignored on the other processes, which can pass None.
         comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
         root (int): the process which has the input targets locally.
+        batchsize (int): the maximum number of targets sent to each process
+            in one scatter.
 
     """
 
-    def __init__(self, targets, comm=None, root=0):
+    def __init__(self, targets, comm=None, root=0, batchsize=16):
 
         comm_size = 1
         comm_rank = 0
@@ -319,7 +559,11 @@ class DistTargetsCopy(DistTargets):
         # Distribute the targets among process weighted by the amount of work
         # to do for each target.
 
-        self._proc_targets = distribute_targets(targets, comm_size)
+        self._proc_targets = None
+        if comm_rank == root:
+            self._proc_targets = distribute_targets(targets, comm_size)
+        if comm is not None:
+            self._proc_targets = comm.bcast(self._proc_targets, root=root)
 
         self._my_targets = self._proc_targets[comm_rank]
 
@@ -329,12 +573,19 @@ class DistTargetsCopy(DistTargets):
         if comm is None:
             self._my_data = targets
         else:
-            tbuf = dict()
-            for tg in targets:
-                recv = comm.bcast(tg, root=root)
-                if recv.id in self._my_targets:
-                    tbuf[recv.id] = recv
-            self._my_data = [ tbuf[x] for x in self._my_targets ]
+            bytid = None
+            if comm_rank == root:
+                bytid = { tg.id : tg for tg in targets }
+            nbatch = max([ (len(x) + batchsize - 1) // batchsize \
+                for x in self._proc_targets ])
+            self._my_data = list()
+            for b in range(nbatch):
+                sendbuf = None
+                if comm_rank == root:
+                    sendbuf = [ [ bytid[x] for x in \
+                        ptg[b*batchsize:(b+1)*batchsize] ] \
+                        for ptg in self._proc_targets ]
+                self._my_data.extend(comm.scatter(sendbuf, root=root))
 
         super(DistTargetsCopy, self).__init__(self._alltargetids, comm=comm)
 
@@ -344,3 +595,51 @@ class DistTargetsCopy(DistTargets):
 
     def _local_data(self):
         return self._my_data
+
+
+class DistTargetsView(DistTargets):
+    """A subset of the local targets of another DistTargets object.
+
+    This is used to process the local targets in several passes, or to use
+    modified copies of them (see downsample_targets()).  No data is
+    communicated:  each process selects some of its own local targets, and
+    the global list of target IDs is that of the parent.
+
+    Args:
+        parent (DistTargets): the distributed targets.
+        targets (list): a subset of the local Target objects of the parent
+            on this process, or copies of them.  This may be empty.
+
+    """
+
+    def __init__(self, parent, targets):
+        self._parent = parent
+        self._my_data = list(targets)
+        self._my_targets = [ x.id for x in self._my_data ]
+        super(DistTargetsView, self).__init__(parent.all_target_ids,
+            comm=parent.comm)
+
+
+    def _local_target_ids(self):
+        return self._my_targets
+
+    def _local_data(self):
+        return self._my_data
+
+
+def downsample_targets(targets, factor):
+    """Bin the spectra of the local targets to coarser grids.
+
+    This is used for a faster coarse redshift scan.  The templates must be
+    rebinned to the wavelength grids of the returned object.
+
+    Args:
+        targets (DistTargets): the distributed targets.
+        factor (int): the number of pixels combined into one.
+
+    Returns:
+        DistTargetsView: the binned copies of the local targets.
+
+    """
+    return DistTargetsView(targets, [ tg.downsample(factor) \
+        for tg in targets.local() ])
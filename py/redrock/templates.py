@@ -10,10 +10,10 @@ import os
 import traceback
 
 import numpy as np
-from astropy.io import fits
-from astropy.table import Table
 
-from .utils import native_endian, elapsed, get_mp, mp_array
+from .utils import native_endian, elapsed, get_mp, mp_array, WorkerPool
+
+from .instrument import span, count
 
 from .rebin import rebin_template, trapz_rebin
 
@@ -33,6 +33,7 @@ class Template(object):
         wave=None, flux=None, subtype=None):
 
         if filename is not None:
+            from astropy.io import fits
             fx = None
             if os.path.exists(filename):
                 fx = fits.open(filename, memmap=False)
@@ -57,7 +58,7 @@ class Template(object):
             ## find out if redshift info is present in the file
             old_style_templates = True
             try:
-                redshifts = native_endian(fx['REDSHIFTS'].data)
+                self._redshifts = native_endian(fx['REDSHIFTS'].data)
                 old_style_templates = False
             except:
                 pass
@@ -207,12 +208,15 @@ class DistTemplatePiece(object):
         data (list): a list of dictionaries, one for each redshift, and
             each containing the 2D interpolated template values for all
             "wavehash" keys.
+        first (int): the index of the first redshift of this piece in the
+            redshifts of the template.
 
     """
-    def __init__(self, index, redshifts, data):
+    def __init__(self, index, redshifts, data, first=0):
         self.index = index
         self.redshifts = redshifts
         self.data = data
+        self.first = first
 
 
 def _mp_rebin_template(template, dwave, zlist, qout):
@@ -249,9 +253,12 @@ class DistTemplate(object):
         mp_procs (int): if not using MPI, restrict the number of
             multiprocesses to this.
         comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
+        backend (str): if not using MPI, run the multiprocessing workers as
+            "processes" or "threads".  See redrock.utils.WorkerPool.
 
     """
-    def __init__(self, template, dwave, mp_procs=1, comm=None):
+    def __init__(self, template, dwave, mp_procs=1, comm=None,
+        backend="processes"):
         self._comm = comm
         self._template = template
         self._dwave = dwave
@@ -269,6 +276,7 @@ class DistTemplate(object):
         nz = len(myz)
 
         data = list()
+        rebin = span("rebin", template=self._template.full_type)
 
         # In the case of not using MPI (comm == None), one process is rebinning
         # all the templates.  In that scenario, use multiprocessing
@@ -280,27 +288,31 @@ class DistTemplate(object):
                 binned = rebin_template(self._template, z, self._dwave)
                 data.append(binned)
         else:
-            # We don't have MPI, so use multiprocessing
-            import multiprocessing as mp
+            # We don't have MPI, so use multiprocessing workers (processes
+            # or threads).
+            pool = WorkerPool(backend=backend, nworker=mp_procs)
 
-            qout = mp.Queue()
+            qout = pool.queue()
             work = np.array_split(myz, mp_procs)
-            procs = list()
             for i in range(mp_procs):
-                p = mp.Process(target=_mp_rebin_template,
-                    args=(self._template, self._dwave, work[i], qout))
-                procs.append(p)
-                p.start()
+                pool.start(_mp_rebin_template,
+                    (self._template, self._dwave, work[i], qout))
 
             # Extract the output into a single list
             results = dict()
             for i in range(mp_procs):
                 res = qout.get()
                 results.update(res)
+            pool.close()
             for z in myz:
                 data.append(results[z])
 
-        self._piece = DistTemplatePiece(self._comm_rank, myz, data)
+        first = sum([ len(x) for x in \
+            self._distredshifts[0:self._comm_rank] ])
+        self._piece = DistTemplatePiece(self._comm_rank, myz, data,
+            first=first)
+        rebin.stop()
+        count("rebin_calls", nz * len(self._dwave))
 
 
     @property
@@ -344,6 +356,9 @@ class DistTemplate(object):
         if from_proc < 0:
             from_proc = nproc - 1
 
+        count("bytes_cycled", sum([ v.nbytes for d in self._piece.data \
+            for v in d.values() ]))
+
         # Send our data and get a request handle for later checking.
 
         req = self._comm.isend(self._piece, to_proc)
@@ -369,40 +384,20 @@ class DistTemplate(object):
         return done
 
 
-def load_dist_templates(dwave, templates=None, comm=None, mp_procs=1):
-    """Read and distribute templates from disk.
-
-    This reads one or more template files from disk and distributes them among
-    an MPI communicator.  Each process will locally store interpolated data
-    for a redshift slice of each template.  For a single redshift, the template
-    is interpolated to the wavelength grids specified by "dwave".
-
-    As an example, imagine 3 templates with independent redshift ranges.  Also
-    imagine that the communicator has 2 processes.  This function would return
-    a list of 3 DistTemplate objects.  Within each of those objects, the 2
-    processes store the interpolated data for a subset of the redshift range:
-
-    DistTemplate #1:  zmin1 <---- p0 ----> | <---- p1 ----> zmax1
-    DistTemplate #2:  zmin2 <-- p0 --> | <-- p1 --> zmax2
-    DistTemplate #3:  zmin3 <--- p0 ---> | <--- p1 ---> zmax3
+def load_templates(templates=None, comm=None):
+    """Read templates from disk and broadcast them.
 
     Args:
-        dwave (dict): the dictionary of wavelength grids.  Keys are the
-            "wavehash" and values are an array of wavelengths.
         templates (str or None): if None, find all templates from the
             redrock template directory.  If a path to a file is specified,
             load that single template.  If a path to a directory is given,
             load all templates in that directory.
         comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
-        mp_procs (int): if not using MPI, restrict the number of
-            multiprocesses to this.
 
     Returns:
-        list: a list of DistTemplate objects.
+        list: a list of Template objects on every process.
 
     """
-    timer = elapsed(None, "", comm=comm)
-
     template_files = None
 
     if (comm is None) or (comm.rank == 0):
@@ -435,15 +430,64 @@ def load_dist_templates(dwave, templates=None, comm=None, mp_procs=1):
     if comm is not None:
         template_data = comm.bcast(template_data, root=0)
 
-    timer = elapsed(timer, "Read and broadcast of {} templates"\
-        .format(len(template_files)), comm=comm)
+    return template_data
+
+
+def load_dist_templates(dwave, templates=None, comm=None, mp_procs=1,
+    backend="processes"):
+    """Read and distribute templates from disk.
+
+    This reads one or more template files from disk and distributes them among
+    an MPI communicator.  Each process will locally store interpolated data
+    for a redshift slice of each template.  For a single redshift, the template
+    is interpolated to the wavelength grids specified by "dwave".
+
+    As an example, imagine 3 templates with independent redshift ranges.  Also
+    imagine that the communicator has 2 processes.  This function would return
+    a list of 3 DistTemplate objects.  Within each of those objects, the 2
+    processes store the interpolated data for a subset of the redshift range:
+
+    DistTemplate #1:  zmin1 <---- p0 ----> | <---- p1 ----> zmax1
+    DistTemplate #2:  zmin2 <-- p0 --> | <-- p1 --> zmax2
+    DistTemplate #3:  zmin3 <--- p0 ---> | <--- p1 ---> zmax3
+
+    Args:
+        dwave (dict): the dictionary of wavelength grids.  Keys are the
+            "wavehash" and values are an array of wavelengths.
+        templates (str or None or list): if None, find all templates from the
+            redrock template directory.  If a path to a file is specified,
+            load that single template.  If a path to a directory is given,
+            load all templates in that directory.  If a list of Template
+            objects (for example from load_templates()) is given, these are
+            used without reading anything from disk.
+        comm (mpi4py.MPI.Comm): (optional) the MPI communicator.
+        mp_procs (int): if not using MPI, restrict the number of
+            multiprocesses to this.
+        backend (str): if not using MPI, run the multiprocessing workers as
+            "processes" or "threads".
+
+    Returns:
+        list: a list of DistTemplate objects.
+
+    """
+    timer = elapsed(None, "", comm=comm)
+
+    if isinstance(templates, list):
+        template_data = templates
+    else:
+        with span("load_templates"):
+            template_data = load_templates(templates=templates, comm=comm)
+
+        timer = elapsed(timer, "Read and broadcast of {} templates"\
+            .format(len(template_data)), comm=comm)
 
     # Compute the interpolated templates in a distributed way with every
     # process generating a slice of the redshift range.
 
     dtemplates = list()
     for t in template_data:
-        dtemplates.append(DistTemplate(t, dwave, mp_procs=mp_procs, comm=comm))
+        dtemplates.append(DistTemplate(t, dwave, mp_procs=mp_procs, comm=comm,
+            backend=backend))
 
     timer = elapsed(timer, "Rebinning templates", comm=comm)
 
@@ -0,0 +1,209 @@
+#- Writers of synthetic input files in the DESI and BOSS formats
+
+from __future__ import division, print_function
+
+import numpy as np
+import scipy.sparse
+
+from . import util
+
+
+def _resolution_data(nwave, ndiag=11, sigma=(1.0, 1.5)):
+    """Return the (ndiag, nwave) band diagonal data of a resolution matrix
+
+    The line spread function is a Gaussian whose width (in pixels) varies
+    linearly along the wavelength grid between the values of sigma.  Each
+    column is normalized.
+    """
+    x = np.arange(ndiag//2, -(ndiag//2)-1, -1)
+    s = np.linspace(sigma[0], sigma[1], nwave)
+    data = np.exp(-x[:,None]**2 / (2.0 * s[None,:]**2))
+    data /= data.sum(axis=0)
+    return data
+
+
+def _template(wavemax, nbasis=3):
+    return util.get_template(wavemin=100, wavemax=wavemax, wavestep=1,
+        nbasis=nbasis)
+
+
+def _observed_flux(template, coeff, wave, z, rdata):
+    """Template flux at redshift z convolved with the resolution"""
+    flux = template.eval(coeff, wave, z)
+    ndiag = rdata.shape[0]
+    offsets = np.arange(ndiag//2, -(ndiag//2)-1, -1)
+    R = scipy.sparse.dia_matrix((rdata, offsets), shape=(len(wave),
+        len(wave)))
+    return R.dot(flux)
+
+
+def write_desi_spectra(filename, ntarget=16, nexp=2, waves=None, ndiag=11,
+    zrange=(0.05, 1.4), mask_fraction=0.0, first_targetid=1000, seed=0):
+    """Write a synthetic DESI spectra file
+
+    The file has a FIBERMAP table and, for each camera, the WAVELENGTH,
+    FLUX, IVAR, MASK and RESOLUTION HDUs read by DistTargetsDESI.  Each
+    target has nexp spectra (rows) in each camera.
+
+    Args:
+        filename (str): the output file.
+        ntarget (int): the number of targets.
+        nexp (int): the number of exposures of each target.
+        waves (list): the wavelength grids of the cameras b, r, z (default
+            util.desi_waves).
+        ndiag (int): the number of diagonals of the resolution matrices.
+        zrange (tuple): the range of the random true redshifts.
+        mask_fraction (float): the fraction of spectra which get a masked
+            block of pixels (nonzero MASK) and a block of pixels with
+            ivar == 0.
+        first_targetid (int): the TARGETID of the first target.
+        seed (int): the random seed.
+
+    Returns:
+        dict: the true redshift of each TARGETID.
+    """
+    from astropy.io import fits
+    from astropy.table import Table
+
+    rng = np.random.RandomState(seed)
+    if waves is None:
+        waves = util.desi_waves
+    bands = ['b', 'r', 'z', 'x', 'y'][0:len(waves)]
+    template = _template(waves[-1][-1] + 100)
+
+    targetids = np.arange(first_targetid, first_targetid + ntarget)
+    truez = rng.uniform(zrange[0], zrange[1], size=ntarget)
+    coeffs = rng.uniform(0.5, 2.0, size=(ntarget, template.nbasis))
+    nspec = ntarget * nexp
+
+    fibermap = Table()
+    fibermap['TARGETID'] = np.repeat(targetids, nexp).astype(np.int64)
+    fibermap['FIBER'] = np.tile(np.arange(ntarget, dtype=np.int32), nexp)
+    fibermap['EXPID'] = np.repeat(np.arange(nexp, dtype=np.int32)[None,:],
+        ntarget, axis=0).ravel()
+    fibermap['TARGET_RA'] = np.repeat(rng.uniform(0, 360, ntarget), nexp)
+    fibermap['TARGET_DEC'] = np.repeat(rng.uniform(-10, 60, ntarget), nexp)
+    fibermap['BRICKNAME'] = np.array(['0000p000',] * nspec, dtype='S8')
+
+    hx = fits.HDUList()
+    hx.append(fits.PrimaryHDU())
+    hdu = fits.convenience.table_to_hdu(fibermap)
+    hdu.header['EXTNAME'] = 'FIBERMAP'
+    hx.append(hdu)
+
+    for band, wave in zip(bands, waves):
+        nwave = len(wave)
+        rdata = _resolution_data(nwave, ndiag=ndiag).astype(np.float32)
+        flux = np.zeros((nspec, nwave), dtype=np.float32)
+        ivar = np.zeros((nspec, nwave), dtype=np.float32)
+        mask = np.zeros((nspec, nwave), dtype=np.uint32)
+        for i in range(ntarget):
+            model = _observed_flux(template, coeffs[i], wave, truez[i], rdata)
+            for j in range(nexp):
+                row = i * nexp + j
+                sigma = rng.uniform(0.5, 1.5, size=nwave)
+                flux[row] = model + rng.normal(scale=sigma)
+                ivar[row] = 1.0 / sigma**2
+                if rng.uniform() < mask_fraction:
+                    # A masked block, and a block with no data.
+                    n = nwave // 10
+                    a, b = rng.randint(0, nwave - n, size=2)
+                    mask[row, a:a+n] = 1
+                    ivar[row, b:b+n] = 0.0
+        res = np.repeat(rdata[None,:,:], nspec, axis=0)
+
+        for name, data in [('WAVELENGTH', wave), ('FLUX', flux),
+            ('IVAR', ivar), ('MASK', mask), ('RESOLUTION', res)]:
+            hdu = fits.ImageHDU(data)
+            hdu.header['EXTNAME'] = '{}_{}'.format(band.upper(), name)
+            hx.append(hdu)
+
+    hx.writeto(filename, overwrite=True)
+    return { int(t) : float(z) for t, z in zip(targetids, truez) }
+
+
+def write_boss_spplate(filename, nfiber=16, plate=1000, mjd=55000,
+    coeff0=3.5563, coeff1=1e-4, npix=4600, zrange=(0.05, 1.0),
+    mask_fraction=0.0, seed=0):
+    """Write a synthetic BOSS spPlate file
+
+    The file has the flux, inverse variance, and-mask, or-mask, wavelength
+    dispersion and plug map HDUs read by redrock.external.boss.read_spectra,
+    on a log10 wavelength grid starting at coeff0 with step coeff1.
+
+    Args:
+        filename (str): the output file.
+        nfiber (int): the number of fibers (targets).
+        plate (int): the plate number.
+        mjd (int): the MJD.
+        coeff0 (float): log10 of the first wavelength.
+        coeff1 (float): the log10 wavelength step.
+        npix (int): the number of pixels.
+        zrange (tuple): the range of the random true redshifts.
+        mask_fraction (float): the fraction of fibers which get a block of
+            pixels with a nonzero and-mask.
+        seed (int): the random seed.
+
+    Returns:
+        dict: the true redshift of each fiber ID.
+    """
+    from astropy.io import fits
+    from astropy.table import Table
+
+    rng = np.random.RandomState(seed)
+    wave = 10**(coeff0 + coeff1 * np.arange(npix))
+    template = _template(wave[-1] + 100)
+    truez = rng.uniform(zrange[0], zrange[1], size=nfiber)
+    coeffs = rng.uniform(0.5, 2.0, size=(nfiber, template.nbasis))
+
+    flux = np.zeros((nfiber, npix), dtype=np.float32)
+    ivar = np.zeros((nfiber, npix), dtype=np.float32)
+    andmask = np.zeros((nfiber, npix), dtype=np.int32)
+    wdisp = np.ones((nfiber, npix), dtype=np.float32)
+    rdata = _resolution_data(npix, ndiag=5, sigma=(1.0, 1.0))
+    for i in range(nfiber):
+        model = _observed_flux(template, coeffs[i], wave, truez[i], rdata)
+        sigma = rng.uniform(0.5, 1.5, size=npix)
+        flux[i] = model + rng.normal(scale=sigma)
+        ivar[i] = 1.0 / sigma**2
+        if rng.uniform() < mask_fraction:
+            n = npix // 10
+            a = rng.randint(0, npix - n)
+            andmask[i, a:a+n] = 1
+
+    hdr = fits.Header()
+    hdr['PLATEID'] = plate
+    hdr['MJD'] = mjd
+    hdr['COEFF0'] = coeff0
+    hdr['COEFF1'] = coeff1
+    hx = fits.HDUList()
+    hx.append(fits.PrimaryHDU(flux, header=hdr))
+    hx.append(fits.ImageHDU(ivar))
+    hx.append(fits.ImageHDU(andmask))
+    hx.append(fits.ImageHDU(np.zeros_like(andmask)))
+    hx.append(fits.ImageHDU(wdisp))
+    plugmap = Table()
+    plugmap['FIBERID'] = np.arange(1, nfiber + 1, dtype=np.int32)
+    plugmap['OBJTYPE'] = np.array(['GALAXY',] * nfiber, dtype='S16')
+    hx.append(fits.convenience.table_to_hdu(plugmap))
+    hx.writeto(filename, overwrite=True)
+    return { i + 1 : float(z) for i, z in enumerate(truez) }
+
+
+def write_template(filename, template):
+    """Write a Template in the format read by Template(filename)"""
+    from astropy.io import fits
+    hdr = fits.Header()
+    hdr['CRVAL1'] = template.wave[0]
+    hdr['CDELT1'] = template.wave[1] - template.wave[0]
+    hdr['RRTYPE'] = template.template_type
+    hdr['RRSUBTYP'] = template.sub_type
+    hdr['EXTNAME'] = 'BASIS_VECTORS'
+    hx = fits.HDUList()
+    hx.append(fits.PrimaryHDU())
+    hx.append(fits.ImageHDU(template.flux, header=hdr))
+    hdu = fits.ImageHDU(np.asarray(template.redshifts, dtype=np.float64))
+    hdu.header['EXTNAME'] = 'REDSHIFTS'
+    hx.append(hdu)
+    hx.writeto(filename, overwrite=True)
+    return
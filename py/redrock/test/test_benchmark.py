@@ -0,0 +1,43 @@
+from __future__ import division, print_function
+
+import unittest
+import numpy as np
+
+from ..benchmark import run_benchmarks, compare_results
+from . import util
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        pass
+
+    def test_desi_sizes(self):
+        tg = util.get_target(0.5, waves=util.desi_waves, nexp=3)
+        self.assertEqual(len(tg.spectra), 9)
+        self.assertEqual(tg.spectra[0].nwave, len(util.desi_waves[0]))
+        tx = util.get_template(nbasis=10)
+        self.assertEqual(tx.nbasis, 10)
+
+    def test_run_compare(self):
+        res = run_benchmarks(ntarget=2, nz=20, nbasis=3, procs=[1, 2],
+            repeat=1, steps=["coadd", "scan", "fitz"], small=True)
+        steps = [ (x["step"], x["nproc"]) for x in res ]
+        self.assertEqual(steps, [ ("coadd", 1), ("scan", 1), ("scan", 2),
+            ("fitz", 1) ])
+        old = dict(config=dict(ntarget=2), results=res)
+        slow = [ dict(x, best=2 * x["best"]) for x in res ]
+        new = dict(config=dict(ntarget=2), results=slow)
+        rows = compare_results(old, new, threshold=0.5)
+        self.assertEqual(len(rows), 4)
+        self.assertTrue(all([ x[5] for x in rows if x[2] > 0 ]))
+        with self.assertRaises(ValueError):
+            run_benchmarks(steps=["blat"])
+
+
+def test_suite():
+    """Allows testing of only this module with the command::
+
+        python setup.py test -m <modulename>
+    """
+    return unittest.defaultTestLoader.loadTestsFromName(__name__)
@@ -6,12 +6,15 @@ from uuid import uuid1
 import numpy as np
 
 from .. import utils as rrutils
-from ..results import read_zscan, write_zscan
-from ..targets import DistTargetsCopy
-from ..templates import DistTemplate, find_templates, load_dist_templates
+from ..results import read_zscan, write_zscan, merge_zscan, ZScanFile
+from ..targets import DistTargetsCopy, DistTargetsView
+from ..templates import (Template, DistTemplate, find_templates,
+    load_templates, load_dist_templates)
 from ..zfind import zfind
+from ..zscan import ScanRetention
 
 from . import util
+from .mockfiles import write_desi_spectra, write_boss_spplate, write_template
 
 
 class TestIO(unittest.TestCase):
@@ -61,6 +64,13 @@ class TestIO(unittest.TestCase):
             self.assertEqual(wave.ndim, 1)
             self.assertEqual(flux.ndim, 2)
 
+        # Templates that were already read are reused as they are
+        templates = load_templates()
+        dtemplates = load_dist_templates(dwave, templates=templates)
+        self.assertEqual(len(dtemplates), len(templates))
+        for t, dtp in zip(templates, dtemplates):
+            self.assertTrue(dtp.template is t)
+
     def test_zscan_io(self):
         dtarg = util.fake_targets()
 
@@ -74,7 +84,8 @@ class TestIO(unittest.TestCase):
         zscan1, zfit1 = zfind(dtarg, [ dtemp ])
 
         write_zscan(self.testfile, zscan1, zfit1)
-        write_zscan(self.testfile, zscan1, zfit1, clobber=True)
+        write_zscan(self.testfile, zscan1, zfit1, clobber=True,
+            compression='gzip')
         zscan2, zfit2 = read_zscan(self.testfile)
 
         self.assertEqual(zfit1.colnames, zfit2.colnames)
@@ -88,6 +99,141 @@ class TestIO(unittest.TestCase):
                     d2 = zscan2[targetid][spectype][key]
                     self.assertTrue(np.all(d1==d2), 'data mismatch {}/{}/{}'.format(targetid, spectype, key))
 
+        with ZScanFile(self.testfile) as zf:
+            self.assertEqual(len(zf), len(zscan2))
+            targetid = zf.targetids[-1]
+            self.assertIn(targetid, zf)
+            zscan3 = zf[targetid]
+            for spectype in zscan2[targetid]:
+                for key in ['redshifts', 'zchi2', 'penalty', 'zcoeff']:
+                    np.testing.assert_equal(zscan3[spectype][key],
+                        zscan2[targetid][spectype][key])
+            zfit3 = zf.zfit([targetid])
+            np.testing.assert_equal(zfit3['z'],
+                zfit2['z'][zfit2['targetid'] == targetid])
+
+            nread = 0
+            for zscan4, zfit4 in zf.iter_chunks(1):
+                self.assertEqual(len(zscan4), 1)
+                nread += len(zscan4)
+                self.assertTrue(np.all(zfit4['targetid'] == \
+                    list(zscan4.keys())[0]))
+            self.assertEqual(nread, len(zscan2))
+
+    def test_zscan_io_empty(self):
+        import h5py
+        dtarg = util.fake_targets()
+        template = util.get_template(subtype='BLAT')
+        dtemp = DistTemplate(template, dtarg.wavegrids())
+        zscan1, zfit1 = zfind(DistTargetsView(dtarg, list()), [ dtemp ])
+
+        write_zscan(self.testfile, zscan1, zfit1, clobber=True)
+        with h5py.File(self.testfile, 'r') as fx:
+            self.assertEqual(fx['targetids'].shape, (0,))
+            self.assertEqual(len(fx['zfit/zfit']), 0)
+            np.testing.assert_equal(fx['zfit/offsets'][()], [0])
+
+    def test_merge_zscan(self):
+        dtarg = util.fake_targets()
+        dwave = dtarg.wavegrids()
+        template = util.get_template()
+        dtemp = DistTemplate(template, dwave)
+
+        zscan1, zfit1 = zfind(dtarg, [ dtemp ])
+
+        # Write the targets in two parts, as a streaming run would
+        ids = sorted(zscan1.keys())
+        parts = list()
+        for i, sub in enumerate([ ids[:1], ids[1:] ]):
+            part = '{}.part-{}'.format(self.testfile, i)
+            subfit = zfit1[np.in1d(zfit1['targetid'], sub)]
+            write_zscan(part, { x : zscan1[x] for x in sub }, subfit,
+                clobber=True)
+            parts.append(part)
+
+        merge_zscan(self.testfile, parts, zfit1, clobber=True)
+        for part in parts:
+            self.assertFalse(os.path.exists(part))
+
+        zscan2, zfit2 = read_zscan(self.testfile)
+        os.remove(self.testfile)
+        for cn in zfit1.colnames:
+            np.testing.assert_equal(zfit1[cn], zfit2[cn])
+        self.assertEqual(sorted(zscan1.keys()), sorted(zscan2.keys()))
+        for targetid in zscan1:
+            for spectype in zscan1[targetid]:
+                for key in zscan1[targetid][spectype]:
+                    np.testing.assert_equal(zscan1[targetid][spectype][key],
+                        zscan2[targetid][spectype][key])
+
+    def test_zscan_retention_io(self):
+        dtarg = util.fake_targets()
+        dwave = dtarg.wavegrids()
+        template = util.get_template()
+        dtemp = DistTemplate(template, dwave)
+        ft = template.full_type
+
+        zscan1, zfit1 = zfind(dtarg, [ dtemp ])
+
+        retention = ScanRetention(zcoeff='window', nminima=2, halfwidth=1,
+            dtype=np.float32)
+        zscan2, zfit2 = zfind(dtarg, [ dtemp ], retention=retention)
+        write_zscan(self.testfile, zscan2, zfit2, clobber=True)
+        zscan3, zfit3 = read_zscan(self.testfile)
+
+        for targetid in zscan1:
+            full = zscan1[targetid][ft]
+            win = zscan3[targetid][ft]
+            self.assertEqual(win['zchi2'].dtype, np.float32)
+            self.assertEqual(win['zcoeff'].shape, (6, template.nbasis))
+            ii = win['zcoeff_index']
+            self.assertTrue(np.any(ii >= 0))
+            np.testing.assert_allclose(win['zcoeff'][ii >= 0],
+                full['zcoeff'][ii[ii >= 0]], rtol=1e-5)
+            self.assertTrue(np.all(win['zcoeff'][ii < 0] == 0))
+
+        retention = ScanRetention(zcoeff='none')
+        zscan4, zfit4 = zfind(dtarg, [ dtemp ], retention=retention)
+        write_zscan(self.testfile, zscan4, zfit4, clobber=True)
+        zscan5, zfit5 = read_zscan(self.testfile)
+        for targetid in zscan5:
+            self.assertNotIn('zcoeff', zscan5[targetid][ft])
+            np.testing.assert_equal(zscan5[targetid][ft]['zchi2'],
+                zscan1[targetid][ft]['zchi2'])
+
+    def test_mock_files(self):
+        from astropy.io import fits
+        waves = [ np.arange(3600, 4000, 1.0), np.arange(3900, 4500, 1.0) ]
+        truth = write_desi_spectra(self.testfile, ntarget=3, nexp=2,
+            waves=waves, ndiag=7, mask_fraction=1.0)
+        self.assertEqual(len(truth), 3)
+        with fits.open(self.testfile) as hx:
+            fm = hx['FIBERMAP'].data
+            self.assertEqual(len(fm), 6)
+            self.assertEqual(sorted(set(fm['TARGETID'])), sorted(truth))
+            for band, wave in zip(['B', 'R'], waves):
+                nwave = len(wave)
+                self.assertEqual(hx[band+'_FLUX'].data.shape, (6, nwave))
+                self.assertEqual(hx[band+'_RESOLUTION'].data.shape,
+                    (6, 7, nwave))
+                self.assertTrue(np.any(hx[band+'_MASK'].data != 0))
+                self.assertTrue(np.any(hx[band+'_IVAR'].data == 0))
+                np.testing.assert_allclose(
+                    hx[band+'_RESOLUTION'].data.sum(axis=1), 1, rtol=1e-5)
+
+        truth = write_boss_spplate(self.testfile, nfiber=4, npix=500)
+        with fits.open(self.testfile) as hx:
+            self.assertEqual(hx[0].data.shape, (4, 500))
+            self.assertEqual(hx[0].header['PLATEID'], 1000)
+            self.assertEqual(list(hx[5].data['FIBERID']), sorted(truth))
+
+        template = util.get_template(redshifts=np.linspace(0.1, 0.3, 11))
+        write_template(self.testfile, template)
+        tx = Template(self.testfile)
+        np.testing.assert_equal(tx.redshifts, template.redshifts)
+        np.testing.assert_allclose(tx.flux, template.flux)
+        os.remove(self.testfile)
+
 
 def test_suite():
     """Allows testing of only this module with the command::
@@ -6,8 +6,10 @@ from __future__ import (absolute_import, division,
                         print_function, unicode_literals)
 # The line above will help with 2to3 support.
 import unittest
+import os
 import re
 import sys
+import subprocess
 from .. import __version__ as theVersion
 
 
@@ -38,6 +40,18 @@ class TestTopLevel(unittest.TestCase):
         else:
             self.assertRegexpMatches(theVersion, self.versionre)
 
+    def test_lazy_imports(self):
+        """Ensure numba and astropy FITS are only loaded when needed.
+        """
+        code = ("import sys; import redrock.targets, redrock.templates, "
+            "redrock.zscan; print(sorted(x for x in ('numba', "
+            "'astropy.io.fits') if x in sys.modules))")
+        env = dict(os.environ)
+        env["PYTHONPATH"] = os.path.dirname(os.path.dirname(
+            os.path.dirname(os.path.abspath(__file__))))
+        out = subprocess.check_output([sys.executable, "-c", code], env=env)
+        self.assertEqual(out.decode().strip(), "[]")
+
 
 def test_suite():
     """Allows testing of only this module with the command::
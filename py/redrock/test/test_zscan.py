@@ -1,14 +1,29 @@
+import os
+import shutil
+import tempfile
 import unittest
 import numpy as np
 import scipy.sparse
 
 import numpy.testing as nt
 
-from ..targets import DistTargetsCopy
+from ..targets import (DistTargetsCopy, DistTargetsView, downsample_targets,
+    distribute_targets, triage_targets, TargetCost)
 from ..templates import DistTemplate
 from ..rebin import rebin_template
-from ..zscan import calc_zchi2_one, calc_zchi2_targets, spectral_data
-from ..zfind import zfind
+from ..zscan import (calc_zchi2_one, calc_zchi2_targets, spectral_data,
+    ScanRetention, NormalEquations, calc_normeq_one, solve_normeq)
+from ..targets import Target
+from ..results import write_zscan
+from ..memory import predict_memory
+from ..priors import RedshiftPriors, parse_zlimits
+from ..zfind import zfind, _small_delta_chi2
+from ..fitz import get_dv
+from ..utils import (available_cpus, worker_cpus, worker_threads,
+    configure_workers, distribute_work, WorkerPool)
+from .. import constants
+from ..zwarning import ZWarningMask as ZW
+from .. import instrument
 
 from . import util
 
@@ -126,6 +141,565 @@ class TestZScan(unittest.TestCase):
         self.assertTrue(np.all(zfit['spectype'] == 'STAR'))
 
 
+    def test_zfind_local_scan(self):
+        t1 = util.get_target(0.2); t1.id = 111
+        t2 = util.get_target(0.25); t2.id = 222
+        dtarg = DistTargetsCopy([t1, t2])
+        dwave = dtarg.wavegrids()
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        dtemp = DistTemplate(template, dwave)
+
+        zscan1, zfit1 = zfind(dtarg, [ dtemp ])
+        zscan2, zfit2 = zfind(dtarg, [ dtemp ], gather_scan=False)
+
+        self.assertEqual(zfit1.colnames, zfit2.colnames)
+        self.assertTrue(np.all(np.diff(zfit1['targetid']) >= 0))
+        for cn in zfit1.colnames:
+            nt.assert_equal(zfit1[cn], zfit2[cn])
+        self.assertEqual(sorted(zscan1.keys()), sorted(zscan2.keys()))
+
+
+    def test_zfind_no_targets(self):
+        t1 = util.get_target(0.2); t1.id = 111
+        dtarg = DistTargetsCopy([t1])
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        dtemp = DistTemplate(template, dtarg.wavegrids())
+        zscan1, zfit1 = zfind(dtarg, [ dtemp ])
+
+        empty = DistTargetsView(dtarg, list())
+        for mp_procs in (1, 2):
+            zscan, zfit = zfind(empty, [ dtemp ], mp_procs=mp_procs)
+            self.assertEqual(zscan, dict())
+            self.assertEqual(len(zfit), 0)
+            self.assertTrue(set(zfit.colnames).issubset(zfit1.colnames))
+            self.assertEqual(zfit['coeff'].shape, (0, template.nbasis))
+
+
+    def test_downsample(self):
+        np.random.seed(3)
+        t1 = util.get_target(0.2); t1.id = 111
+        t2 = util.get_target(0.25); t2.id = 222
+        dtarg = DistTargetsCopy([t1, t2])
+
+        s = t1.spectra[0]
+        b = s.downsample(3)
+        self.assertEqual(b.nwave, (s.nwave + 2) // 3)
+        nt.assert_allclose(b.ivar.sum(), s.ivar.sum())
+        nt.assert_allclose(np.sum(b.ivar * b.flux), np.sum(s.ivar * s.flux))
+        # A constant template stays constant after the binned resolution.
+        ones = b.R.dot(np.ones(b.nwave))
+        nt.assert_allclose(ones[5:-5], 1.0)
+
+        coarse = downsample_targets(dtarg, 3)
+        self.assertEqual(coarse.local_target_ids(), dtarg.local_target_ids())
+        cwave = coarse.wavegrids()
+        self.assertEqual(len(cwave), len(dtarg.wavegrids()))
+        self.assertTrue(set(cwave).isdisjoint(dtarg.wavegrids()))
+
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        zscan1, zfit1 = zfind(dtarg, [ DistTemplate(template,
+            dtarg.wavegrids()) ])
+        zscan2, zfit2 = zfind(dtarg, [ DistTemplate(template, cwave) ],
+            coarse=coarse)
+        best1 = zfit1[zfit1['znum'] == 0]
+        best2 = zfit2[zfit2['znum'] == 0]
+        nt.assert_allclose(best2['z'], best1['z'], atol=1e-3)
+        self.assertTrue(np.all((best2['zwarn'] & ZW.COARSE_MISMATCH) == 0))
+
+
+    def test_zfind_checkpoint(self):
+        targets = list()
+        for i, z in enumerate([0.2, 0.25, 0.22, 0.18, 0.27]):
+            tg = util.get_target(z)
+            tg.id = 100 + i
+            targets.append(tg)
+        dtarg = DistTargetsCopy(targets)
+        dwave = dtarg.wavegrids()
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        dtemp = DistTemplate(template, dwave)
+
+        zscan1, zfit1 = zfind(dtarg, [ dtemp ])
+
+        ckdir = tempfile.mkdtemp()
+        try:
+            zscan2, zfit2 = zfind(dtarg, [ dtemp ], checkpoint=ckdir,
+                checkpoint_size=2)
+            chunks = sorted(os.listdir(ckdir))
+            self.assertEqual(len(chunks), 3)
+
+            # Resume after losing one chunk, and with nothing left to do
+            os.remove(os.path.join(ckdir, chunks[1]))
+            zscan3, zfit3 = zfind(dtarg, [ dtemp ], checkpoint=ckdir,
+                checkpoint_size=2)
+            self.assertEqual(len(os.listdir(ckdir)), 3)
+            zscan4, zfit4 = zfind(dtarg, [ dtemp ], checkpoint=ckdir)
+        finally:
+            shutil.rmtree(ckdir)
+
+        ft = template.full_type
+        for zscan, zfit in [(zscan2, zfit2), (zscan3, zfit3), (zscan4, zfit4)]:
+            self.assertEqual(zfit1.colnames, zfit.colnames)
+            for cn in zfit1.colnames:
+                nt.assert_equal(zfit1[cn], zfit[cn])
+            self.assertEqual(sorted(zscan1.keys()), sorted(zscan.keys()))
+            for tid in zscan1:
+                for key in zscan1[tid][ft]:
+                    nt.assert_equal(zscan1[tid][ft][key], zscan[tid][ft][key])
+
+
+    def test_priors(self):
+        from astropy.table import Table
+        np.random.seed(5)
+        t1 = util.get_target(0.2); t1.id = 111
+        t2 = util.get_target(0.25); t2.id = 222
+        t3 = util.get_target(0.22); t3.id = 333
+        dtarg = DistTargetsCopy([t1, t2, t3])
+        dwave = dtarg.wavegrids()
+        redshifts = np.linspace(0.1, 0.4, 61)
+        gal = util.get_template(redshifts=redshifts)
+        star = util.get_template(spectype='STAR', redshifts=redshifts)
+        dtemp = [ DistTemplate(gal, dwave), DistTemplate(star, dwave) ]
+
+        self.assertEqual(parse_zlimits(['0.5', 'star:0.3']),
+            {None: 0.5, 'STAR': 0.3})
+        table = Table()
+        table['TARGETID'] = [111, 222, 222, 444]
+        table['ZMIN'] = [0.181, np.nan, 0.0, 2.5]
+        table['ZMAX'] = [0.219, np.nan, 0.0, 3.0]
+        table['SPECTYPE'] = ['', 'GALAXY', 'STAR', 'QSO']
+        priors = RedshiftPriors.from_table(table, zmax={'STAR': 0.301})
+        self.assertEqual(sorted(priors.targets), [111, 222, 444])
+        self.assertEqual(priors.window(111, star), (0.181, 0.219))
+        self.assertEqual(priors.window(333, star), (None, 0.301))
+        self.assertIsNone(priors.mask(333, gal))
+        # No template is allowed for 444, so its priors are ignored.
+        self.assertEqual(priors.masks(444, [gal, star]),
+            {gal.full_type: None, star.full_type: None})
+
+        zscan0, zfit0 = zfind(dtarg, dtemp)
+        for mp in (1, 2):
+            zscan, zfit = zfind(dtarg, dtemp, mp_procs=mp, priors=priors)
+            # The window includes one grid point on each side.
+            chi2 = zscan[111][gal.full_type]['zchi2']
+            scanned = redshifts[np.isfinite(chi2)]
+            nt.assert_allclose([scanned[0], scanned[-1]], [0.18, 0.22])
+            rows = zfit[zfit['targetid'] == 111]
+            self.assertTrue(np.all(rows['zscan_min'] == scanned[0]))
+            self.assertTrue(np.all((rows['z'] >= 0.18) & (rows['z'] <= 0.22)))
+            # Only the galaxy template is fit for target 222.
+            rows = zfit[zfit['targetid'] == 222]
+            self.assertEqual(set(rows['spectype']), set(['GALAXY']))
+            self.assertTrue(np.all(np.isinf(zscan[222][star.full_type]['zchi2'])))
+            # The global limit of the stars applies to target 333.
+            rows = zfit[(zfit['targetid'] == 333) & (zfit['spectype'] == 'STAR')]
+            self.assertTrue(np.all(rows['zscan_max'] == redshifts[41]))
+            # The best fits inside the windows are unchanged.
+            for tid in (111, 222):
+                best0 = zfit0[(zfit0['targetid'] == tid) & (zfit0['znum'] == 0)]
+                best = zfit[(zfit['targetid'] == tid) & (zfit['znum'] == 0)]
+                nt.assert_allclose(best['z'], best0['z'], atol=1e-4)
+
+
+    def test_triage(self):
+        np.random.seed(6)
+        targets = list()
+        for i, z in enumerate([0.2, 0.25, 0.22, 0.21]):
+            tg = util.get_target(z)
+            tg.id = 100 + i
+            for s in tg.spectra:
+                s.ivar = s.ivar.copy()
+            targets.append(tg)
+        for s in targets[1].spectra:
+            s.ivar[:] = 0.0
+        for s in targets[2].spectra:
+            s.ivar[:] = 0.0
+        targets[2].spectra[0].ivar[10:12] = 1.0
+        flags = {103: ZW.SKY}
+
+        skip = triage_targets(targets, flags=flags, minpixels=3)
+        self.assertEqual(skip, {101: (ZW.NODATA, 0),
+            102: (ZW.LITTLE_COVERAGE, 2),
+            103: (ZW.SKY, sum([ np.count_nonzero(s.ivar) \
+            for s in targets[3].spectra ]))})
+        dist = distribute_targets(targets, 2, skip=skip)
+        self.assertEqual(sorted(sum(dist, [])), [100, 101, 102, 103])
+
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 31))
+        dtarg = DistTargetsCopy(targets[0:1])
+        zscan0, zfit0 = zfind(dtarg, [ DistTemplate(template,
+            dtarg.wavegrids()) ])
+        dtarg = DistTargetsCopy(targets)
+        dtemp = DistTemplate(template, dtarg.wavegrids())
+        ckdir = tempfile.mkdtemp()
+        try:
+            runs = [ zfind(dtarg, [dtemp], flags=flags),
+                zfind(dtarg, [dtemp], mp_procs=2, flags=flags),
+                zfind(dtarg, [dtemp], flags=flags, checkpoint=ckdir,
+                    checkpoint_size=1) ]
+        finally:
+            shutil.rmtree(ckdir)
+        ft = template.full_type
+        for zscan, zfit in runs:
+            best = zfit[zfit['znum'] == 0]
+            nt.assert_equal(best['targetid'], [100, 101, 102, 103])
+            nt.assert_equal(best['zwarn'][1:],
+                [ZW.NODATA, ZW.LITTLE_COVERAGE, ZW.SKY])
+            self.assertEqual(list(best['spectype'][1:]), ['', '', ''])
+            nt.assert_equal(best['z'][1:], 0.0)
+            self.assertEqual(np.sum(zfit['targetid'] != 100), 3)
+            for tid in (101, 102, 103):
+                self.assertTrue(np.all(np.isinf(zscan[tid][ft]['zchi2'])))
+            rows = zfit[zfit['targetid'] == 100]
+            nt.assert_allclose(rows['z'], zfit0['z'])
+            nt.assert_allclose(zscan[100][ft]['zchi2'], zscan0[100][ft]['zchi2'])
+
+
+    def test_distribute(self):
+        weights = { x : w for x, w in enumerate([1, 1, 1, 1, 8, 9, 10, 1, 1,
+            0, 0, 0, 0, 0, 0]) }
+        ids = list(weights.keys())
+        for method in ("lpt", "contiguous"):
+            dist = distribute_work(3, ids, weights=weights, method=method)
+            self.assertEqual(sorted(sum(dist, [])), ids)
+            for d in dist:
+                self.assertEqual(d, sorted(d))
+        dist = distribute_work(3, ids, weights=weights)
+        loads = [ sum([ weights[x] for x in d ]) for d in dist ]
+        self.assertEqual(sorted(loads), [11, 11, 11])
+        # The zero weights are spread evenly.
+        self.assertEqual([ len(d) for d in dist ], [5, 5, 5])
+        with self.assertRaises(ValueError):
+            distribute_work(3, ids, method="greedy")
+
+        # The cost grows with the spectra and the pixels with data.
+        np.random.seed(7)
+        cost = TargetCost()
+        t1 = util.get_target(0.2, nexp=1)
+        t2 = util.get_target(0.2, nexp=3)
+        self.assertGreater(cost(t2), cost(t1))
+        npix = sum([ s.nwave for s in t1.spectra ])
+        t1.spectra[0].ivar = np.zeros(t1.spectra[0].nwave)
+        self.assertLess(cost(t1), cost.cost(len(t1.spectra), npix))
+
+        # The workers get targets which are not contiguous in the local
+        # list, and the results are put back in order.
+        targets = list()
+        for i, nexp in enumerate([4, 1, 1, 3, 1, 2, 1, 1]):
+            tg = util.get_target(0.2 + 0.01 * i, nexp=nexp)
+            tg.id = 100 + i
+            targets.append(tg)
+        dist = distribute_targets(targets, 3)
+        self.assertTrue(any([ np.any(np.diff(d) > 1) for d in dist ]))
+        dtarg = DistTargetsCopy(targets)
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 31))
+        dtemp = DistTemplate(template, dtarg.wavegrids())
+        zscan1, zfit1 = zfind(dtarg, [ dtemp ])
+        zscan3, zfit3 = zfind(dtarg, [ dtemp ], mp_procs=3)
+        ft = template.full_type
+        for tid in zscan1:
+            nt.assert_allclose(zscan3[tid][ft]['zchi2'],
+                zscan1[tid][ft]['zchi2'])
+        for cn in ('targetid', 'z', 'chi2'):
+            nt.assert_allclose(zfit3[cn], zfit1[cn])
+
+
+    def test_mp_tasks(self):
+        # The workers share the batches of all templates, and refine the
+        # fits of each batch right after its scan.
+        targets = list()
+        for i, nexp in enumerate([3, 1, 2, 1, 1, 2]):
+            tg = util.get_target(0.2 + 0.01 * i, nexp=nexp)
+            tg.id = 100 + i
+            targets.append(tg)
+        dtarg = DistTargetsCopy(targets)
+        templates = [ util.get_template(redshifts=np.linspace(0.15, 0.3, 31)),
+            util.get_template(redshifts=np.linspace(0.1, 0.4, 61),
+            subtype="B") ]
+        dtemp = [ DistTemplate(t, dtarg.wavegrids()) for t in templates ]
+        zscan1, zfit1 = zfind(dtarg, dtemp)
+        for backend in WorkerPool.backends:
+            instrument.recorder().reset()
+            zscan3, zfit3 = zfind(dtarg, dtemp, mp_procs=3, backend=backend)
+            for tid in zscan1:
+                for t in templates:
+                    ft = t.full_type
+                    nt.assert_allclose(zscan3[tid][ft]['zchi2'],
+                        zscan1[tid][ft]['zchi2'])
+            for cn in ('targetid', 'z', 'chi2', 'spectype', 'subtype'):
+                self.assertTrue(np.all(zfit3[cn] == zfit1[cn]))
+            refine = [ x for x in instrument.recorder().records()["spans"] \
+                if x[0] == "refine" ]
+            self.assertEqual(set([ x[4]["template"] for x in refine ]),
+                set([ t.full_type for t in templates ]))
+
+
+    def test_normeq_update(self):
+        np.random.seed(4)
+        targets = list()
+        for i, z in enumerate([0.2, 0.25, 0.22]):
+            tg = util.get_target(z)
+            tg.id = 100 + i
+            targets.append(tg)
+        # The first exposure in each band (spectra 0 and 2) is "old".
+        old = [ Target(tg.id, [ tg.spectra[0], tg.spectra[2] ]) \
+            for tg in targets ]
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        ft = template.full_type
+        retention = ScanRetention(normeq=True)
+
+        # The packed normal equations give the same chi2 as the direct fit.
+        tdata = rebin_template(template, 0.2, { s.wavehash : s.wave \
+            for s in targets[0].spectra })
+        args = spectral_data(targets[0].spectra)
+        neq = calc_normeq_one(targets[0].spectra, *(args + (tdata,
+            template.nbasis)))
+        zchi2, zcoeff = calc_zchi2_one(targets[0].spectra, *(args + (tdata,)))
+        chi2, coeff = solve_normeq(neq, template.nbasis)
+        nt.assert_allclose(chi2, zchi2, rtol=1e-8)
+        nt.assert_allclose(coeff, zcoeff, rtol=1e-8)
+
+        dtarg = DistTargetsCopy(targets)
+        dtemp = DistTemplate(template, dtarg.wavegrids())
+        zscan1, zfit1 = zfind(dtarg, [ dtemp ])
+        dold = DistTargetsCopy(old)
+        zscan2, zfit2 = zfind(dold, [ dtemp ], retention=retention)
+        self.assertEqual(zscan2[100][ft]['normeq_spectra'].shape, (16,))
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            scanfile = os.path.join(tmpdir, 'old.h5')
+            write_zscan(scanfile, zscan2, zfit2)
+            # Target 102 is not in the stored file.
+            normeq = NormalEquations.read(scanfile, [100, 101, 102, 103],
+                [ dtemp ])
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(sorted(normeq.data.keys()), [100, 101, 102])
+        spectra, keys, stored = normeq.select(targets[0], ft)
+        self.assertEqual(len(spectra), 2)
+        self.assertTrue(spectra[0] is targets[0].spectra[1])
+        self.assertEqual(len(normeq.select(old[0], ft)[0]), 0)
+        # Stored sums with spectra which the target does not have are not
+        # used.
+        tg = Target(100, targets[0].spectra[1:])
+        self.assertTrue(normeq.select(tg, ft)[2] is None)
+
+        zscan3, zfit3 = zfind(dtarg, [ dtemp ], retention=retention,
+            normeq=normeq)
+        for tid in zscan1:
+            nt.assert_allclose(zscan3[tid][ft]['zchi2'],
+                zscan1[tid][ft]['zchi2'], rtol=1e-8)
+            nt.assert_allclose(zscan3[tid][ft]['zcoeff'],
+                zscan1[tid][ft]['zcoeff'], rtol=1e-6, atol=1e-8)
+        nt.assert_allclose(zfit3['z'], zfit1['z'], rtol=1e-8)
+
+
+    def test_normeq_checkpoint(self):
+        # The spectrum keys have the same length in all checkpoint chunks.
+        targets = list()
+        for i, nexp in enumerate([9, 1]):
+            tg = util.get_target(0.2 + 0.02 * i, nexp=nexp)
+            tg.id = 100 + i
+            targets.append(tg)
+        self.assertEqual([ len(tg.spectra) for tg in targets ], [18, 2])
+        dtarg = DistTargetsCopy(targets)
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 31))
+        ft = template.full_type
+        dtemp = DistTemplate(template, dtarg.wavegrids())
+        retention = ScanRetention(normeq=True)
+        tmpdir = tempfile.mkdtemp()
+        try:
+            ckdir = os.path.join(tmpdir, 'checkpoint')
+            zscan, zfit = zfind(dtarg, [ dtemp ], retention=retention,
+                checkpoint=ckdir, checkpoint_size=1)
+            for tid in zscan:
+                self.assertEqual(zscan[tid][ft]['normeq_spectra'].shape,
+                    (32,))
+            write_zscan(os.path.join(tmpdir, 'scan.h5'), zscan, zfit)
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_thread_backend(self):
+        targets = list()
+        for i, z in enumerate([0.2, 0.25, 0.22]):
+            tg = util.get_target(z)
+            tg.id = 100 + i
+            targets.append(tg)
+        dtarg = DistTargetsCopy(targets)
+        dwave = dtarg.wavegrids()
+        template = util.get_template(redshifts=np.linspace(0.15, 0.3, 50))
+        ft = template.full_type
+
+        dtemp1 = DistTemplate(template, dwave, mp_procs=2)
+        dtemp2 = DistTemplate(template, dwave, mp_procs=2, backend='threads')
+        for i in range(len(template.redshifts)):
+            for key in dwave:
+                nt.assert_equal(dtemp1.local.data[i][key],
+                    dtemp2.local.data[i][key])
+
+        zscan1, zfit1 = zfind(dtarg, [ dtemp1 ], mp_procs=2)
+        zscan2, zfit2 = zfind(dtarg, [ dtemp2 ], mp_procs=2,
+            backend='threads')
+        for cn in zfit1.colnames:
+            nt.assert_equal(zfit1[cn], zfit2[cn])
+        for tid in zscan1:
+            for key in zscan1[tid][ft]:
+                nt.assert_equal(zscan1[tid][ft][key], zscan2[tid][ft][key])
+
+        with self.assertRaises(ValueError):
+            DistTemplate(template, dwave, backend='blat')
+
+
+    def test_worker_threads(self):
+        ncpu = len(available_cpus())
+        try:
+            configure_workers(threads=None, pin="cores")
+            self.assertEqual(worker_threads(1), ncpu)
+            self.assertEqual(worker_threads(2 * ncpu), 1)
+            self.assertIsNone(worker_cpus(0, 2 * ncpu, 1, None))
+            cpus = [ worker_cpus(i, ncpu, 1, "cores") for i in range(ncpu) ]
+            self.assertEqual(sorted(sum(cpus, [])), available_cpus())
+            # Already bound to fewer CPUs than needed: not pinned.
+            self.assertIsNone(worker_cpus(0, 2 * ncpu, 1, "cores"))
+            configure_workers(threads=3)
+            self.assertEqual(worker_threads(100), 3)
+            with self.assertRaises(ValueError):
+                configure_workers(pin="blat")
+        finally:
+            configure_workers()
+
+
+    def test_instrument(self):
+        import json
+        targets = [ util.get_target(0.2), util.get_target(0.5) ]
+        targets[1].id = 111
+        dtarg = DistTargetsCopy(targets)
+        template = util.get_template(redshifts=np.linspace(0.1, 0.6, 40))
+        instrument.recorder().reset()
+        memory = instrument.enable_memory()
+        try:
+            dtemp = DistTemplate(template, dtarg.wavegrids())
+            zscan, zfit = zfind(dtarg, [ dtemp ])
+        finally:
+            instrument.enable_memory(False)
+        rec = instrument.recorder().records()
+        if memory:
+            self.assertGreater(rec["gauges"]["results_bytes"],
+                2 * 40 * 8 * 2)
+            self.assertIsNotNone(rec["spans"][0][5])
+        self.assertEqual(rec["counters"]["chi2_evaluations"], 2 * 40)
+        self.assertEqual(rec["counters"]["targets"], 2)
+        names = set([ x[0] for x in rec["spans"] ])
+        for name in ("rebin", "scan", "refine", "gather"):
+            self.assertIn(name, names)
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            jfile = os.path.join(tmpdir, "trace.json")
+            instrument.write_trace(jfile)
+            with open(jfile) as f:
+                summ = json.load(f)
+            self.assertEqual(summ["nproc"], 1)
+            self.assertEqual(summ["phases"]["scan"]["nproc"], 1)
+            self.assertEqual(summ["ranks"][0]["spans"]["scan"]["calls"], 1)
+            cfile = os.path.join(tmpdir, "trace.chrome.json")
+            instrument.write_trace(cfile, format="chrome")
+            with open(cfile) as f:
+                trace = json.load(f)
+            phases = set([ x["ph"] for x in trace["traceEvents"] ])
+            self.assertEqual(phases, set(["M", "X", "C"]))
+        finally:
+            shutil.rmtree(tmpdir)
+
+
+    def test_predict_memory(self):
+        template = util.get_template(redshifts=np.linspace(0.1, 0.6, 40))
+        retention = ScanRetention()
+        self.assertEqual(retention.nbytes(40, 3), 40 * 8 * (2 + 3))
+        window = ScanRetention(zcoeff='window', dtype=np.float32)
+        self.assertLess(window.nbytes(4000, 10), retention.nbytes(4000, 10))
+
+        serial = predict_memory(100, 1000, [ template ], retention=retention)
+        self.assertEqual(serial["results"], 100 * retention.nbytes(40,
+            template.nbasis))
+        mpi = predict_memory(100, 1000, [ (40, template.nbasis) ], nproc=4,
+            retention=retention)
+        self.assertLess(mpi["process"], serial["process"])
+        self.assertGreater(mpi["node"], mpi["process"] * 4)
+
+
+    def test_small_delta_chi2(self):
+        np.random.seed(2)
+        nfit = np.random.randint(1, 8, size=50)
+        group = np.repeat(np.arange(len(nfit)), nfit)
+        znum = np.concatenate([ np.arange(n) for n in nfit ])
+        chi2 = np.random.uniform(0, 20, size=len(group))
+        z = np.random.uniform(0, 0.02, size=len(group))
+
+        flag = _small_delta_chi2(chi2, z, group, znum, nfit, blocksize=7)
+
+        for g in range(len(nfit)):
+            ii = np.where(group == g)[0]
+            for i in ii[:-1]:
+                jj = ii[ii != i]
+                dchi2 = np.abs(chi2[jj] - chi2[i])
+                dv = np.abs(get_dv(z=z[jj], zref=z[i]))
+                expected = np.any((dchi2 < 9.) \
+                    & (dv >= constants.max_velo_diff))
+                self.assertEqual(flag[i], expected)
+            self.assertFalse(flag[ii[-1]])
+
+
+    def test_compress(self):
+        tg = util.get_target(0.5)
+        spectra = tg.spectra
+        for x in spectra:
+            x.ivar = x.ivar.copy()
+        spectra[0].ivar[0:50] = 0.0
+        spectra[0].ivar[200:260] = 0.0
+        spectra[2].ivar[:] = 0.0
+        template = util.get_template()
+        dwave = { s.wavehash : s.wave for s in spectra }
+        tdata = rebin_template(template, 0.5, dwave)
+
+        weights, flux, wflux = spectral_data(spectra)
+        s = spectra[0]
+        nt.assert_equal(s.pixels, np.where(s.ivar > 0)[0])
+        self.assertEqual(len(weights), len(s.pixels) \
+            + np.count_nonzero(spectra[1].ivar) \
+            + np.count_nonzero(spectra[3].ivar))
+        self.assertEqual(len(spectra[2].pixels), 0)
+        # The masked blocks also drop the template pixels which only feed
+        # them.
+        self.assertEqual(s.feed_range[0], 45)
+        self.assertIn(204, s.feed)
+        self.assertNotIn(205, s.feed)
+        self.assertNotIn(254, s.feed)
+        self.assertIn(255, s.feed)
+        self.assertTrue(isinstance(spectra[1].feed, slice))
+
+        zchi2, zcoeff = calc_zchi2_one(spectra, weights, flux, wflux, tdata)
+        Tb = np.vstack([ x.Rcsr.dot(tdata[x.wavehash]) for x in spectra ])
+        w = np.concatenate([ x.ivar for x in spectra ])
+        f = np.concatenate([ x.flux for x in spectra ])
+        coeff = np.linalg.solve(Tb.T.dot(w[:,None] * Tb), Tb.T.dot(w * f))
+        nt.assert_allclose(zcoeff, coeff)
+        nt.assert_allclose(zchi2, np.sum(w * (f - Tb.dot(coeff))**2))
+
+        # Rebinning only the needed pixels gives the same fit.
+        part = rebin_template(template, 0.5, dwave, pixels={ s.wavehash : \
+            s.feed_range })
+        self.assertTrue(np.all(part[s.wavehash][0:45] == 0))
+        w, f, wf = spectral_data([ s ])
+        nt.assert_allclose(calc_zchi2_one([ s ], w, f, wf, part)[0],
+            calc_zchi2_one([ s ], w, f, wf, tdata)[0])
+
+        s.sharedmem_pack()
+        self.assertTrue(s.pixels is None)
+        s.sharedmem_unpack()
+
+
     def test_sharedmem(self):
         z1 = 0.0
         z2 = 1e-4
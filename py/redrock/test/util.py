@@ -9,38 +9,56 @@ from ..targets import Spectrum, Target, DistTargetsCopy
 from ..templates import Template
 
 
-def get_template(wavemin=100, wavemax=9000, wavestep=5, spectype='GALAXY', subtype='', redshifts=None):
+#- DESI-like wavelength grids of the b, r and z cameras
+desi_waves = [np.arange(3600, 5800.1, 0.8), np.arange(5760, 7620.1, 0.8),
+    np.arange(7520, 9824.1, 0.8)]
+
+
+def get_template(wavemin=100, wavemax=9000, wavestep=5, spectype='GALAXY', subtype='', redshifts=None, nbasis=3):
     """Returns fake template PCA eigenvectors to use for testing
+
+    Basis vectors beyond the first 3 are sinusoids of increasing frequency,
+    so that nbasis can be set to the size of real templates (e.g. 10).
     """
     if redshifts is None:
         redshifts = np.linspace(0, 1, 20)
     wave = np.arange(wavemin, wavemax + wavestep/2.0, wavestep)
-    flux = np.zeros((3, len(wave)))
+    flux = np.zeros((max(3, nbasis), len(wave)))
     wavemid = (wavemin + wavemax) / 2.0
     wx = np.pi*(2*(wave - wavemin) / (wavemax-wavemin) - 1)
     flux[0] = 1.0
     flux[1] = np.arange(len(wave)) / len(wave)
     flux[2] = np.exp(-(wave-wavemid)**2/(2*20**2)) + 0.1*np.sin(wx)
+    for i in range(3, nbasis):
+        flux[i] = np.sin((i - 1) * wx)
 
     return Template(spectype=spectype, redshifts=redshifts, wave=wave,
         flux=flux, subtype=subtype)
 
 
-def get_target(z=0.5, wavestep=5):
+def get_target(z=0.5, wavestep=5, waves=None, nexp=2):
     """Returns a fake target at redshift z to use for testing
+
+    By default the target has 2 exposures of 2 small cameras.  Pass the
+    wavelength grids of the cameras as waves (e.g. desi_waves) and the number
+    of exposures as nexp to get targets of a realistic size.
     """
-    template = get_template()
+    if waves is None:
+        template = get_template()
+        waves = [np.arange(4000, 6700, wavestep), np.arange(6502, 8001, wavestep)]
+    else:
+        template = get_template(wavemin=100, wavemax=waves[-1][-1] + 100)
     c = np.random.normal(size=template.nbasis)
     c = [1,2,3]
     spectra = list()
-    for wave in [np.arange(4000, 6700, wavestep), np.arange(6502, 8001, wavestep)]:
+    for wave in waves:
         flux = template.eval(c, wave, z)
         sigma = np.random.normal(loc=1, scale=0.1, size=len(wave)).clip(0.5, 1.5)
         ivar = 1/sigma**2
         R = _getR(len(wave), 2.0)
         assert isinstance(R, scipy.sparse.dia_matrix)
         assert hasattr(R, 'offsets')
-        for i in range(2):
+        for i in range(nexp):
             noisyflux = flux + np.random.normal(scale=sigma)
             spectra.append(Spectrum(wave, noisyflux, ivar, R, R.tocsr()))
 
@@ -10,6 +10,8 @@ import time
 
 import numpy as np
 
+from .instrument import count
+
 
 #- From https://github.com/desihub/desispec io.util.native_endian
 def native_endian(data):
@@ -69,19 +71,21 @@ def elapsed(timer, prefix, comm=None):
     If timer is None, compute the start time and return.  Otherwise, find the
     elapsed time and print a message before returning the new start time.
 
+    The processes are not synchronized, so with MPI this is the time seen by
+    the rank 0 process.  The times of every process are recorded by the spans
+    of redrock.instrument.
+
     Args:
         timer (float): time in seconds for some arbitrary epoch.  If "None",
             get the current time and return.
         prefix (str): string to print before the elapsed time.
-        comm (mpi4py.MPI.Comm): optional communicator.
+        comm (mpi4py.MPI.Comm): optional communicator.  Only the rank 0
+            process prints the message.
 
     Returns:
         float: the new start time in seconds.
 
     """
-    if comm is not None:
-        comm.barrier()
-
     cur = time.time()
     if timer is not None:
         elapsed = cur - timer
@@ -92,6 +96,29 @@ def elapsed(timer, prefix, comm=None):
     return cur
 
 
+def process_age():
+    """Return the time since this process started.
+
+    This includes the interpreter startup and the imports, which are not
+    seen by timers started in the code.
+
+    Returns:
+        float: the age of the process in seconds, or None if this is not
+            available on the system.
+
+    """
+    try:
+        with open("/proc/self/stat", "r") as f:
+            # The command name may contain spaces, the fields after it do not.
+            fields = f.read().rsplit(")", 1)[1].split()
+        start = float(fields[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime", "r") as f:
+            uptime = float(f.read().split()[0])
+    except (IOError, OSError, ValueError, IndexError, AttributeError):
+        return None
+    return max(0.0, uptime - start)
+
+
 def nersc_login_node():
     """Returns True if we are on a NERSC login node, else False.
     """
@@ -146,6 +173,287 @@ def get_mp(requested):
     return procs
 
 
+# Per-worker thread settings, see configure_workers().
+_worker_threads = dict(threads=None, pin=None)
+
+_thread_env = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS",
+    "VECLIB_MAXIMUM_THREADS", "NUMEXPR_NUM_THREADS")
+
+
+def available_cpus():
+    """Return the sorted list of CPUs this process is allowed to run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    import multiprocessing as mp
+    return list(range(mp.cpu_count()))
+
+
+def numa_cpus():
+    """Return the CPUs of each NUMA domain, or None if this is unknown.
+
+    Only the CPUs that this process is allowed to run on are included.
+
+    """
+    import glob
+    import re
+    avail = set(available_cpus())
+    nodes = list()
+    nodefiles = glob.glob("/sys/devices/system/node/node*/cpulist")
+    nodefiles.sort(key=lambda x: int(re.findall(r"node(\d+)", x)[-1]))
+    for nf in nodefiles:
+        cpus = list()
+        try:
+            with open(nf, "r") as f:
+                for rng in f.read().strip().split(","):
+                    if rng == "":
+                        continue
+                    lo, _, hi = rng.partition("-")
+                    cpus.extend(range(int(lo), int(hi or lo) + 1))
+        except (IOError, OSError, ValueError):
+            return None
+        cpus = [ c for c in cpus if c in avail ]
+        if len(cpus) > 0:
+            nodes.append(cpus)
+    if len(nodes) == 0:
+        return None
+    return nodes
+
+
+def worker_cpus(index, nworker, nthread, pin):
+    """Select the CPUs for one worker.
+
+    Args:
+        index (int): the index of the worker.
+        nworker (int): the number of workers sharing the available CPUs.
+        nthread (int): the number of threads of each worker.
+        pin (str): "cores" gives each worker its own block of nthread CPUs,
+            "numa" assigns the workers round-robin to the NUMA domains.
+            None disables pinning.
+
+    Returns:
+        list: the CPUs, or None if the worker should not be pinned.
+
+    """
+    if pin is None or pin == "none":
+        return None
+    if pin not in ("cores", "numa"):
+        raise ValueError("unknown pinning \"{}\"".format(pin))
+    avail = available_cpus()
+    if pin == "numa":
+        nodes = numa_cpus()
+        if nodes is None:
+            return None
+        return nodes[index % len(nodes)]
+    if len(avail) < nworker * nthread:
+        # The process was already bound to a smaller set of CPUs (for
+        # example by the MPI launcher), keep it.
+        return None
+    first = index * nthread
+    return avail[first:first+nthread]
+
+
+def set_threads(nthread, cpus=None):
+    """Limit the threads used by this process and optionally pin it.
+
+    The BLAS / OpenMP thread pools are limited at run time with threadpoolctl
+    when it is installed.  Otherwise the usual environment variables are set,
+    which only affects libraries that are loaded afterwards.  The numba
+    thread count is also limited.
+
+    Args:
+        nthread (int): the maximum number of threads.
+        cpus (list): if not None, pin the process to these CPUs.
+
+    Returns:
+        dict: the effective configuration, with the keys "threads", "method"
+            (the way the BLAS limit was applied) and "cpus".
+
+    """
+    nthread = max(1, int(nthread))
+    for key in _thread_env:
+        os.environ[key] = str(nthread)
+    method = "environment"
+    try:
+        from threadpoolctl import threadpool_limits
+        threadpool_limits(limits=nthread)
+        method = "threadpoolctl"
+    except ImportError:
+        pass
+    try:
+        import numba
+        numba.set_num_threads(min(nthread, numba.config.NUMBA_NUM_THREADS))
+    except (ImportError, AttributeError, ValueError):
+        pass
+    if cpus is not None and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, cpus)
+        except OSError:
+            cpus = None
+    else:
+        cpus = None
+    return dict(threads=nthread, method=method, cpus=cpus)
+
+
+def configure_workers(threads=None, pin=None):
+    """Set the thread limits and pinning applied when workers start.
+
+    Args:
+        threads (int): the number of BLAS / OpenMP threads of each worker.
+            None (the default) divides the available CPUs evenly between the
+            workers.
+        pin (str): None, "cores" or "numa", see worker_cpus().
+
+    """
+    if pin == "none":
+        pin = None
+    if pin not in (None, "cores", "numa"):
+        raise ValueError("unknown pinning \"{}\"".format(pin))
+    _worker_threads["threads"] = threads
+    _worker_threads["pin"] = pin
+    return
+
+
+def worker_threads(nworker):
+    """Return the number of threads to use in each of nworker workers."""
+    if _worker_threads["threads"] is not None:
+        return max(1, _worker_threads["threads"])
+    return max(1, len(available_cpus()) // max(1, nworker))
+
+
+def mpi_threads(comm):
+    """Apply the worker thread settings to the MPI processes.
+
+    The processes running on the same node share its CPUs.  This must be
+    called by all processes of the communicator.
+
+    Args:
+        comm (mpi4py.Comm): the communicator.
+
+    Returns:
+        dict: the effective configuration of this process, see set_threads().
+
+    """
+    try:
+        from mpi4py import MPI
+        local = comm.Split_type(MPI.COMM_TYPE_SHARED)
+        nworker = local.size
+        index = local.rank
+        local.Free()
+    except (ImportError, AttributeError, NotImplementedError):
+        nworker = 1
+        index = 0
+    nthread = worker_threads(nworker)
+    return set_threads(nthread, cpus=worker_cpus(index, nworker, nthread,
+        _worker_threads["pin"]))
+
+
+def _start_worker(index, nworker, target, args):
+    """Apply the worker thread settings and run target(*args)."""
+    nthread = worker_threads(nworker)
+    set_threads(nthread, cpus=worker_cpus(index, nworker, nthread,
+        _worker_threads["pin"]))
+    return target(*args)
+
+
+def thread_summary(config):
+    """Format the output of set_threads() for logging."""
+    cpus = "not pinned"
+    if config["cpus"] is not None:
+        cpus = "pinned to CPUs {}".format(",".join(
+            [ str(c) for c in config["cpus"] ]))
+    return "{} threads ({}), {}".format(config["threads"], config["method"],
+        cpus)
+
+
+class WorkerPool(object):
+    """Run worker functions in processes or in threads.
+
+    This keeps the pattern used when MPI is disabled, where each worker is
+    started explicitly with its share of the data and sends its results to
+    a queue, independent of how the workers are run.  With the "processes"
+    backend each worker is a multiprocessing.Process and the data is pickled
+    (or passed through shared memory).  With the "threads" backend the
+    workers run in a thread pool and share the data of the parent.  This is
+    only efficient if the workers spend their time in code which releases
+    the GIL (numpy, scipy and the nogil numba kernels).
+
+    The BLAS / OpenMP threads of the workers are limited to share the
+    available CPUs (see configure_workers()).  Worker processes apply the
+    limits, and optionally pin themselves, when they start.  Worker threads
+    share the limits of the parent, which are restored by close().
+
+    Args:
+        backend (str): "processes" or "threads".
+        nworker (int): the maximum number of concurrent workers.
+
+    """
+    backends = ("processes", "threads")
+
+    def __init__(self, backend="processes", nworker=1):
+        if backend not in self.backends:
+            raise ValueError("unknown backend \"{}\"".format(backend))
+        self._backend = backend
+        self._procs = list()
+        self._pool = None
+        self._nworker = max(1, nworker)
+        self._limits = None
+        if backend == "threads":
+            from concurrent.futures import ThreadPoolExecutor
+            self._pool = ThreadPoolExecutor(max_workers=self._nworker)
+            try:
+                from threadpoolctl import threadpool_limits
+                self._limits = threadpool_limits(
+                    limits=worker_threads(self._nworker))
+            except ImportError:
+                pass
+
+    @property
+    def backend(self):
+        return self._backend
+
+    @property
+    def shared(self):
+        """True if the workers share memory with the parent."""
+        return self._backend == "threads"
+
+    def queue(self):
+        """Return a queue that workers can use to send results."""
+        if self._backend == "threads":
+            if sys.version_info[0] > 2:
+                import queue
+            else:
+                import Queue as queue
+            return queue.Queue()
+        import multiprocessing as mp
+        return mp.Queue()
+
+    def start(self, target, args):
+        """Start one worker calling target(*args)."""
+        if self._backend == "threads":
+            self._procs.append(self._pool.submit(target, *args))
+        else:
+            import multiprocessing as mp
+            index = len(self._procs) % self._nworker
+            p = mp.Process(target=_start_worker,
+                args=(index, self._nworker, target, args))
+            p.start()
+            self._procs.append(p)
+        return
+
+    def close(self):
+        """Wait for all workers to finish."""
+        if self._backend == "threads":
+            self._pool.shutdown(wait=True)
+            if self._limits is not None:
+                self._limits.restore_original_limits()
+                self._limits = None
+        else:
+            for p in self._procs:
+                p.join()
+        self._procs = list()
+        return
+
+
 def mp_array(original):
     """Allocate a raw shared memory buffer and wrap it in an ndarray.
 
@@ -171,7 +479,85 @@ def mp_array(original):
     return nd
 
 
-def distribute_work(nproc, ids, weights=None):
+def mpi_gather_rows(comm, data, root=0):
+    """Gather arrays along their first dimension to one process.
+
+    Each process passes an array with the same shape (apart from the first
+    dimension) and dtype, or None if it has no rows.  The rows are sent as raw
+    buffers with a single Gatherv call, using a datatype of one full row so
+    that the counts stay small, and concatenated in rank order on the root
+    process.
+
+    Args:
+        comm (mpi4py.MPI.Comm): the MPI communicator.
+        data (array): the local rows, or None.
+        root (int): the process which receives the data.
+
+    Returns:
+        array: the concatenated rows on the root process, None elsewhere.
+            If every process passed None, all processes return None.
+
+    """
+    from mpi4py import MPI
+
+    info = None
+    if data is not None:
+        info = (data.shape, data.dtype.str)
+    allinfo = comm.allgather(info)
+    valid = [ x for x in allinfo if x is not None ]
+    if len(valid) == 0:
+        return None
+
+    rowshape = tuple(valid[0][0][1:])
+    dtype = np.dtype(valid[0][1])
+    rowbytes = int(np.prod(rowshape, dtype=np.int64)) * dtype.itemsize
+    rows = [ 0 if x is None else x[0][0] for x in allinfo ]
+
+    rowtype = MPI.BYTE.Create_contiguous(max(rowbytes, 1))
+    rowtype.Commit()
+
+    nrow = 0
+    if data is None:
+        sendbuf = np.zeros(0, dtype=np.uint8)
+    else:
+        nrow = data.shape[0]
+        sendbuf = np.ascontiguousarray(data, dtype=dtype)
+
+    result = None
+    recvbuf = None
+    if comm.rank == root:
+        result = np.empty((sum(rows),) + rowshape, dtype=dtype)
+        displs = np.cumsum([0,] + rows[:-1])
+        recvbuf = [ result, rows, list(displs), rowtype ]
+
+    if rowbytes > 0:
+        comm.Gatherv([ sendbuf, nrow, rowtype ], recvbuf, root=root)
+        count("bytes_gathered", sendbuf.nbytes)
+
+    rowtype.Free()
+    return result
+
+
+def _distribute_lpt(nproc, ids, weights):
+    """Longest processing time partitioning of weighted IDs.
+
+    The IDs are taken in order of decreasing weight and each is assigned to
+    the process with the smallest total weight so far (and then the fewest
+    IDs, so that zero weights are spread evenly).
+
+    """
+    import heapq
+    order = sorted(ids, key=lambda x: (-weights[x], x))
+    heap = [ (0.0, 0, p) for p in range(nproc) ]
+    dist = [ list() for p in range(nproc) ]
+    for x in order:
+        load, n, p = heapq.heappop(heap)
+        dist[p].append(x)
+        heapq.heappush(heap, (load + weights[x], n + 1, p))
+    return [ sorted(x) for x in dist ]
+
+
+def distribute_work(nproc, ids, weights=None, method="lpt"):
     """Helper function to distribute work among processes.
 
     This takes a list of unique IDs associated with each work unit, and a
@@ -183,12 +569,18 @@ def distribute_work(nproc, ids, weights=None):
         ids (list): list of IDs
         weights (dict): dictionary of weights for each ID.  If None,
             use equal weighting.
+        method (str): "lpt" assigns the IDs by decreasing weight to the
+            least loaded process, which balances the total weights well.
+            "contiguous" splits the sorted IDs into ranges of similar
+            weight.
 
     Returns:
         list:  A list (one element for each process) with each element
-            being a list of the IDs assigned to that process.
+            being a sorted list of the IDs assigned to that process.
 
     """
+    if method not in ("lpt", "contiguous"):
+        raise ValueError("unknown distribution method \"{}\"".format(method))
     #
     # These are two helper functions.
     #
@@ -219,6 +611,9 @@ def distribute_work(nproc, ids, weights=None):
     if weights is None:
         weights = { x : 1 for x in ids }
 
+    if method == "lpt":
+        return _distribute_lpt(nproc, ids, weights)
+
     sids = list(sorted(ids))
     wts = np.array([ weights[x] for x in sids ], dtype=np.float64)
 
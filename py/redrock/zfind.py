@@ -10,6 +10,7 @@ from __future__ import division, print_function
 import os
 import re
 import sys
+import glob
 import traceback
 
 import time
@@ -20,71 +21,370 @@ import astropy.table
 
 from . import constants
 
-from .utils import elapsed
+from .utils import mpi_gather_rows
 
-from .targets import Spectrum, Target, DistTargets, distribute_targets
+from .instrument import span, count, gauge, memory_enabled
+
+from .memory import nbytes
+
+from .targets import (Spectrum, Target, DistTargets, DistTargetsView,
+    distribute_targets, triage_targets)
 
 from .templates import Template, DistTemplate
 
-from .zscan import calc_zchi2_targets
+from .zscan import calc_zchi2_targets, normeq_keys
+
+from .results import write_checkpoint, read_checkpoint
 
 from .fitz import fitz, get_dv
 
 from .zwarning import ZWarningMask as ZW
 
 
-def _mp_fitz(chi2, target_data, t, nminima, qout):
-    """Wrapper for multiprocessing version of fitz.
+def _small_delta_chi2(chi2, z, group, znum, nfit, blocksize=4096):
+    """Find the fits which have a nearby chi^2 at a distant redshift.
+
+    For every fit (except the last of each group), check whether any other fit
+    in the same group has a chi^2 within 9 and a velocity difference of at
+    least constants.max_velo_diff.  Groups are processed in blocks as padded
+    2D arrays to bound the memory use.
+
+    Args:
+        chi2 (array): chi^2 of each fit, sorted by group.
+        z (array): redshift of each fit.
+        group (array): the group index (0...ngroup-1) of each fit.
+        znum (array): the position of each fit within its group.
+        nfit (array): the number of fits in each group.
+        blocksize (int): the number of groups to process at once.
+
+    Returns:
+        array: boolean array which is True for flagged fits.
+
     """
-    try:
-        # Unpack targets from shared memory
-        for tg in target_data:
-            tg.sharedmem_unpack()
-        results = list()
-        for i, tg in enumerate(target_data):
-            zfit = fitz(chi2[i], t.template.redshifts, tg.spectra,
-                t.template, nminima=nminima)
-            npix = 0
-            for spc in tg.spectra:
-                npix += (spc.ivar > 0.).sum()
-            results.append( (tg.id, zfit, npix) )
-        qout.put(results)
-    except:
-        exc_type, exc_value, exc_traceback = sys.exc_info()
-        lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
-        lines = [ "MP calc_zchi2: {}".format(x) for x in lines ]
-        print("".join(lines))
-        sys.stdout.flush()
+    flag = np.zeros(len(chi2), dtype=bool)
+    ngroup = len(nfit)
+    if ngroup == 0:
+        return flag
+    maxfit = np.max(nfit)
 
+    for first in range(0, ngroup, blocksize):
+        last = min(first + blocksize, ngroup)
+        rows = np.where((group >= first) & (group < last))[0]
+        g = group[rows] - first
+        k = znum[rows]
 
-def zfind(targets, templates, mp_procs=1, nminima=3):
-    """Compute all redshift fits for the local set of targets and collect.
+        pchi2 = np.full((last - first, maxfit), np.nan)
+        pz = np.full((last - first, maxfit), np.nan)
+        pchi2[g, k] = chi2[rows]
+        pz[g, k] = z[rows]
 
-    Given targets and templates distributed across a set of MPI processes,
-    compute the redshift fits for all redshifts and our local set of targets.
-    Each process computes the fits for a slice of redshift range and then
-    cycles through redshift slices by passing the interpolated templates along
-    to the next process in order.
+        alldeltachi2 = np.absolute(pchi2[:,None,:] - pchi2[:,:,None])
+        alldv = np.absolute(get_dv(z=pz[:,None,:], zref=pz[:,:,None]))
+        close = (alldeltachi2 < 9.) & (alldv >= constants.max_velo_diff)
+        close[:, np.arange(maxfit), np.arange(maxfit)] = False
+        pflag = np.any(close, axis=2)
 
-    Note:
-        If using MPI, only the rank 0 process will return results- all other
-        processes with return a tuple of (None, None).
+        flag[rows] = pflag[g, k] & (k < nfit[group[rows]] - 1)
+
+    return flag
+
+
+def _assemble_zfit(results, targetids, nminima, mincoeff=0, skip=None):
+    """Build the table of best fit results for a set of targets.
+
+    The fits for all targets and template types are concatenated into
+    columns, sorted by (targetid, chi2) and the per-target quantities (fit
+    number, delta chi^2, zwarn flags and the trimming of extra subtypes) are
+    computed with grouped array operations.  The Table is only constructed
+    once at the end.
+
+    Args:
+        results (dict): the results for each target ID, containing the
+            "zfit" Table for each template type and the "meta" dictionary.
+        targetids (list): the target IDs to include, in output order.
+        nminima (int): the number of minima to keep for each spectype.
+        mincoeff (int): pad the coefficients to at least this length, so that
+            tables built on different processes have the same shape.
+        skip (dict): (optional) the (ZWARN bits, number of pixels) of the
+            targets which were not fit.  Each gets a single placeholder row
+            with z = 0, an empty spectype and these zwarn bits.
+
+    Returns:
+        Table: the best fit results for all minima of all targets.
+
+    """
+    # Gather the columns of all fits into lists of arrays.
+
+    colnames = None
+    cols = dict()
+    tindx = list()
+    spectypes = list()
+    subtypes = list()
+    ncoeff = list()
+    for t, tid in enumerate(targetids):
+        for fulltype in results[tid]:
+            if fulltype == 'meta':
+                continue
+            tmp = results[tid][fulltype]['zfit']
+            if colnames is None:
+                colnames = list(tmp.colnames)
+                cols = { x : list() for x in colnames }
+            for cn in colnames:
+                cols[cn].append(np.asarray(tmp[cn]))
+            #- TODO: reconsider fragile parsing of fulltype
+            if fulltype.count(':::') > 0:
+                spectype, subtype = fulltype.split(':::')
+            else:
+                spectype, subtype = (fulltype, '')
+            nfit = len(tmp)
+            tindx.append(np.full(nfit, t, dtype=np.int64))
+            spectypes.append(np.repeat(spectype, nfit))
+            subtypes.append(np.repeat(subtype, nfit))
+            ncoeff.append(np.full(nfit, tmp['coeff'].shape[1], dtype=np.int64))
+
+    # Placeholder rows of the targets which were not fit.
+
+    if skip is not None:
+        for t, tid in enumerate(targetids):
+            if tid not in skip:
+                continue
+            for cn in colnames:
+                cols[cn].append(np.zeros((1,) + cols[cn][0].shape[1:],
+                    dtype=cols[cn][0].dtype))
+            cols['zwarn'][-1][0] = skip[tid][0]
+            cols['npixels'][-1][0] = skip[tid][1]
+            for cn in ('zscan_min', 'zscan_max'):
+                if cn in cols:
+                    cols[cn][-1][0] = np.nan
+            tindx.append(np.full(1, t, dtype=np.int64))
+            spectypes.append(np.repeat('', 1))
+            subtypes.append(np.repeat('', 1))
+            ncoeff.append(np.zeros(1, dtype=np.int64))
+
+    # Pad the coefficients to the largest number of basis vectors.
+
+    maxncoeff = max([ x.shape[1] for x in cols['coeff'] ] + [ mincoeff ])
+    coeff = np.zeros((sum([ len(x) for x in cols['coeff'] ]), maxncoeff),
+        dtype=np.float64)
+    off = 0
+    for c in cols['coeff']:
+        coeff[off:off+len(c), 0:c.shape[1]] = c
+        off += len(c)
+    cols['coeff'] = [ coeff ]
+
+    cols = { x : np.concatenate(cols[x]) for x in colnames }
+    tindx = np.concatenate(tindx)
+    spectypes = np.concatenate(spectypes)
+    subtypes = np.concatenate(subtypes)
+    ncoeff = np.concatenate(ncoeff)
+
+    # Sort by target and then chi2.
+
+    order = np.lexsort((cols['chi2'], tindx))
+    cols = { x : cols[x][order] for x in colnames }
+    tindx = tindx[order]
+    spectypes = spectypes[order]
+    subtypes = subtypes[order]
+    ncoeff = ncoeff[order]
+    nrow = len(tindx)
+
+    # Position of every row within the fits of its target, and the start
+    # and size of each target group.
+
+    first = np.searchsorted(tindx, tindx, side='left')
+    znum = np.arange(nrow) - first
+    groupstart = np.where(znum == 0)[0]
+    group = np.cumsum(znum == 0) - 1
+    nfit = np.diff(np.append(groupstart, nrow))
+    islast = (znum == nfit[group] - 1)
+
+    deltachi2 = np.ediff1d(cols['chi2'], to_end=0.0)
+    deltachi2[islast] = 0.0
+
+    zwarn = cols['zwarn']
+    zwarn[ (cols['npixels'] < 10*ncoeff) ] |= ZW.LITTLE_COVERAGE
+
+    #- set ZW.SMALL_DELTA_CHI2 flag
+    smalldchi2 = _small_delta_chi2(cols['chi2'], cols['z'], group, znum, nfit)
+    zwarn[smalldchi2] |= ZW.SMALL_DELTA_CHI2
+
+    # Trim down cases of multiple subtypes for a single type (e.g. STARs).
+    # The rows are already sorted by chi2 within each target, so keep the
+    # first nminima of each (target, spectype).  The stable sort preserves
+    # the chi2 order within each (target, spectype) group.
+
+    spectype_indx = np.unique(spectypes, return_inverse=True)[1]
+    tsorder = np.lexsort((np.arange(nrow), spectype_indx, tindx))
+    tskey = tindx[tsorder] * (np.max(spectype_indx) + 1) \
+        + spectype_indx[tsorder]
+    tsrank = np.empty(nrow, dtype=np.int64)
+    tsrank[tsorder] = np.arange(nrow) \
+        - np.searchsorted(tskey, tskey, side='left')
+    keep = (tsrank < nminima)
+
+    # Build the output table.
+
+    tids = np.asarray(targetids)
+    allzfit = astropy.table.Table()
+    allzfit['targetid'] = tids[tindx[keep]]
+    for cn in colnames:
+        allzfit[cn] = cols[cn][keep]
+    allzfit['spectype'] = spectypes[keep]
+    allzfit['subtype'] = subtypes[keep]
+    allzfit['ncoeff'] = ncoeff[keep]
+    allzfit['znum'] = znum[keep]
+    allzfit['deltachi2'] = deltachi2[keep]
+
+    # Now we have the final table of best fit results.  We want to add any
+    # extra columns from the target metadata.  We assume that the meta keys
+    # for the first target are the same keys for all targets...
+
+    firstmeta = results[targetids[0]]['meta']
+    allmetakeys = list(sorted(firstmeta.keys()))
+
+    # Parse any type information for the metadata.
+
+    typepat = re.compile(r'(.*)_datatype')
+    metakeys = list()
+    metatypes = dict()
+    for mk in allmetakeys:
+        mat = typepat.match(mk)
+        if mat is None:
+            # this is a real key
+            metakeys.append(mk)
+        else:
+            # get the data type
+            metatypes[mat.group(1)] = firstmeta[mk]
+    for mk in metakeys:
+        if mk not in metatypes:
+            metatypes[mk] = None
+
+    # Append the columns, building each one per target and then expanding
+    # it to the rows of that target.
+
+    for mk in metakeys:
+        tcol = np.array([ results[x]['meta'][mk] for x in targetids ],
+            dtype=metatypes[mk])
+        allzfit.add_column(astropy.table.Column(tcol[tindx[keep]], name=mk))
+
+    return allzfit
+
+
+def _empty_zfit(ncoeff, scanned=False):
+    """Build a table of best fit results without any rows.
+
+    Args:
+        ncoeff (int): the number of coefficients.
+        scanned (bool): if True, include the "zscan_min" and "zscan_max"
+            columns added with redshift priors.
+
+    Returns:
+        Table: the columns of _assemble_zfit() for no targets.
+
+    """
+    allzfit = astropy.table.Table()
+    allzfit['targetid'] = np.zeros(0, dtype=np.int64)
+    allzfit['z'] = np.zeros(0)
+    allzfit['zerr'] = np.zeros(0)
+    allzfit['zwarn'] = np.zeros(0, dtype=np.int64)
+    allzfit['chi2'] = np.zeros(0)
+    allzfit['zz'] = np.zeros((0, 15))
+    allzfit['zzchi2'] = np.zeros((0, 15))
+    allzfit['coeff'] = np.zeros((0, ncoeff))
+    allzfit['npixels'] = np.zeros(0, dtype=np.int64)
+    if scanned:
+        allzfit['zscan_min'] = np.zeros(0)
+        allzfit['zscan_max'] = np.zeros(0)
+    allzfit['spectype'] = np.zeros(0, dtype='U1')
+    allzfit['subtype'] = np.zeros(0, dtype='U1')
+    allzfit['ncoeff'] = np.zeros(0, dtype=np.int64)
+    allzfit['znum'] = np.zeros(0, dtype=np.int64)
+    allzfit['deltachi2'] = np.zeros(0)
+    return allzfit
+
+
+def _coarse_mismatch(results, targets, templates):
+    """Flag the fits which disagree with a downsampled coarse scan.
+
+    For each target and template, the best refined fit is compared to the
+    lowest chi^2 of the coarse scan.  If they are further apart than
+    constants.max_velo_diff, the best fit is flagged with COARSE_MISMATCH:
+    the minima of the full resolution data are likely not all found by the
+    coarse scan.
+
+    Returns:
+        int: the number of flagged (target, template) pairs.
+
+    """
+    nbad = 0
+    for tg in targets.local():
+        for t in templates:
+            res = results[tg.id][t.template.full_type]
+            ibest = np.argmin(res['zchi2'] + res['penalty'])
+            zfit = res['zfit']
+            if len(zfit) == 0:
+                continue
+            dv = get_dv(z=zfit['z'][0], zref=t.template.redshifts[ibest])
+            if np.abs(dv) > constants.max_velo_diff:
+                zfit['zwarn'][0] |= ZW.COARSE_MISMATCH
+                nbad += 1
+    count("coarse_mismatch", nbad)
+    return nbad
+
+
+def _record_priors(results, targets, templates, priors):
+    """Add the redshift range scanned to the fits of each template.
+
+    The columns "zscan_min" and "zscan_max" of every fit contain the first
+    and last redshift evaluated for its target and template.
+
+    """
+    tlist = [ t.template for t in templates ]
+    for tg in targets.local():
+        masks = priors.masks(tg.id, tlist)
+        for t in tlist:
+            mask = masks[t.full_type]
+            scanned = t.redshifts if mask is None else t.redshifts[mask]
+            if len(scanned) == 0:
+                scanned = [ np.nan, ]
+            zfit = results[tg.id][t.full_type]['zfit']
+            zfit['zscan_min'] = np.full(len(zfit), scanned[0])
+            zfit['zscan_max'] = np.full(len(zfit), scanned[-1])
+    return
+
+
+def _zfind_local(targets, templates, mp_procs=1, nminima=3, retention=None,
+    backend="processes", coarse=None, normeq=None, priors=None, skip=None,
+    nkeys=None):
+    """Compute the scan and the refined fits for the local targets.
 
     Args:
         targets (DistTargets): distributed targets.
-        templates (list): list of DistTemplate objects.
+        templates (list): list of DistTemplate objects, rebinned to the
+            wavelength grids of coarse if it is given.
         mp_procs (int): if not using MPI, this is the number of multiprocessing
             processes to use.
         nminima (int): number of chi^2 minima to consider.  Passed to fitz().
+        retention (ScanRetention): (optional) what scan data to keep.
+        backend (str): if not using MPI, run the multiprocessing workers as
+            "processes" or "threads".
+        coarse (DistTargets): (optional) binned copies of the local targets
+            used for the redshift scan.  The refinement uses targets.
+        normeq (NormalEquations): (optional) stored normal equations to
+            update.  Passed to calc_zchi2_targets().
+        priors (RedshiftPriors): (optional) the allowed redshifts and
+            template types of the targets.  Passed to calc_zchi2_targets().
+        skip (dict): (optional) the target IDs which are not fit.  They get
+            no weight in the distribution among the workers, are not scanned
+            and have no refined fits.
+        nkeys (int): (optional) the padded length of the spectrum keys of
+            the normal equations.  Passed to calc_zchi2_targets().
 
     Returns:
-        tuple: (allresults, allzfit), where "allresults" is a dictionary of the
-            full chi^2 fit information, suitable for writing to a redrock scan
-            file.  "allzfit" is an astropy Table of only the best fit parameters
-            for a limited set of minima.
+        dict: the results of calc_zchi2_targets() for each local target ID,
+            with the "zfit" Table of fitz() added for each template type.
 
     """
-
     # Find most likely candidate redshifts by scanning over the
     # pre-interpolated templates on a coarse redshift spacing.
 
@@ -95,38 +395,42 @@ def zfind(targets, templates, mp_procs=1, nminima=3):
     elif targets.comm.rank == 0:
         am_root = True
 
-    # If we are not using MPI, our DistTargets object will have all the targets
-    # on the main process.  In that case, we would like to distribute our
-    # targets across multiprocesses.  Here we compute that distribution, if
-    # needed.
+    # Compute the coarse-binned chi2 for all local targets.  If we are not
+    # using MPI, the multiprocessing workers also compute the refined fits of
+    # each batch of targets as soon as it is scanned.
 
-    mpdist = None
+    fit_nminima = None
+    fit_targets = None
     if targets.comm is None:
-        mpdist = distribute_targets(targets.local(), mp_procs)
-
-    # Compute the coarse-binned chi2 for all local targets.
+        fit_nminima = nminima
+        if coarse is not None:
+            fit_targets = targets.local()
 
-    results = calc_zchi2_targets(targets, templates, mp_procs=mp_procs)
+    results = calc_zchi2_targets(targets if coarse is None else coarse,
+        templates, mp_procs=mp_procs, retention=retention, backend=backend,
+        normeq=normeq, priors=priors, skip=skip, nminima=fit_nminima,
+        fit_targets=fit_targets, nkeys=nkeys)
 
-    # For each of our local targets, refine the redshift fit close to the
-    # minima in the coarse fit.
+    if memory_enabled():
+        gauge("targets_bytes", nbytes(targets.local()))
+        gauge("templates_bytes", sum([ nbytes(t.local) for t in templates ]))
+        gauge("results_bytes", nbytes(results))
 
-    sort = np.array([ t.template.full_type for t in templates]).argsort()
-    for t in np.array(list(templates))[sort]:
-        ft = t.template.full_type
+    # With MPI, each process refines the redshift fit of its local targets
+    # close to the minima in the coarse fit.
 
-        if am_root:
-            print("  Finding best fits for template {}"\
-                .format(t.template.full_type))
-            sys.stdout.flush()
+    if targets.comm is not None:
+        sort = np.array([ t.template.full_type for t in templates]).argsort()
+        for t in np.array(list(templates))[sort]:
+            ft = t.template.full_type
 
-        start = elapsed(None, "", comm=t.comm)
+            if am_root:
+                print("  Finding best fits for template {}"\
+                    .format(t.template.full_type))
+                sys.stdout.flush()
 
-        # Here we have another parallelization choice between MPI and
-        # multiprocessing.
+            refine = span("refine", template=ft)
 
-        if targets.comm is not None:
-            # MPI case.  Every process just works with its local targets.
             for tg in targets.local():
                 zfit = fitz(results[tg.id][ft]['zchi2'] \
                     + results[tg.id][ft]['penalty'],
@@ -138,175 +442,366 @@ def zfind(targets, templates, mp_procs=1, nminima=3):
                     results[tg.id][ft]['zfit']['npixels'] += \
                         (spectrum.ivar>0.).sum()
 
-        else:
-            # Multiprocessing case.
-            import multiprocessing as mp
+            seconds = refine.stop()
+            if am_root:
+                print("    Finished in: {:0.1f} seconds".format(seconds))
+                sys.stdout.flush()
 
-            # Ensure that all targets are packed into shared memory
-            for tg in targets.local():
-                tg.sharedmem_pack()
-
-            qout = mp.Queue()
-
-            procs = list()
-            for i in range(mp_procs):
-                if len(mpdist[i]) == 0:
-                    continue
-                target_data = [ x for x in targets.local() if x.id in mpdist[i] ]
-                eff_chi2 = np.zeros((len(target_data),
-                    len(t.template.redshifts)), dtype=np.float64)
-
-                for i, tg in enumerate(target_data):
-                    eff_chi2[i,:] = results[tg.id][ft]['zchi2'] \
-                        + results[tg.id][ft]['penalty']
-                p = mp.Process(target=_mp_fitz, args=(eff_chi2,
-                    target_data, t, nminima, qout))
-                procs.append(p)
-                p.start()
-
-            # Extract the output
-            for i in range(mp_procs):
-                if len(mpdist[i]) == 0:
-                    continue
-                res = qout.get()
-                for rs in res:
-                    results[rs[0]][ft]['zfit'] = rs[1]
-                    results[rs[0]][ft]['zfit']['npixels'] = rs[2]
-
-        stop = elapsed(start, "    Finished in", comm=t.comm)
+    if priors is not None:
+        _record_priors(results, targets, templates, priors)
+
+    if coarse is not None:
+        nbad = _coarse_mismatch(results, targets, templates)
+        if targets.comm is not None:
+            nbad = targets.comm.reduce(nbad, root=0)
+        if am_root and nbad > 0:
+            print("  WARNING: the coarse scan and the refined fit disagree "
+                "for {} target and template pairs".format(nbad))
+            sys.stdout.flush()
+
+    return results
+
+
+def _zfind_checkpoint(targets, templates, checkpoint, chunksize=64,
+    mp_procs=1, nminima=3, retention=None, backend="processes", coarse=None,
+    normeq=None, priors=None, skip=None, nkeys=None):
+    """Compute the results for the local targets in checkpointed chunks.
+
+    Results found in the checkpoint directory are loaded instead of being
+    computed.  The remaining local targets are processed in chunks of at most
+    chunksize targets per process, and the results of every chunk are written
+    to a new file in the directory as soon as they are complete.  Files from
+    an earlier run can be used with any number of processes.
+
+    All processes run the same number of chunks, since the scan passes the
+    templates between processes.
+
+    Args:
+        targets (DistTargets): distributed targets.
+        templates (list): list of DistTemplate objects.
+        checkpoint (str): the checkpoint directory.
+        chunksize (int): the number of targets per process in each chunk.
+        mp_procs (int): if not using MPI, this is the number of multiprocessing
+            processes to use.
+        nminima (int): number of chi^2 minima to consider.  Passed to fitz().
+        retention (ScanRetention): (optional) what scan data to keep.
+        backend (str): if not using MPI, run the multiprocessing workers as
+            "processes" or "threads".
+        coarse (DistTargets): (optional) binned copies of the local targets
+            used for the redshift scan.
+        normeq (NormalEquations): (optional) stored normal equations to
+            update.
+        priors (RedshiftPriors): (optional) the allowed redshifts and
+            template types of the targets.
+        skip (dict): (optional) the target IDs which are not fit.
+        nkeys (int): (optional) the padded length of the spectrum keys of
+            the normal equations, the same for all chunks.
+
+    Returns:
+        dict: the results for each local target ID, as from _zfind_local().
+
+    """
+    comm = targets.comm
+    rank = 0
+    if comm is not None:
+        rank = comm.rank
+
+    files = None
+    if rank == 0:
+        if not os.path.isdir(checkpoint):
+            os.makedirs(checkpoint)
+        files = sorted(glob.glob(os.path.join(checkpoint, "chunk-*.h5")))
+    if comm is not None:
+        files = comm.bcast(files, root=0)
+
+    results = read_checkpoint(files, targets.local_target_ids(), templates)
+
+    # Number the chunks of this run after those of earlier runs.
+
+    run = 0
+    for f in files:
+        mat = re.match(r"chunk-(\d+)-", os.path.basename(f))
+        if mat is not None:
+            run = max(run, int(mat.group(1)) + 1)
+
+    todo = [ tg for tg in targets.local() if tg.id not in results ]
+    if coarse is not None:
+        cmap = { tg.id : tg for tg in coarse.local() }
+    nchunk = (len(todo) + chunksize - 1) // chunksize
+    if comm is not None:
+        ndone = comm.allreduce(len(results))
+        nchunk = max(comm.allgather(nchunk))
+    else:
+        ndone = len(results)
+
+    if rank == 0:
+        print("Restored {} targets from checkpoint {}; {} chunks to do"\
+            .format(ndone, checkpoint, nchunk))
+        sys.stdout.flush()
+
+    for c in range(nchunk):
+        chunk = todo[c*chunksize:(c+1)*chunksize]
+        if (comm is None) and (len(chunk) == 0):
+            continue
+        view = DistTargetsView(targets, chunk)
+        cview = None
+        if coarse is not None:
+            cview = DistTargetsView(coarse, [ cmap[tg.id] for tg in chunk ])
+        chunkres = _zfind_local(view, templates, mp_procs=mp_procs,
+            nminima=nminima, retention=retention, backend=backend,
+            coarse=cview, normeq=normeq, priors=priors, skip=skip,
+            nkeys=nkeys)
+        if len(chunk) > 0:
+            filename = os.path.join(checkpoint,
+                "chunk-{:04d}-{:05d}-{:05d}.h5".format(run, rank, c))
+            write_checkpoint(filename, chunkres, view.local_target_ids())
+        results.update(chunkres)
+        del view
+        del cview
+        del chunkres
+
+    return results
+
+
+def zfind(targets, templates, mp_procs=1, nminima=3, gather_scan=True,
+    retention=None, checkpoint=None, checkpoint_size=64,
+    backend="processes", coarse=None, normeq=None, priors=None, flags=None):
+    """Compute all redshift fits for the local set of targets and collect.
+
+    Given targets and templates distributed across a set of MPI processes,
+    compute the redshift fits for all redshifts and our local set of targets.
+    Each process computes the fits for a slice of redshift range and then
+    cycles through redshift slices by passing the interpolated templates along
+    to the next process in order.
+
+    The table of best fits is built by every process for its local targets
+    and only those rows are sent to the root process.  The full scan data
+    (chi^2, penalty and coefficients at every redshift) is only gathered if
+    requested.
+
+    Note:
+        If using MPI, only the rank 0 process will return results- all other
+        processes with return a tuple of (None, None).  If gather_scan is
+        False, every process instead returns the scan data of its local
+        targets, and the root process additionally returns the table.
+
+    Args:
+        targets (DistTargets): distributed targets.
+        templates (list): list of DistTemplate objects, rebinned to the
+            wavelength grids of coarse if it is given.
+        mp_procs (int): if not using MPI, this is the number of multiprocessing
+            processes to use.
+        nminima (int): number of chi^2 minima to consider.  Passed to fitz().
+        gather_scan (bool): if True, gather the full scan data to the root
+            process.  If False, the scan data stays on the process that
+            computed it, for example to be written in parallel.
+        retention (ScanRetention): (optional) what scan data to keep, and
+            with which data type.  Passed to calc_zchi2_targets().
+        checkpoint (str): (optional) a directory where the results are saved
+            in chunks of targets as they are computed.  Targets already in
+            the directory are not computed again.
+        checkpoint_size (int): the number of targets per process in each
+            checkpoint chunk.
+        backend (str): if not using MPI, run the multiprocessing workers as
+            "processes" or "threads".  See redrock.utils.WorkerPool.
+        coarse (DistTargets): (optional) binned copies of the local targets
+            (see redrock.targets.downsample_targets()) used for the redshift
+            scan.  The minima are refined with the full resolution targets,
+            and best fits far from the coarse minimum are flagged with
+            ZWarningMask.COARSE_MISMATCH.
+        normeq (NormalEquations): (optional) stored normal equations of the
+            local targets, for example from an earlier run with fewer
+            spectra.  Only the spectra which are not included in them are
+            scanned, and their contribution is added.  The refinement uses
+            all spectra.
+        priors (RedshiftPriors): (optional) the allowed redshifts and
+            template types of the targets.  Only the allowed redshifts are
+            scanned and refined, the fits of other template types are not
+            included in the table, and the columns "zscan_min" and
+            "zscan_max" of the table record the redshift range scanned.
+        flags (dict): (optional) the nonzero ZWARN bits of target IDs which
+            should not be fit, for example sky fibers (ZWarningMask.SKY).
+            These targets, and those with fewer pixels with data than the
+            largest number of template coefficients (NODATA or
+            LITTLE_COVERAGE), are not scanned.  They have an infinite chi2
+            in the scan data and a single placeholder row in the table, with
+            z = 0, an empty spectype and the zwarn bits.
+
+    Returns:
+        tuple: (allresults, allzfit), where "allresults" is a dictionary of the
+            full chi^2 fit information, suitable for writing to a redrock scan
+            file.  "allzfit" is an astropy Table of only the best fit parameters
+            for a limited set of minima.
+
+    """
+
+    am_root = False
+    if targets.comm is None:
+        am_root = True
+    elif targets.comm.rank == 0:
+        am_root = True
+
+    # Find the targets which are not fit.
+
+    ncoeff = max([ t.template.nbasis for t in templates ])
+    skip = triage_targets(targets.local(), flags=flags, minpixels=ncoeff)
+    nskip = len(skip)
+    count("triaged", nskip)
+    if targets.comm is not None:
+        nskip = targets.comm.reduce(nskip, root=0)
+    if am_root and nskip > 0:
+        print("Skipping {} targets without usable data or flagged by the "
+            "input".format(nskip))
+        sys.stdout.flush()
+
+    # The spectrum keys of the normal equations have the same length for all
+    # local targets, even if they are scanned in several chunks.
+
+    nkeys = 0
+    if ((retention is not None) and retention.normeq) or (normeq is not None):
+        nkeys = normeq_keys(targets)
+
+    # Compute the scan and the refined fits of all local targets, possibly
+    # in chunks which are saved as we go.
+
+    if checkpoint is None:
+        results = _zfind_local(targets, templates, mp_procs=mp_procs,
+            nminima=nminima, retention=retention, backend=backend,
+            coarse=coarse, normeq=normeq, priors=priors, skip=skip,
+            nkeys=nkeys)
+    else:
+        results = _zfind_checkpoint(targets, templates, checkpoint,
+            chunksize=checkpoint_size, mp_procs=mp_procs, nminima=nminima,
+            retention=retention, backend=backend, coarse=coarse,
+            normeq=normeq, priors=priors, skip=skip, nkeys=nkeys)
 
     # Add the target metadata to the results
 
     for tg in targets.local():
         results[tg.id]['meta'] = tg.meta
 
-    # Gather our results to the root process and split off the zfit data.
-    # Only process zero returns data- other ranks return None.
+    # Build the table of best fits for our local targets, and then remove the
+    # zfit and meta data from the dictionary, so that it is not later
+    # interpreted as a template type.
+
+    localids = [ tg.id for tg in targets.local() ]
+
+    zfit = None
+    if len(localids) > 0:
+        zfit = _assemble_zfit(results, localids, nminima, mincoeff=ncoeff,
+            skip=skip)
+
+    for tid in localids:
+        del results[tid]['meta']
+        for fulltype in results[tid]:
+            del results[tid][fulltype]['zfit']
+
+    # Reduce the best fit tables to the root process.  These are small
+    # compared to the full scan data.  Only process zero returns the table-
+    # other ranks return None.
 
-    allresults = None
     allzfit = None
+    count("targets", len(localids))
+    gather = span("gather")
 
     if targets.comm is not None:
-        results = targets.comm.gather(results, root=0)
+        zfit = targets.comm.gather(zfit, root=0)
     else:
-        results = [ results ]
+        zfit = [ zfit ]
 
     if am_root:
-        allresults = dict()
-        for p in results:
-            allresults.update(p)
-        del results
-
-        # for t in templates:
-        #     ft = t.template.full_type
-
-        allzfit = list()
-        for tid in targets.all_target_ids:
-            tzfit = list()
-            for fulltype in allresults[tid]:
-                if fulltype == 'meta':
-                    continue
-                tmp = allresults[tid][fulltype]['zfit']
-                #- TODO: reconsider fragile parsing of fulltype
-                if fulltype.count(':::') > 0:
-                    spectype, subtype = fulltype.split(':::')
-                else:
-                    spectype, subtype = (fulltype, '')
-                tmp['spectype'] = spectype
-                tmp['subtype'] = subtype
-                tmp['ncoeff'] = tmp['coeff'].shape[1]
-                tzfit.append(tmp)
-                del allresults[tid][fulltype]['zfit']
-
-            maxncoeff = max([tmp['coeff'].shape[1] for tmp in tzfit])
-            for tmp in tzfit:
-                if tmp['coeff'].shape[1] < maxncoeff:
-                    n = maxncoeff - tmp['coeff'].shape[1]
-                    c = np.append(tmp['coeff'], np.zeros((len(tmp), n)), axis=1)
-                    tmp.replace_column('coeff', c)
-
-            tzfit = astropy.table.vstack(tzfit)
-            tzfit.sort('chi2')
-            tzfit['targetid'] = tid
-            tzfit['znum'] = np.arange(len(tzfit))
-            tzfit['deltachi2'] = np.ediff1d(tzfit['chi2'], to_end=0.0)
-            tzfit['zwarn'][ (tzfit['npixels']<10*tzfit['ncoeff']) ] |= \
-                ZW.LITTLE_COVERAGE
-
-            #- set ZW.SMALL_DELTA_CHI2 flag
-            for i in range(len(tzfit)-1):
-                noti = (np.arange(len(tzfit))!=i)
-                alldeltachi2 = np.absolute(tzfit['chi2'][noti]-tzfit['chi2'][i])
-                alldv = np.absolute(get_dv(z=tzfit['z'][noti],
-                    zref=tzfit['z'][i]))
-                zwarn = np.any( (alldeltachi2<9.) & \
-                    (alldv>=constants.max_velo_diff) )
-                if zwarn:
-                    tzfit['zwarn'][i] |= ZW.SMALL_DELTA_CHI2
-
-            # Trim down cases of multiple subtypes for a single type (e.g.
-            # STARs) tzfit is already sorted by chi2, so keep first nminima of
-            # each type.
-            iikeep = list()
-            for spectype in np.unique(tzfit['spectype']):
-                ii = np.where(tzfit['spectype'] == spectype)[0]
-                iikeep.extend(ii[0:nminima])
-            if len(iikeep) < len(tzfit):
-                tzfit = tzfit[iikeep]
-                #- grouping by spectype could get chi2 out of order; resort
-                tzfit.sort('chi2')
-
-            allzfit.append(tzfit)
-
-        allzfit = astropy.table.vstack(allzfit)
-
-        # Cosmetic: move TARGETID to be first column as primary key
-        try:
-            allzfit.columns.move_to_end('targetid', last=False)
-        except:
-            # Must be using python2, don't mess with the order.
-            pass
-
-        # Now we have the final table of best fit results.  We want to add any
-        # extra columns from the target metadata.  We assume that the meta keys
-        # for the first target are the same keys for all targets...
-
-        zfitids = list(allzfit['targetid'])
-        allmetakeys = list(sorted(allresults[zfitids[0]]['meta'].keys()))
-
-        # Parse any type information for the metadata.
-
-        typepat = re.compile(r'(.*)_datatype')
-        metakeys = list()
-        metatypes = dict()
-        for mk in allmetakeys:
-            mat = typepat.match(mk)
-            if mat is None:
-                # this is a real key
-                metakeys.append(mk)
-            else:
-                # get the data type
-                metatypes[mat.group(1)] = allresults[zfitids[0]]['meta'][mk]
-        for mk in metakeys:
-            if mk not in metatypes:
-                metatypes[mk] = None
-
-        # Append the columns
-
-        for mk in metakeys:
-            if metatypes[mk] is not None:
-                col = astropy.table.Column(np.array([ \
-                    allresults[x]['meta'][mk] for x in zfitids ],
-                    dtype=metatypes[mk]), name=mk)
+        zfit = [ x for x in zfit if x is not None ]
+        if len(zfit) == 0:
+            allzfit = _empty_zfit(ncoeff, scanned=(priors is not None))
+        else:
+            if len(zfit) == 1:
+                allzfit = zfit[0]
             else:
-                col = astropy.table.Column([ allresults[x]['meta'][mk] \
-                    for x in zfitids ], name=mk)
-            allzfit.add_column(col)
+                allzfit = astropy.table.vstack(zfit)
 
-        # Remove the meta data from the dictionary, so that it is not later
-        # interpreted as a template type.
+            # Put the rows in the order of the global target list.  The
+            # stable sort keeps the chi2 order of the fits for each target.
 
-        for tid in targets.all_target_ids:
-            del allresults[tid]['meta']
+            allids = np.asarray(targets.all_target_ids)
+            idsort = np.argsort(allids, kind='stable')
+            pos = idsort[np.searchsorted(allids, allzfit['targetid'],
+                sorter=idsort)]
+            allzfit = allzfit[np.argsort(pos, kind='stable')]
+        del zfit
+
+    gather.stop()
+
+    # Optionally gather the full scan data to the root process.
+
+    if not gather_scan:
+        return results, allzfit
+
+    allresults = None
+    if targets.comm is not None:
+        with span("gather_scan"):
+            allresults = _gather_zscan(targets.comm, results, localids,
+                templates)
+    else:
+        allresults = results
 
     return allresults, allzfit
+
+
+def _gather_zscan(comm, results, localids, templates, root=0):
+    """Gather the scan data of all targets to one process.
+
+    For each template, the per-target arrays are stacked into contiguous
+    buffers and collected with typed Gatherv calls, rather than pickling the
+    nested dictionaries.
+
+    Args:
+        comm (mpi4py.MPI.Comm): the MPI communicator.
+        results (dict): the scan results for the local targets.
+        localids (list): the local target IDs.
+        templates (list): list of DistTemplate objects.
+        root (int): the process which receives the data.
+
+    Returns:
+        dict: the scan results for all targets on the root process, and None
+            on other processes.
+
+    """
+    allids = comm.gather(localids, root=root)
+    if comm.rank == root:
+        allids = [ x for p in allids for x in p ]
+
+    allresults = None
+    if comm.rank == root:
+        allresults = { x : dict() for x in allids }
+
+    # Without any targets, there are no keys to gather.
+
+    if comm.allreduce(len(localids)) == 0:
+        return allresults
+
+    for t in templates:
+        ft = t.template.full_type
+
+        # Every process has the same keys for a given template, but some
+        # processes may have no targets.
+
+        keys = None
+        if len(localids) > 0:
+            keys = sorted([ x for x in results[localids[0]][ft].keys() \
+                if x != 'redshifts' ])
+        keys = [ x for x in comm.allgather(keys) if x is not None ][0]
+
+        for tid in allids if comm.rank == root else list():
+            allresults[tid][ft] = dict()
+            allresults[tid][ft]['redshifts'] = t.template.redshifts
+
+        for key in keys:
+            data = None
+            if len(localids) > 0:
+                data = np.stack([ results[x][ft][key] for x in localids ])
+            data = mpi_gather_rows(comm, data, root=root)
+            if comm.rank == root:
+                for i, tid in enumerate(allids):
+                    allresults[tid][ft][key] = data[i]
+
+    return allresults
@@ -9,6 +9,7 @@ from __future__ import division, print_function
 
 import os
 import sys
+import time
 import traceback
 
 import numpy as np
@@ -16,9 +17,11 @@ import scipy.sparse
 
 from . import rebin
 
-from .utils import elapsed
+from .utils import WorkerPool, distribute_work
 
-from .targets import Spectrum, Target, DistTargets, distribute_targets
+from .instrument import span, count, recorder
+
+from .targets import Spectrum, Target, DistTargets, TargetCost
 
 from .templates import Template, DistTemplate
 
@@ -28,8 +31,9 @@ from ._zscan import _zchi2_one
 def spectral_data(spectra):
     """Compute concatenated spectral data products.
 
-    This helper function builds full length array quantities needed for the
-    chi2 fit.
+    This helper function builds the array quantities needed for the chi2 fit.
+    Only the pixels with nonzero weight are included (see
+    Spectrum.compress(), which is called here).
 
     Args:
         spectra (list): list of Spectrum objects.
@@ -39,21 +43,135 @@ def spectral_data(spectra):
             redshift chi^2 fits.
 
     """
-    weights = np.concatenate([ s.ivar for s in spectra ])
-    flux = np.concatenate([ s.flux for s in spectra ])
+    if len(spectra) == 0:
+        empty = np.zeros(0, dtype=np.float64)
+        return (empty, empty, empty)
+    for s in spectra:
+        s.compress()
+    weights = np.concatenate([ s.ivar[s.pixels] for s in spectra ])
+    flux = np.concatenate([ s.flux[s.pixels] for s in spectra ])
     wflux = weights * flux
     return (weights, flux, wflux)
 
 
+class ScanRetention(object):
+    """Options for the scan data kept after the redshift scan.
+
+    The coefficients at every redshift are by far the largest part of the
+    scan results, but are only of interest close to the chi^2 minima.  These
+    options control what is kept in memory and later written to the redrock
+    scan file.
+
+    Args:
+        zcoeff (str): "full" keeps the coefficients at every redshift,
+            "window" keeps them only around the lowest chi^2 minima and "none"
+            drops them.
+        nminima (int): the number of minima used for the "window" option.
+        halfwidth (int): the number of redshifts kept on each side of each
+            minimum for the "window" option.
+        dtype (numpy.dtype): the data type for storing zchi2, penalty and
+            zcoeff, for example np.float32 to halve their size.
+        normeq (bool): also keep the sums of the normal equations at every
+            redshift (see NormalEquations), as "normeq", and the keys of the
+            spectra included in them, as "normeq_spectra".  These are always
+            stored as float64 and allow later updates with new spectra.
+
+    """
+    def __init__(self, zcoeff='full', nminima=3, halfwidth=5,
+        dtype=np.float64, normeq=False):
+        if zcoeff not in ['full', 'window', 'none']:
+            raise ValueError("Unknown zcoeff retention \"{}\"".format(zcoeff))
+        self.zcoeff = zcoeff
+        self.nminima = nminima
+        self.halfwidth = halfwidth
+        self.dtype = np.dtype(dtype)
+        self.normeq = normeq
+
+    @property
+    def nwindow(self):
+        """The number of redshifts kept for the "window" option.
+        """
+        return self.nminima * (2 * self.halfwidth + 1)
+
+    def nbytes(self, nz, ncoeff):
+        """The bytes kept for one target and template.
+
+        Args:
+            nz (int): the number of redshifts of the template.
+            ncoeff (int): the number of coefficients of the template.
+
+        Returns:
+            int: the size of the zchi2, penalty and zcoeff data.
+
+        """
+        size = self.dtype.itemsize
+        total = 2 * nz * size
+        if self.zcoeff == 'full':
+            total += nz * ncoeff * size
+        elif self.zcoeff == 'window':
+            total += self.nwindow * (ncoeff * size + 4)
+        if self.normeq:
+            total += nz * normeq_size(ncoeff) * 8
+        return total
+
+    def select(self, zchi2, penalty, zcoeff, normeq=None, spectra=None):
+        """Select the data to keep for one target and template.
+
+        Args:
+            zchi2 (array): chi^2 at each redshift.
+            penalty (array): the chi^2 penalty at each redshift.
+            zcoeff (array): the coefficients at each redshift, or None.
+            normeq (array): the packed normal equations at each redshift, or
+                None.
+            spectra (array): the keys of the spectra included in normeq,
+                padded with zeros.
+
+        Returns:
+            dict: the "zchi2", "penalty" and "zcoeff" values to keep.  For the
+                "window" option, "zcoeff_index" contains the redshift index of
+                each row of "zcoeff", with -1 (and zero coefficients) for
+                unused rows.
+
+        """
+        from .fitz import find_minima
+
+        result = dict()
+        result['zchi2'] = zchi2.astype(self.dtype, copy=False)
+        result['penalty'] = penalty.astype(self.dtype, copy=False)
+        if self.normeq and (normeq is not None):
+            result['normeq'] = normeq
+            result['normeq_spectra'] = spectra
+        if (self.zcoeff == 'none') or (zcoeff is None):
+            return result
+        if self.zcoeff == 'full':
+            result['zcoeff'] = zcoeff.astype(self.dtype, copy=False)
+            return result
+
+        nz = len(zchi2)
+        offsets = np.arange(-self.halfwidth, self.halfwidth + 1)
+        imin = find_minima(zchi2 + penalty)[0:self.nminima]
+        keep = np.unique(np.clip(imin[:,None] + offsets[None,:], 0, nz - 1))
+
+        index = np.full(self.nwindow, -1, dtype=np.int32)
+        index[0:len(keep)] = keep
+        coeff = np.zeros((self.nwindow, zcoeff.shape[1]), dtype=self.dtype)
+        coeff[0:len(keep)] = zcoeff[keep]
+        result['zcoeff_index'] = index
+        result['zcoeff'] = coeff
+        return result
+
+
 def calc_zchi2_one(spectra, weights, flux, wflux, tdata):
     """Calculate a single chi2.
 
     For one redshift and a set of spectra, compute the chi2 for template
-    data that is already on the correct grid.
+    data that is already on the correct grid.  Only the pixels selected by
+    Spectrum.compress() are used.
 
     Args:
         spectra (list): list of Spectrum objects.
-        weights (array): concatenated spectral weights (ivar).
+        weights (array): concatenated spectral weights (ivar), as returned by
+            spectral_data().
         flux (array): concatenated flux values.
         wflux (array): concatenated weighted flux values.
         tdata (dict): dictionary of interpolated template values for each
@@ -63,22 +181,193 @@ def calc_zchi2_one(spectra, weights, flux, wflux, tdata):
         tuple: chi^2 and coefficients.
 
     """
-    Tb = list()
-    nbasis = None
-    for s in spectra:
-        key = s.wavehash
-        if nbasis is None:
-            nbasis = tdata[key].shape[1]
-            #print("using ",nbasis," basis vectors", flush=True)
-        Tb.append(s.Rcsr.dot(tdata[key]))
-    Tb = np.vstack(Tb)
-    zcoeff = np.zeros(nbasis, dtype=np.float64)
+    Tb = _template_block(spectra, tdata)
+    zcoeff = np.zeros(Tb.shape[1], dtype=np.float64)
     zchi2 = _zchi2_one(Tb, weights, flux, wflux, zcoeff)
 
     return zchi2, zcoeff
 
 
-def calc_zchi2(target_ids, target_data, dtemplate, progress=None):
+def _template_block(spectra, tdata):
+    """The template convolved with the resolution, for the fitted pixels.
+    """
+    return np.vstack([ s.Rpix.dot(tdata[s.wavehash][s.feed]) \
+        for s in spectra ])
+
+
+def normeq_size(nbasis):
+    """The length of the packed normal equations for nbasis basis vectors.
+    """
+    return 1 + nbasis + nbasis * (nbasis + 1) // 2
+
+
+def calc_normeq_one(spectra, weights, flux, wflux, tdata, nbasis):
+    """Calculate the normal equations of a single chi2.
+
+    The chi^2 of the template coefficients c is
+
+        chi2 = f^T W f - 2 c^T y + c^T M c
+
+    with M = T^T W T and y = T^T W f, where T is the template data convolved
+    with the resolution, f the flux and W the inverse variance.  All three
+    are sums over the spectra.
+
+    Args:
+        spectra (list): list of Spectrum objects, which may be empty.
+        weights (array): concatenated spectral weights (ivar), as returned by
+            spectral_data().
+        flux (array): concatenated flux values.
+        wflux (array): concatenated weighted flux values.
+        tdata (dict): dictionary of interpolated template values for each
+            wavehash.
+        nbasis (int): the number of basis vectors of the template.
+
+    Returns:
+        array: the packed f^T W f, y and the upper triangle of M.
+
+    """
+    if len(spectra) == 0:
+        return np.zeros(normeq_size(nbasis), dtype=np.float64)
+    Tb = _template_block(spectra, tdata)
+    M = Tb.T.dot(weights[:,None] * Tb)
+    y = Tb.T.dot(wflux)
+    return np.concatenate([ [ np.dot(flux, wflux) ], y,
+        M[np.triu_indices(nbasis)] ])
+
+
+def solve_normeq(normeq, nbasis):
+    """Solve packed normal equations for the coefficients and the chi2.
+
+    Args:
+        normeq (array): the packed normal equations from calc_normeq_one(),
+            or their sum over several sets of spectra.
+        nbasis (int): the number of basis vectors of the template.
+
+    Returns:
+        tuple: chi^2 and coefficients.
+
+    """
+    y = normeq[1:1+nbasis]
+    M = np.zeros((nbasis, nbasis), dtype=np.float64)
+    M[np.triu_indices(nbasis)] = normeq[1+nbasis:]
+    M = M + np.triu(M, 1).T
+    zcoeff = np.linalg.solve(M, y)
+    zchi2 = normeq[0] - np.dot(zcoeff, y)
+    return zchi2, zcoeff
+
+
+def spectrum_key(spectrum):
+    """Return a nonzero 64 bit key identifying the data of a spectrum.
+    """
+    import hashlib
+    h = hashlib.sha1()
+    for x in (spectrum.wave, spectrum.flux, spectrum.ivar):
+        h.update(np.ascontiguousarray(x, dtype=np.float64).tobytes())
+    key = int(np.frombuffer(h.digest()[0:8], dtype='<i8')[0])
+    if key == 0:
+        key = 1
+    return key
+
+
+class NormalEquations(object):
+    """Stored sums of the chi^2 normal equations of some targets.
+
+    The normal equations (see calc_normeq_one()) are sums over the spectra of
+    a target, so the scan of a target can be updated with new spectra by
+    adding only their contribution to the stored sums.
+
+    Args:
+        data (dict): for each target ID, a dictionary with the packed normal
+            equations of each template full type, with shape (nz, npack).
+        spectra (dict): for each target ID, a dictionary with the keys (see
+            spectrum_key()) of the spectra included in the sums, for each
+            template full type.
+
+    """
+    def __init__(self, data=None, spectra=None):
+        self.data = dict() if data is None else data
+        self.spectra = dict() if spectra is None else spectra
+
+    def subset(self, targetids):
+        """Return the stored sums of some of the targets.
+        """
+        return NormalEquations(
+            { x : self.data[x] for x in targetids if x in self.data },
+            { x : self.spectra[x] for x in targetids if x in self.spectra })
+
+    def select(self, target, fulltype):
+        """Find the spectra of a target which are not in the stored sums.
+
+        If the stored sums include spectra which the target does not have,
+        they cannot be used and all spectra are returned.
+
+        Args:
+            target (Target): the target.
+            fulltype (str): the template full type.
+
+        Returns:
+            tuple: (spectra, keys, stored) with the list of spectra to add, the
+                keys of all spectra included in the result and the stored
+                sums at every redshift, or None.
+
+        """
+        keys = [ spectrum_key(s) for s in target.spectra ]
+        if (target.id not in self.data) or \
+            (fulltype not in self.data[target.id]):
+            return (target.spectra, keys, None)
+        old = set(self.spectra[target.id][fulltype])
+        if not old.issubset(keys):
+            return (target.spectra, keys, None)
+        spectra = [ s for s, k in zip(target.spectra, keys) if k not in old ]
+        return (spectra, keys, self.data[target.id][fulltype])
+
+    @staticmethod
+    def read(filename, targetids, templates):
+        """Read the stored sums of some targets from a scan file.
+
+        Args:
+            filename (str): a scan file written with the normal equations
+                (ScanRetention(normeq=True)).
+            targetids (list): the target IDs to read.  Targets which are not
+                in the file are skipped.
+            templates (list): list of DistTemplate objects.  The redshifts and
+                the number of basis vectors must match the file.
+
+        Returns:
+            NormalEquations: the stored sums.
+
+        """
+        from .results import ZScanFile
+        data = dict()
+        spectra = dict()
+        with ZScanFile(filename) as zf:
+            present = [ x for x in targetids if x in zf ]
+            allres = dict()
+            if len(present) > 0:
+                allres = zf.zscan(present)
+            for tid in present:
+                res = allres[tid]
+                data[tid] = dict()
+                spectra[tid] = dict()
+                for t in templates:
+                    ft = t.template.full_type
+                    if (ft not in res) or ('normeq' not in res[ft]):
+                        raise ValueError("{} has no normal equations for "
+                            "template {}".format(filename, ft))
+                    shape = (len(t.template.redshifts),
+                        normeq_size(t.template.nbasis))
+                    if res[ft]['normeq'].shape != shape:
+                        raise ValueError("the normal equations of template "
+                            "{} in {} do not match the template".format(ft,
+                            filename))
+                    data[tid][ft] = res[ft]['normeq']
+                    keys = res[ft]['normeq_spectra']
+                    spectra[tid][ft] = keys[keys != 0]
+        return NormalEquations(data, spectra)
+
+
+def calc_zchi2(target_ids, target_data, dtemplate, progress=None,
+    retention=None, normeq=None, nkeys=0, masks=None):
     """Calculate chi2 vs. redshift for a given PCA template.
 
     Args:
@@ -87,24 +376,54 @@ def calc_zchi2(target_ids, target_data, dtemplate, progress=None):
         dtemplate (DistTemplate): distributed template data
         progress (multiprocessing.Queue): optional queue for tracking
             progress, only used if MPI is disabled.
+        retention (ScanRetention): (optional) the data type of the outputs
+            and whether to keep the coefficients.  If the coefficients are
+            not kept, zcoeff is returned as None.
+        normeq (NormalEquations): (optional) stored normal equations of the
+            targets.  Only the spectra which are not included in them are
+            fit, and their contribution is added to the stored sums.
+        nkeys (int): the length of the padded arrays of spectrum keys.
+        masks (list): (optional) for each target, None or a boolean array
+            of the redshifts of the full template grid to evaluate (see
+            redrock.priors.RedshiftPriors).  The chi2 of the other redshifts
+            is set to infinity and their coefficients to zero.
 
     Returns:
-        tuple: (zchi2, zcoeff, zchi2penalty) with:
+        tuple: (zchi2, zcoeff, zchi2penalty, zneq) with:
             - zchi2[ntargets, nz]: array with one element per target per
                 redshift
             - zcoeff[ntargets, nz, ncoeff]: array of best fit template
                 coefficients for each target at each redshift
             - zchi2penalty[ntargets, nz]: array of penalty priors per target
                 and redshift, e.g. to penalize unphysical fits
+            - zneq: None, or if the normal equations are kept or given, a
+                tuple of the packed normal equations [ntargets, nz, npack]
+                and the spectrum keys [ntargets, nkeys] of each target.
 
     """
     nz = len(dtemplate.local.redshifts)
     ntargets = len(target_ids)
     nbasis = dtemplate.template.nbasis
 
-    zchi2 = np.zeros( (ntargets, nz) )
-    zchi2penalty = np.zeros( (ntargets, nz) )
-    zcoeff = np.zeros( (ntargets, nz, nbasis) )
+    if retention is None:
+        retention = ScanRetention()
+
+    zchi2 = np.zeros( (ntargets, nz), dtype=retention.dtype )
+    zchi2penalty = np.zeros( (ntargets, nz), dtype=retention.dtype )
+    zcoeff = None
+    if retention.zcoeff != 'none':
+        zcoeff = np.zeros( (ntargets, nz, nbasis), dtype=retention.dtype )
+
+    # The normal equations are kept, or are needed to update stored ones.
+    ft = dtemplate.template.full_type
+    zneq = None
+    if retention.normeq or (normeq is not None):
+        if normeq is None:
+            normeq = NormalEquations()
+        zneq = (np.zeros( (ntargets, nz, normeq_size(nbasis)),
+            dtype=np.float64 ), np.zeros( (ntargets, nkeys),
+            dtype=np.int64 ))
+    first = dtemplate.local.first
 
     # Redshifts near [OII]; used only for galaxy templates
     if dtemplate.template.template_type == 'GALAXY':
@@ -112,38 +431,119 @@ def calc_zchi2(target_ids, target_data, dtemplate, progress=None):
             (dtemplate.template.wave <= 3733)
         OIItemplate = dtemplate.template.flux[:,isOII].T
 
+    nskip = 0
     for j in range(ntargets):
-        (weights, flux, wflux) = spectral_data(target_data[j].spectra)
+        spectra = target_data[j].spectra
+        mask = None
+        if masks is not None and masks[j] is not None:
+            mask = masks[j][first:first+nz]
+            zchi2[j,~mask] = np.inf
+            nskip += np.count_nonzero(~mask)
+        stored = None
+        if (zneq is not None) and (masks is not None) \
+            and (masks[j] is not None) and (not np.any(masks[j])):
+            # Not scanned; the spectra are not included in the sums.
+            spectra = list()
+        elif zneq is not None:
+            spectra, keys, stored = normeq.select(target_data[j], ft)
+            zneq[1][j,0:len(keys)] = keys
+            if stored is not None:
+                stored = stored[first:first+nz]
+        (weights, flux, wflux) = spectral_data(spectra)
 
         # Loop over redshifts, solving for template fit
         # coefficients.  We use the pre-interpolated templates for each
         # unique wavelength range.
         for i, z in enumerate(dtemplate.local.redshifts):
-            zchi2[j,i], zcoeff[j,i] = calc_zchi2_one(target_data[j].spectra,
-                weights, flux, wflux, dtemplate.local.data[i])
+            if mask is not None and not mask[i]:
+                continue
+            if zneq is None:
+                zchi2[j,i], coeff = calc_zchi2_one(spectra, weights, flux,
+                    wflux, dtemplate.local.data[i])
+            else:
+                neq = calc_normeq_one(spectra, weights, flux, wflux,
+                    dtemplate.local.data[i], nbasis)
+                if stored is not None:
+                    neq += stored[i]
+                zneq[0][j,i] = neq
+                zchi2[j,i], coeff = solve_normeq(neq, nbasis)
+            if zcoeff is not None:
+                zcoeff[j,i] = coeff
 
             #- Penalize chi2 for negative [OII] flux; ad-hoc
             if dtemplate.template.template_type == 'GALAXY':
-                OIIflux = np.sum( OIItemplate.dot(zcoeff[j,i]) )
+                OIIflux = np.sum( OIItemplate.dot(coeff) )
                 if OIIflux < 0:
                     zchi2penalty[j,i] = -OIIflux
 
         if dtemplate.comm is None:
             progress.put(1)
 
-    return zchi2, zcoeff, zchi2penalty
+    if nskip > 0:
+        count("chi2_skipped", nskip)
 
+    return zchi2, zcoeff, zchi2penalty, zneq
 
-def _mp_calc_zchi2(indx, target_ids, target_data, t, qout, qprog):
-    """Wrapper for multiprocessing version of calc_zchi2.
+
+def _mp_scan_worker(tasks, targets, templates, qout, qprog, retention=None,
+    normeq=None, nkeys=0, masks=None, nminima=None, fit_targets=None):
+    """Worker of the multiprocessing scan.
+
+    The worker takes tasks (template index, target IDs) from the tasks queue
+    until it gets None.  For each task it computes calc_zchi2() of the
+    targets with the template and, if nminima is given, the refined fits of
+    fitz(), with the time spent in fitz().  Only the scan data kept by
+    ScanRetention.select() is sent to qout, with the refined fits.
     """
+    from .fitz import fitz
     try:
-        # Unpack targets from shared memory
-        for tg in target_data:
-            tg.sharedmem_unpack()
-        tzchi2, tzcoeff, tpenalty = calc_zchi2(target_ids, target_data, t,
-            progress=qprog)
-        qout.put( (indx, tzchi2, tzcoeff, tpenalty) )
+        bytid = { tg.id : tg for tg in targets }
+        fitbytid = bytid
+        if fit_targets is not None:
+            fitbytid = { tg.id : tg for tg in fit_targets }
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            ti, target_ids = task
+            t = templates[ti]
+            ft = t.template.full_type
+
+            # Unpack the targets of this task from shared memory
+            target_data = [ bytid[x] for x in target_ids ]
+            for tg in target_data:
+                tg.sharedmem_unpack()
+            tzchi2, tzcoeff, tpenalty, tzneq = calc_zchi2(target_ids,
+                target_data, t, progress=qprog, retention=retention,
+                normeq=None if normeq is None else normeq.subset(target_ids),
+                nkeys=nkeys, masks=None if masks is None else \
+                [ masks[x][ft] for x in target_ids ])
+
+            zfits = None
+            if nminima is not None:
+                start = time.time()
+                zfits = list()
+                for i, tid in enumerate(target_ids):
+                    tg = fitbytid[tid]
+                    tg.sharedmem_unpack()
+                    zfit = fitz(tzchi2[i] + tpenalty[i], t.template.redshifts,
+                        tg.spectra, t.template, nminima=nminima)
+                    npix = 0
+                    for spc in tg.spectra:
+                        npix += (spc.ivar > 0.).sum()
+                    zfits.append( (zfit, npix) )
+                zfits = (zfits, start, time.time())
+
+            # Keep only the requested scan data, so that the full
+            # coefficients of the task are released here.
+            selected = [ retention.select(tzchi2[i], tpenalty[i],
+                None if tzcoeff is None else tzcoeff[i],
+                normeq=None if tzneq is None else tzneq[0][i],
+                spectra=None if tzneq is None else tzneq[1][i]) \
+                for i in range(len(target_ids)) ]
+            del tzcoeff
+            del tzneq
+            qout.put( (ti, target_ids, selected, zfits) )
     except:
         exc_type, exc_value, exc_traceback = sys.exc_info()
         lines = traceback.format_exception(exc_type, exc_value, exc_traceback)
@@ -152,7 +552,146 @@ def _mp_calc_zchi2(indx, target_ids, target_data, t, qout, qprog):
         sys.stdout.flush()
 
 
-def calc_zchi2_targets(targets, templates, mp_procs=1):
+def _mp_calc_zchi2_targets(targets, templates, mp_procs=1, retention=None,
+    backend="processes", normeq=None, nkeys=0, masks=None, skip=None,
+    nminima=None, fit_targets=None):
+    """Scan all templates for the local targets with multiprocessing.
+
+    The local targets are split into about 4 batches per worker with a
+    similar estimated cost (see redrock.targets.TargetCost).  Every pair of
+    a template and a batch is a task, and the workers take the tasks from a
+    shared queue, the most expensive first, so that the workers which finish
+    early take over the remaining tasks of any template.  The time spent by
+    the workers in the refined fits is recorded as "refine" spans.
+
+    Returns:
+        dict: for each template full type, the tuple (selected, zfits) of
+            the local targets in order, where selected is the list of the
+            scan data kept by ScanRetention.select() and zfits is None or the
+            list of (zfit, npixels) of each target.
+
+    """
+    local = targets.local()
+    local_ids = targets.local_target_ids()
+    ntarget = len(local_ids)
+
+    # The batches of targets, by decreasing cost.
+    cost = TargetCost()
+    weights = dict()
+    for tg in local:
+        weights[tg.id] = cost(tg)
+        if (skip is not None) and (tg.id in skip):
+            weights[tg.id] = 0
+    batches = [ x for x in distribute_work(min(ntarget, 4 * mp_procs),
+        local_ids, weights=weights) if len(x) > 0 ]
+    tasks = list()
+    for ti, t in enumerate(templates):
+        for b in batches:
+            tasks.append( (sum([ weights[x] for x in b ]) \
+                * len(t.template.redshifts), ti, b) )
+    tasks = [ (x[1], x[2]) for x in sorted(tasks, key=lambda x: -x[0]) ]
+
+    pool = WorkerPool(backend=backend, nworker=mp_procs)
+
+    # Ensure that all targets are packed into shared memory, unless the
+    # workers are threads which share our memory anyway.
+    if not pool.shared:
+        for tg in local:
+            tg.sharedmem_pack()
+        if fit_targets is not None:
+            for tg in fit_targets:
+                tg.sharedmem_pack()
+
+    # We explicitly spawn the workers here (rather than using a pool.map)
+    # so that we can communicate the read-only objects once.
+
+    qtask = pool.queue()
+    qout = pool.queue()
+    qprog = pool.queue()
+    for task in tasks:
+        qtask.put(task)
+    nworker = min(mp_procs, len(tasks))
+    for i in range(nworker):
+        qtask.put(None)
+    for i in range(nworker):
+        pool.start(_mp_scan_worker, (qtask, local, templates, qout, qprog,
+            retention, normeq, nkeys, masks, nminima, fit_targets))
+
+    # Track progress
+    sys.stdout.write("    Progress: {:3d} %\n".format(0))
+    sys.stdout.flush()
+    ntot = ntarget * len(templates)
+    progincr = 10
+    if (ntot > 0) and (mp_procs > ntot):
+        progincr = int(100.0 / ntot)
+    tot = 0
+    proglast = 0
+    while (tot < ntot):
+        cnt = qprog.get()
+        tot += cnt
+        prg = int(100.0 * tot / ntot)
+        if prg >= proglast + progincr:
+            proglast += progincr
+            sys.stdout.write("    Progress: {:3d} %\n".format(proglast))
+            sys.stdout.flush()
+
+    # Extract the output
+    parts = [ list() for t in templates ]
+    for task in tasks:
+        res = qout.get()
+        parts[res[0]].append(res[1:])
+    pool.close()
+
+    # Concatenate the results of each template, and put the rows back in the
+    # order of the local targets.
+
+    results = dict()
+    for ti, t in enumerate(templates):
+        ft = t.template.full_type
+        part = parts[ti]
+        if len(part) == 0:
+            results[ft] = (list(), None if nminima is None else list())
+            continue
+        rowids = np.concatenate([ x[0] for x in part ])
+        rowsort = np.argsort(rowids, kind='stable')
+        order = rowsort[np.searchsorted(rowids, local_ids, sorter=rowsort)]
+
+        selected = sum([ x[1] for x in part ], list())
+        selected = [ selected[x] for x in order ]
+        zfits = None
+        if nminima is not None:
+            zfits = sum([ x[2][0] for x in part ], list())
+            zfits = [ zfits[x] for x in order ]
+            for x in part:
+                recorder().add_span("refine", x[2][1], x[2][2],
+                    dict(template=ft))
+        results[ft] = (selected, zfits)
+        count("chi2_evaluations", ntarget * len(t.template.redshifts))
+    return results
+
+
+def normeq_keys(targets):
+    """The padded length of the spectrum keys of the normal equations.
+
+    The spectrum keys are padded to the same length for all targets, rounded
+    up so that separate runs usually agree.
+
+    Args:
+        targets (DistTargets): distributed targets.
+
+    Returns:
+        int: the length of the padded arrays of spectrum keys.
+
+    """
+    nkeys = max([ len(tg.spectra) for tg in targets.local() ] + [ 0, ])
+    if targets.comm is not None:
+        nkeys = max(targets.comm.allgather(nkeys))
+    return 16 * ((nkeys + 15) // 16)
+
+
+def calc_zchi2_targets(targets, templates, mp_procs=1, retention=None,
+    backend="processes", normeq=None, priors=None, skip=None, nminima=None,
+    fit_targets=None, nkeys=None):
     """Compute all chi2 fits for the local set of targets and collect.
 
     Given targets and templates distributed across a set of MPI processes,
@@ -166,6 +705,31 @@ def calc_zchi2_targets(targets, templates, mp_procs=1):
         templates (list): list of DistTemplate objects.
         mp_procs (int): if not using MPI, this is the number of multiprocessing
             processes to use.
+        retention (ScanRetention): (optional) what scan data to keep, and
+            with which data type.  By default everything is kept as float64.
+        backend (str): if not using MPI, run the multiprocessing workers as
+            "processes" or "threads".  See redrock.utils.WorkerPool.
+        normeq (NormalEquations): (optional) stored normal equations of the
+            local targets.  Only the spectra which are not included in them
+            are scanned.
+        priors (RedshiftPriors): (optional) the allowed redshifts and
+            template types of the targets.  Only the allowed redshifts are
+            evaluated, the others get an infinite chi2.
+        skip (dict): (optional) the target IDs which are not scanned (see
+            redrock.targets.triage_targets()).  Their chi2 is infinite at
+            every redshift.
+        nminima (int): (optional) if not using MPI, the number of chi^2
+            minima passed to fitz().  The workers then compute the refined
+            fits of each batch of targets right after its scan, and they are
+            added to the results as "zfit" with the "npixels" column.
+        fit_targets (list): (optional) the Target objects used for the
+            refined fits, with the IDs of the local targets, if they are not
+            the scanned ones.
+        nkeys (int): (optional) the padded length of the spectrum keys of
+            the normal equations (see normeq_keys()).  By default it is
+            computed from the local targets, so it must be given when the
+            targets are scanned in several calls whose results are stored
+            together.
 
     Returns:
         dict: dictionary of results for each local target ID.
@@ -182,39 +746,67 @@ def calc_zchi2_targets(targets, templates, mp_procs=1):
     elif targets.comm.rank == 0:
         am_root = True
 
-    # If we are not using MPI, our DistTargets object will have all the targets
-    # on the main process.  In that case, we would like to distribute our
-    # targets across multiprocesses.  Here we compute that distribution, if
-    # needed.
-
-    mpdist = None
-    if targets.comm is None:
-        mpdist = distribute_targets(targets.local(), mp_procs)
+    if retention is None:
+        retention = ScanRetention()
 
     results = dict()
     for tid in targets.local_target_ids():
         results[tid] = dict()
 
+    if nkeys is None:
+        nkeys = 0
+        if retention.normeq or (normeq is not None):
+            nkeys = normeq_keys(targets)
+
+    # The redshifts of each template to evaluate for each target.
+    masks = None
+    if priors is not None:
+        if normeq is not None or retention.normeq:
+            raise ValueError("redshift priors cannot be used with the "
+                "normal equations")
+        masks = dict()
+        for tg in targets.local():
+            masks[tg.id] = priors.masks(tg.id, [ t.template for t in \
+                templates ])
+    if (skip is not None) and any([ x in skip for x in \
+        targets.local_target_ids() ]):
+        if masks is None:
+            masks = { x : { t.template.full_type : None for t in templates } \
+                for x in targets.local_target_ids() }
+        for tid in targets.local_target_ids():
+            if tid in skip:
+                masks[tid] = { t.template.full_type : np.zeros(
+                    len(t.template.redshifts), dtype=bool) for t in templates }
+
     if am_root:
         print("Computing redshifts")
         sys.stdout.flush()
 
-    for t in templates:
-        ft = t.template.full_type
+    # There are 2 parallelization techniques supported here (MPI and
+    # multiprocessing).  If we are not using MPI, our DistTargets object will
+    # have all the targets on the main process, and the multiprocessing
+    # workers share the scan of all templates.
 
-        if am_root:
-            print("  Scanning redshifts for template {}"\
-                .format(t.template.full_type))
-            sys.stdout.flush()
-
-        start = elapsed(None, "", comm=t.comm)
+    mpres = None
+    if targets.comm is None:
+        print("  Scanning redshifts for templates {}".format(", ".join(
+            [ t.template.full_type for t in templates ])))
+        sys.stdout.flush()
+        scan = span("scan")
+        mpres = _mp_calc_zchi2_targets(targets, templates, mp_procs=mp_procs,
+            retention=retention, backend=backend, normeq=normeq, nkeys=nkeys,
+            masks=masks, skip=skip, nminima=nminima, fit_targets=fit_targets)
+        seconds = scan.stop()
+        print("    Finished in: {:0.1f} seconds".format(seconds))
+        sys.stdout.flush()
 
-        # There are 2 parallelization techniques supported here (MPI and
-        # multiprocessing).
+    for t in templates:
+        ft = t.template.full_type
 
         zchi2 = None
         zcoeff = None
         penalty = None
+        zfits = None
 
         if targets.comm is not None:
             # MPI case.
@@ -222,6 +814,13 @@ def calc_zchi2_targets(targets, templates, mp_procs=1):
             # (one per MPI process) until all processes have computed the chi2
             # for all redshifts for their local targets.
 
+            if am_root:
+                print("  Scanning redshifts for template {}"\
+                    .format(t.template.full_type))
+                sys.stdout.flush()
+
+            scan = span("scan", template=ft)
+
             if am_root:
                 sys.stdout.write("    Progress: {:3d} %\n".format(0))
                 sys.stdout.flush()
@@ -229,6 +828,7 @@ def calc_zchi2_targets(targets, templates, mp_procs=1):
             zchi2 = dict()
             zcoeff = dict()
             penalty = dict()
+            zneq = dict()
 
             mpi_prog_frac = 1.0
             prog_chunk = 10
@@ -242,14 +842,20 @@ def calc_zchi2_targets(targets, templates, mp_procs=1):
             done = False
             while not done:
                 # Compute the fit for our current redshift slice.
-                tzchi2, tzcoeff, tpenalty = \
-                    calc_zchi2(targets.local_target_ids(), targets.local(), t)
+                tzchi2, tzcoeff, tpenalty, tzneq = \
+                    calc_zchi2(targets.local_target_ids(), targets.local(), t,
+                    retention=retention, normeq=normeq, nkeys=nkeys,
+                    masks=None if masks is None else [ masks[x.id][ft] \
+                    for x in targets.local() ])
+                count("chi2_evaluations", len(targets.local_target_ids()) \
+                    * len(t.local.redshifts))
 
                 # Save the results into a dict keyed on the redshift chunk index
                 # for easy sorting at the end.
                 zchi2[t.local.index] = tzchi2
                 zcoeff[t.local.index] = tzcoeff
                 penalty[t.local.index] = tpenalty
+                zneq[t.local.index] = tzneq
 
                 prg = int(100.0 * prog * mpi_prog_frac)
                 if prg >= proglast + prog_chunk:
@@ -261,92 +867,55 @@ def calc_zchi2_targets(targets, templates, mp_procs=1):
                 prog += 1
 
                 # Cycle through the redshift slices
-                done = t.cycle()
+                with span("cycle", template=ft):
+                    done = t.cycle()
 
             # Concatenate the results, so that we end up with data for all
             # redshifts for our local targets.
 
             zchi2 = np.concatenate([ zchi2[p] for p in sorted(zchi2.keys()) ],
                 axis=1)
-            zcoeff = np.concatenate([ zcoeff[p] for p in sorted(zcoeff.keys()) ],
-                axis=1)
+            if retention.zcoeff == 'none':
+                zcoeff = None
+            else:
+                zcoeff = np.concatenate([ zcoeff[p] for p in \
+                    sorted(zcoeff.keys()) ], axis=1)
             penalty = np.concatenate([ penalty[p] for p in \
                 sorted(penalty.keys()) ], axis=1)
+            if tzneq is None:
+                zneq = None
+            else:
+                zneq = (np.concatenate([ zneq[p][0] for p in \
+                    sorted(zneq.keys()) ], axis=1), tzneq[1])
 
-        else:
-            # Multiprocessing case.
-            import multiprocessing as mp
-
-            # Ensure that all targets are packed into shared memory
-            for tg in targets.local():
-                tg.sharedmem_pack()
-
-            # We explicitly spawn processes here (rather than using a pool.map)
-            # so that we can communicate the read-only objects once and send
-            # a whole list of redshifts to each process.
-
-            qout = mp.Queue()
-            qprog = mp.Queue()
-
-            procs = list()
-            for i in range(mp_procs):
-                if len(mpdist[i]) == 0:
-                    continue
-                target_ids = mpdist[i]
-                target_data = [ x for x in targets.local() if x.id in mpdist[i] ]
-                p = mp.Process(target=_mp_calc_zchi2,
-                    args=(i, target_ids, target_data, t, qout, qprog))
-                procs.append(p)
-                p.start()
-
-            # Track progress
-            sys.stdout.write("    Progress: {:3d} %\n".format(0))
-            sys.stdout.flush()
-            ntarget = len(targets.local_target_ids())
-            progincr = 10
-            if mp_procs > ntarget:
-                progincr = int(100.0 / ntarget)
-            tot = 0
-            proglast = 0
-            while (tot < ntarget):
-                cnt = qprog.get()
-                tot += cnt
-                prg = int(100.0 * tot / ntarget)
-                if prg >= proglast + progincr:
-                    proglast += progincr
-                    sys.stdout.write("    Progress: {:3d} %\n".format(proglast))
-                    sys.stdout.flush()
-
-            # Extract the output
-            zchi2 = dict()
-            zcoeff = dict()
-            penalty = dict()
-
-            for i in range(mp_procs):
-                if len(mpdist[i]) == 0:
-                    continue
-                res = qout.get()
-                zchi2[res[0]] = res[1]
-                zcoeff[res[0]] = res[2]
-                penalty[res[0]] = res[3]
+            seconds = scan.stop()
+            if am_root:
+                print("    Finished in: {:0.1f} seconds".format(seconds))
+                sys.stdout.flush()
 
-            # Concatenate the results, so that we end up with data for all
-            # redshifts for all targets.
+            # Keep only the requested scan data.  For windowed coefficients,
+            # the full array for this template is released here.
 
-            zchi2 = np.concatenate([ zchi2[p] for p in sorted(zchi2.keys()) ],
-                axis=0)
-            zcoeff = np.concatenate([ zcoeff[p] for p in \
-                sorted(zcoeff.keys()) ], axis=0)
-            penalty = np.concatenate([ penalty[p] for p in \
-                sorted(penalty.keys()) ], axis=0)
+            selected = [ retention.select(zchi2[i], penalty[i],
+                None if zcoeff is None else zcoeff[i],
+                normeq=None if zneq is None else zneq[0][i],
+                spectra=None if zneq is None else zneq[1][i]) \
+                for i in range(len(targets.local())) ]
+            del zcoeff
+            del zneq
 
-        stop = elapsed(start, "    Finished in", comm=t.comm)
+        else:
+            # Multiprocessing case.  The workers already selected the scan
+            # data to keep.
+            selected, zfits = mpres.pop(ft)
 
         for i, tg in enumerate(targets.local()):
             results[tg.id][ft] = dict()
             results[tg.id][ft]['redshifts'] = t.template.redshifts
-            results[tg.id][ft]['zchi2'] = zchi2[i]
-            results[tg.id][ft]['penalty'] = penalty[i]
-            results[tg.id][ft]['zcoeff'] = zcoeff[i]
+            results[tg.id][ft].update(selected[i])
+            if zfits is not None:
+                results[tg.id][ft]['zfit'] = zfits[i][0]
+                results[tg.id][ft]['zfit']['npixels'] = zfits[i][1]
+        del selected
 
     return results
@@ -23,6 +23,7 @@ class ZWarningMask(object):
     BAD_TARGET        = 2**8  #- catastrophically bad targeting data
     NODATA            = 2**9  #- No data for this fiber, e.g. because spectrograph was broken during this exposure (ivar=0 for all pixels)
     BAD_MINFIT        = 2**10 #- Bad parabola fit to the chi2 minimum
+    COARSE_MISMATCH   = 2**11 #- best refined fit is far from the best minimum of a downsampled coarse scan
 
     @classmethod
     def flags(cls):